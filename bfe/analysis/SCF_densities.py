@@ -17,12 +17,15 @@ Things to do:
 """
 
 import numpy as np
-from gala.potential import scf
+import schwimmbad
 #import biff
 import datetime
 import sys
 sys.path.append('../../../MW-LMC-SCF/code/')
 import coefficients_smoothing
+from bfe.coefficients import grids
+from bfe.coefficients.fields import CompositeField
+from bfe.coefficients.sparse_coefficients import subset_mask
 
 
 def load_scf_coefficients(coeff_files, cov_files, nmax, lmax,
@@ -129,69 +132,125 @@ def grid_spherical_rand(N, rin, rout):
     z = R*np.cos(T)
     return np.ascontiguousarray(np.array([x.flatten(), y.flatten(), z.flatten()]).T)
 
+def scf_grid_spherical(S, T, nr, ntheta, nphi, rin, rout, rs_mw,
+        quantity='density', G=1, M=1):
+    """
+    Density or potential on a spherical grid with nr radii between rin and
+    rout, ntheta polar angles uniform in cos(theta) and nphi azimuthal
+    angles phi_k = 2 pi k/nphi, evaluated with the separable evaluator
+    bfe.coefficients.grids.spherical_grid_field instead of point by point
+    on the meshgrid of grid_spherical.
+
+    Returns:
+    --------
+    q : numpy.ndarray with shape (nr, ntheta, nphi)
+    r, theta, phi : numpy.ndarray
+        axes of the grid, with x = r sin(theta) cos(phi),
+        y = r sin(theta) sin(phi) and z = r cos(theta).
+
+    """
+    r = np.linspace(rin, rout, nr)
+    theta = np.arccos(1 - 2*np.linspace(0, 1, ntheta))
+    phi = 2*np.pi*np.arange(nphi)/nphi
+    q = grids.spherical_grid_field(r, theta, nphi, S, T, rs_mw, G=G, M=M,
+                                   quantity=quantity)
+    return q, r, theta, phi
+
 ## Compute densities
 def scf_density_grid(pos, S, T, nbins, rs_mw, rs_lmc=0,
-        lmc_com=[0,0,0], quantity='density'):
-
-    pot_halo = scf.SCFPotential(Snlm=S, Tnlm=T, m=1, r_s=rs_mw) # M=a=1
-    #pot_lmw = scf.SCFPotential(Snlm=Slmc, Tnlm=Tlmc, m=1, r_s=rs_lmc) # M=a=1
-    x = pos[0]
-    y = pos[1]
-    z = pos[2]
-    q_all = np.zeros((nbins, nbins, nbins))
-    for i in range(nbins):
-        for j in range(nbins):
-            for k in range(nbins):
-                # These line is flipping x with y!
-                #xyz_lmc = np.array(
-                #        [[x[0,i,0]-lmc_com[0]],
-                #        [y[j,0,0]-lmc_com[1]],
-                #        [z[0,0,k]-lmc_com[2]]])
-                xyz = np.array(
-                        [[x[0,i,0]],
-                        [y[j,0,0]],
-                        [z[0,0,k]]])
-
-                if quantity == "density":
-                    q_all[i][j][k] = pot_halo.density(xyz)# + pot_lmc.density(xyz_lmc)
-
-                if quantity == "potential":
-                    print('Work in progress')
-                if quantity == "acceleration":
-                    print('Work in progress')
-    return q_all.flatten()
+        lmc_com=[0,0,0], quantity='density', pool=None, filename=None):
+    """
+    Density, potential or acceleration of the expansion with M=G=1 at the
+    points (x_i, y_j, z_k) of a grid made with grid(box_size, nbins, 3),
+    evaluated in slabs with bfe.coefficients.grids.CartesianGrid.
 
-def scf_density_grid_fast(
-        x, y, z, Smw, Tmw, Slmc, Tlmc, nbins, rs_mw, rs_lmc,
-        lmc_com, quantity, G=1):
+    Parameters:
+    -----------
+    pool : schwimmbad pool
+        Evaluates the slabs in parallel, by default serially.
+    filename : str
+        If given the grid is written into this memory-mapped .npy file.
+
+    Returns:
+    --------
+    q : numpy.ndarray
+        flattened q[i,j,k], with shape (nbins**3, 3) for the acceleration.
+
+    """
+    x = pos[0][0,:,0]
+    y = pos[1][:,0,0]
+    z = pos[2][0,0,:]
+    assert len(x) == len(y) == len(z) == nbins, "pos does not match nbins"
+    if pool is None:
+        pool = schwimmbad.SerialPool()
+    q_all = grids.CartesianGrid(x, y, z, S, T, rs_mw, quantity=quantity,
+                                filename=filename).main(pool)
+    if quantity == "acceleration":
+        return q_all.reshape(-1, 3)
+    return q_all.flatten()
 
+def scf_contrast_grid(pos, S, T, nbins, rs_mw, nmax_subset=0, lmax_subset=0,
+        m=None, quantity='density', pool=None):
+    """
+    Density (or potential) of all the terms, of a subset of terms and
+    their ratio on a grid made with grid(box_size, nbins, 3), from a single
+    evaluation of the basis functions (see
+    bfe.coefficients.grids.CartesianGrid). By default the subset is the
+    monopole S_000, lmax_subset alone selects the l <= L terms and m the
+    terms of the given m values.
+
+    Returns:
+    --------
+    q_all, q_subset, ratio : numpy.ndarray
+        flattened in the order of the arrays of grid (x.flatten(),
+        y.flatten(), z.flatten()), the contrast is ratio-1.
 
-    xyz_lmc = np.array([x-lmc_com[0],
-                        y-lmc_com[1],
-                        z-lmc_com[2]])
-    xyz = np.array([x-0.1,y-0.1,z-0.1])
+    """
+    x = pos[0][0,:,0]
+    y = pos[1][:,0,0]
+    z = pos[2][0,0,:]
+    assert len(x) == len(y) == len(z) == nbins, "pos does not match nbins"
+    nmax = np.shape(S)[0] - 1
+    lmax = np.shape(S)[1] - 1
+    subset = subset_mask(nmax, lmax, nmax_subset, lmax_subset, m)
+    if pool is None:
+        pool = schwimmbad.SerialPool()
+    q = grids.CartesianGrid(x, y, z, S, T, rs_mw, quantity=quantity,
+                            subset=subset).main(pool)
+    # q[i(x), j(y), k(z)] to the (y, x, z) order of the meshgrid of grid
+    q = np.swapaxes(q, 0, 1)
+    return q[...,0].flatten(), q[...,1].flatten(), q[...,2].flatten()
 
-    potential_lmc = scf.SCFPotential(Snlm=Slmc, Tnlm=Tlmc, m=1, r_s=rs_lmc)
-    potential_mw = scf.SCFPotential(Snlm=Smw, Tnlm=Tmw, m=1, r_s=rs_mw)
 
-    if quantity == "density":
-        q_all = potential_lmc.density(np.ascontiguousarray(xyz_lmc)) \
-                + potential_mw.density(np.ascontiguousarray(xyz))
+def scf_density_grid_fast(
+        x, y, z, Smw, Tmw, Slmc, Tlmc, nbins, rs_mw, rs_lmc,
+        lmc_com, quantity, G=1, rcut_lmc=np.inf, pool=None):
+    """
+    Density, potential or acceleration magnitude of the MW expansion
+    (centred at 0.1, 0.1, 0.1) plus the LMC expansion (centred at lmc_com)
+    at the points x, y, z. Both are evaluated in the same blocked pass with
+    bfe.coefficients.fields.CompositeField, the LMC adds nothing beyond
+    rcut_lmc from its centre.
 
+    """
+    xyz = np.array([x, y, z]).T
+    field = CompositeField(xyz, G=G, potential=(quantity == "potential"),
+                           acceleration=(quantity == "acceleration"),
+                           density=(quantity == "density"))
+    field.add_component(Smw, Tmw, rs_mw, center=[0.1, 0.1, 0.1])
+    field.add_component(Slmc, Tlmc, rs_lmc, center=lmc_com, rcut=rcut_lmc)
+    if pool is None:
+        pool = schwimmbad.SerialPool()
+    pot, acc, rho = field.main(pool)
 
+    if quantity == "density":
+        q_all = rho
     elif quantity == "potential":
-        q_all = potential_lmc.energy(np.ascontiguousarray(xyz_lmc)) \
-                + potential_mw.energy(np.ascontiguousarray(xyz))
-
+        q_all = pot
     elif quantity == "acceleration":
-        print('Hey acceleration')
-        #almc = biff.gradient(np.ascontiguousarray(xyz_lmc), Slmc, Tlmc, M=1, r_s=rs_lmc, G=G)
-        almc = potential_lmc.gradient(np.ascontiguousarray(xyz_lmc))
-        print(np.shape(almc))
-        amw = potential_mw.gradient(np.ascontiguousarray(xyz))
-        q_all = np.sqrt(np.sum((almc+amw)**2, axis=0))
+        q_all = np.sqrt(np.sum(acc**2, axis=1))
 
-    return q_all.value
+    return q_all
 
 
 ## Compute densities general
@@ -312,14 +371,8 @@ if __name__ == "__main__":
         #print(print(datetime.datetime.now().time()))
         Slmc = np.zeros_like(Smw)
         Tlmc = np.zeros_like(Tmw)
-        dens_all = scf_density_grid(x, y, z, Smw, Tmw, Slmc, Tlmc, nbins, rs_mw, rs_lmc, lmc_com, quantity, G)
-        Smw_base = np.zeros_like(Smw)
-        Tmw_base = np.zeros_like(Tmw)
-
-        Smw_base[0,0,0] = Smw[0,0,0]
-        Tmw_base[0,0,0] = Tmw[0,0,0]
-
-        dens_base = scf_density_grid(x, y, z, Smw_base, Tmw_base, Slmc, Tlmc, nbins, rs_mw, rs_lmc, lmc_com, quantity, G)
+        # full density and monopole (S_000) in the same pass
+        dens_all, dens_base, dens_ratio = scf_contrast_grid(pos, Smw, Tmw, nbins, rs_mw)
         #print(datetime.datetime.now().time())
         #dens_all_fast = scf_density_grid_fast(x, y, z, Smw, Tmw, Slmc, Tlmc, int(nbins**(1/3.))+1, rs_mw, rs_lmc, lmc_com, quantity, G)
         #pot_all_fast = scf_density_grid_fast(x, y, z, Smwlmc, Tmwlmc, Slmc, Tlmc, int(nbins**(1/3.))+1, rs_sphere, rs_lmc, lmc_com, 'potential', G)
@@ -331,4 +384,4 @@ if __name__ == "__main__":
         #ensity_fname = "a_mwlmc3_bfe_{}_r_{}_110.txt".format(nbins, i)
         #rite_density(density_fname, a_all_fast, x, y, z)
         density_fname = "test_600_rho_mwlmc5_1_monopole_bfe_{}_r_{:0>3d}.txt".format(nbins, i)
-        write_density(density_fname, (dens_all/dens_base)-1, x.flatten(), y.flatten(), z.flatten())
+        write_density(density_fname, dens_ratio-1, x.flatten(), y.flatten(), z.flatten())
@@ -2,6 +2,7 @@ from .coefficients_smoothing import reshape_matrix
 from .coefficients_smoothing import smooth_coeff_matrix 
 from .coefficients_smoothing import read_coeffcov_matrix 
 from .parallel_coefficients import Coeff_parallel # change this to PBFEcoeff
+from .fused_coefficients import STnlm_fused
 from .parallel_potential import PBFEpot
 from .coefficients_energy import Coeff_properties
 from .fields import BFEpot
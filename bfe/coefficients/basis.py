@@ -0,0 +1,270 @@
+"""
+Recurrence relations for the Hernquist-Ostriker basis functions
+(Lowing et al+11, MNRAS 416, 2697-2711).
+
+Instead of calling a special function for every (n,l,m) term these
+routines build all the terms of an expansion for a set of points at once:
+
+    - Gegenbauer polynomials C_n^(2l+3/2)(xi) through the recurrence in n.
+    - Normalized associated Legendre functions through the recurrence in l
+      and m.
+    - cos(m*phi) and sin(m*phi) through the Chebyshev recurrence in m.
+
+The normalization follows gala, i.e.:
+
+    Phi_nlm = -s^l (1+s)^(-2l-1) C_n^(2l+3/2)(xi) sqrt(4pi) Y_lm(X)
+
+"""
+
+import numpy as np
+from scipy import special
+
+
+def nlm_list(nmax, lmax):
+    """
+    Returns the (n,l,m) triples of an expansion in the order used to
+    store the coefficients in 1d arrays.
+
+    """
+    nlm = []
+    for n in range(nmax+1):
+        for l in range(lmax+1):
+            for m in range(l+1):
+                nlm.append((n,l,m))
+    return nlm
+
+
+def spherical_coordinates(pos, r_s):
+    """
+    Computes the coordinates used by the basis functions.
+
+    Parameters:
+    -----------
+    pos : numpy.ndarray with shape (N, 3)
+        Cartesian coordinates
+    r_s : float
+        Hernquist halo scale length
+
+    Returns:
+    --------
+    s : numpy.ndarray
+        r/r_s
+    phi : numpy.ndarray
+        azimuthal angle
+    X : numpy.ndarray
+        cos(theta), 1 at the origin.
+
+    """
+    r = np.sqrt(np.sum(np.ascontiguousarray(pos)**2, axis=-1))
+    s = np.ascontiguousarray(r / r_s).astype("float64")
+    phi = np.arctan2(pos[:,1], pos[:,0]).astype("float64")
+    X = np.divide(pos[:,2], r, out=np.ones(len(r)), where=r > 0).astype("float64")
+    return s, phi, X
+
+
+def Knl(nmax, lmax):
+    """
+    Knl = n(n+4l+3)/2 + (l+1)(2l+1) for all n and l with shape
+    (nmax+1, lmax+1).
+
+    """
+    n = np.arange(nmax+1)[:,None]
+    l = np.arange(lmax+1)[None,:]
+    return 0.5*n*(n+4*l+3) + (l+1)*(2*l+1)
+
+
+def Anl_tilde(nmax, lmax):
+    """
+    Normalization of the coefficients Anl_tilde for all n and l
+    (Eq. 16 in Lowing+11). Computed in log space to avoid overflows of
+    the factorials and gamma functions at large n and l.
+
+    Returns:
+    --------
+    Anl : numpy.ndarray with shape (nmax+1, lmax+1)
+
+    """
+    n = np.arange(nmax+1)[:,None]
+    l = np.arange(lmax+1)[None,:]
+    log_Anl = (8*l+6)*np.log(2.) + special.gammaln(n+1) + np.log(n+2*l+1.5) \
+              + 2*special.gammaln(2*l+1.5) - special.gammaln(n+4*l+3)
+    return -np.exp(log_Anl) / (4*np.pi*Knl(nmax, lmax))
+
+
+def gegenbauer_table(nmax, lmax, xi, dalpha=0, nmax_l=None):
+    """
+    Gegenbauer polynomials C_n^(2l+3/2+dalpha)(xi) for all n <= nmax and
+    l <= lmax using the recurrence:
+
+        n C_n = 2 xi (n+alpha-1) C_{n-1} - (n+2alpha-2) C_{n-2}
+
+    If nmax_l (array with lmax+1 values) is given the recurrence of each l
+    stops at n = nmax_l[l] and the higher terms are set to zero.
+
+    Returns:
+    --------
+    C : numpy.ndarray with shape (nmax+1, lmax+1, len(xi))
+
+    """
+    alpha = (2*np.arange(lmax+1) + 1.5 + dalpha)[:,None]
+    if nmax_l is None:
+        C = np.empty((nmax+1, lmax+1, len(xi)))
+    else:
+        C = np.zeros((nmax+1, lmax+1, len(xi)))
+    C[0] = 1.0
+    if nmax > 0:
+        C[1] = 2*alpha*xi
+    for n in range(2, nmax+1):
+        if nmax_l is None:
+            C[n] = (2*xi*(n+alpha-1)*C[n-1] - (n+2*alpha-2)*C[n-2]) / n
+        else:
+            l = np.where(np.asarray(nmax_l) >= n)[0]
+            C[n,l] = (2*xi*(n+alpha[l]-1)*C[n-1,l] - (n+2*alpha[l]-2)*C[n-2,l]) / n
+    return C
+
+
+def radial_table(nmax, lmax, s, nmax_l=None):
+    """
+    Radial part of the potential basis functions for all n and l:
+
+        Phi_nl(s) = -s^l (1+s)^(-2l-1) C_n^(2l+3/2)((s-1)/(s+1))
+
+    The powers of s are built with a recurrence in l. nmax_l truncates the
+    recurrence in n of each l (see gegenbauer_table).
+
+    Returns:
+    --------
+    phi_nl : numpy.ndarray with shape (nmax+1, lmax+1, len(s))
+
+    """
+    xi = (s-1) / (s+1)
+    power = np.empty((lmax+1, len(s)))
+    power[0] = -1 / (1+s)
+    q = s / (1+s)**2
+    for l in range(1, lmax+1):
+        power[l] = power[l-1]*q
+    return gegenbauer_table(nmax, lmax, xi, nmax_l=nmax_l) * power
+
+
+def radial_derivative_table(nmax, lmax, s, nmax_l=None):
+    """
+    Radial functions Phi_nl(s) (see radial_table) and their derivatives
+    with respect to s, using dC_n^alpha/dxi = 2 alpha C_{n-1}^(alpha+1)
+    and dxi/ds = 2/(1+s)^2:
+
+        dPhi_nl/ds = (l/s - (2l+1)/(1+s)) Phi_nl
+                     - s^l (1+s)^(-2l-1) 2/(1+s)^2 dC_n/dxi
+
+    nmax_l truncates the recurrence in n of each l (see gegenbauer_table).
+
+    Returns:
+    --------
+    phi_nl, dphi_nl : numpy.ndarray with shape (nmax+1, lmax+1, len(s))
+
+    """
+    xi = (s-1) / (s+1)
+    l = np.arange(lmax+1)[:,None]
+    power = np.empty((lmax+1, len(s)))
+    power[0] = -1 / (1+s)
+    q = s / (1+s)**2
+    for i in range(1, lmax+1):
+        power[i] = power[i-1]*q
+    C = gegenbauer_table(nmax, lmax, xi, nmax_l=nmax_l)
+    dC = np.zeros_like(C)
+    if nmax > 0:
+        alpha = (2*l + 1.5)
+        dC[1:] = 2*alpha*gegenbauer_table(
+                nmax-1, lmax, xi, dalpha=1,
+                nmax_l=None if nmax_l is None else np.asarray(nmax_l)-1)
+    phi_nl = C*power
+    # l/s Phi_nl written as l s^(l-1) to avoid 0/0 at s=0
+    l_over_s = np.zeros((lmax+1, len(s)))
+    l_over_s[1:] = l[1:] / s
+    dphi_nl = (l_over_s - (2*l+1)/(1+s))*phi_nl + power*2/(1+s)**2*dC
+    return phi_nl, dphi_nl
+
+
+def legendre_table(lmax, X, lmax_m=None):
+    """
+    Normalized associated Legendre functions for all l, m <= lmax:
+
+        P_lm(X) = sqrt((2l+1) (l-m)!/(l+m)!) P_l^m(X)
+
+    including the Condon-Shortley phase, this is sqrt(4pi) Y_lm(theta, 0).
+    Terms with m > l are set to zero.
+
+    If lmax_m (array with lmax+1 values) is given the recurrence in l of
+    each m stops at l = lmax_m[m], m values above the last one with
+    lmax_m[m] >= m are skipped and the missing terms are set to zero.
+
+    Returns:
+    --------
+    P : numpy.ndarray with shape (lmax+1, lmax+1, len(X))
+
+    """
+    P = np.zeros((lmax+1, lmax+1, len(X)))
+    sintheta = np.sqrt(np.clip(1 - X*X, 0, None))
+    P[0,0] = 1.0
+    mmax = lmax
+    if lmax_m is None:
+        lmax_m = np.full(lmax+1, lmax)
+    else:
+        mmax = max([m for m in range(lmax+1) if lmax_m[m] >= m], default=0)
+    for m in range(0, mmax+1):
+        if m > 0:
+            P[m,m] = -np.sqrt((2*m+1)/(2.*m)) * sintheta * P[m-1,m-1]
+        if m < lmax_m[m]:
+            P[m+1,m] = np.sqrt(2*m+3) * X * P[m,m]
+        for l in range(m+2, lmax_m[m]+1):
+            a = np.sqrt((2*l+1)*(2*l-1) / ((l-m)*(l+m)))
+            b = np.sqrt((2*l+1)*(l-m-1)*(l+m-1) / ((2*l-3)*(l-m)*(l+m)))
+            P[l,m] = a*X*P[l-1,m] - b*P[l-2,m]
+    return P
+
+
+def legendre_derivative_table(lmax, X, P):
+    """
+    Derivatives with respect to theta of the normalized associated Legendre
+    functions P computed with legendre_table:
+
+        dP_lm/dtheta = (l X P_lm - sqrt((2l+1)/(2l-1) (l^2-m^2)) P_{l-1,m}) / sin(theta)
+
+    sin(theta) is kept above 1e-300 so that X = +-1 gives 0 instead of
+    NaN, the m=1 limits on the z axis need X moved away from +-1 (see
+    fields.evaluate_acceleration).
+
+    Returns:
+    --------
+    dP : numpy.ndarray with shape (lmax+1, lmax+1, len(X))
+
+    """
+    dP = np.zeros_like(P)
+    sintheta = np.maximum(np.sqrt(np.clip(1 - X*X, 0, None)), 1e-300)
+    m = np.arange(lmax+1)[:,None]
+    for l in range(1, lmax+1):
+        # the terms with m >= l have P_{l-1,m} = 0
+        c = np.sqrt(np.clip((2*l+1)/(2*l-1)*(l*l - m**2), 0, None))
+        dP[l] = (l*X*P[l] - c*P[l-1]) / sintheta
+    return dP
+
+
+def azimuthal_table(mmax, phi):
+    """
+    cos(m*phi) and sin(m*phi) for m <= mmax using the Chebyshev recurrence.
+
+    Returns:
+    --------
+    cos_mphi, sin_mphi : numpy.ndarray with shape (mmax+1, len(phi))
+
+    """
+    cos_mphi = np.empty((mmax+1, len(phi)))
+    sin_mphi = np.empty((mmax+1, len(phi)))
+    cos_mphi[0] = 1.0
+    sin_mphi[0] = 0.0
+    if mmax > 0:
+        cos_mphi[1] = np.cos(phi)
+        sin_mphi[1] = np.sin(phi)
+    for m in range(2, mmax+1):
+        cos_mphi[m] = 2*cos_mphi[1]*cos_mphi[m-1] - cos_mphi[m-2]
+        sin_mphi[m] = 2*cos_mphi[1]*sin_mphi[m-1] - sin_mphi[m-2]
+    return cos_mphi, sin_mphi
@@ -0,0 +1,165 @@
+"""
+Basis functions of a fixed set of particles stored as matrices.
+
+The coefficients are linear in the particles and the potential is linear in
+the coefficients, so once the basis functions of every particle are stored,
+
+    S_j = factor_j sum_k m_k Phi_c[k, j]
+    Phi(x_k) = G M / r_s sum_j (Phi_c[k, j] S_j + Phi_s[k, j] T_j)
+
+with Phi_c = Phi_nlm cos(m phi) and Phi_s = Phi_nlm sin(m phi), are
+matrix-vector products and the coefficients of any subset of the particles
+can be obtained without evaluating the basis functions again. The
+potential (and density) of many coefficient sets at the same points is a
+single matrix-matrix product.
+
+"""
+
+import numpy as np
+from bfe.coefficients import basis
+from bfe.coefficients import fused_coefficients
+
+
+def basis_rows(task):
+    """
+    Rows (phi_c, phi_s and optionally rho_c, rho_s) of the particles
+    task=(s, phi, X, nmax, lmax, density) with shape (2 or 4, len(s),
+    ncoeff), see BasisMatrix.
+    """
+    s, phi, X, nmax, lmax, density = task
+    n, l, m = np.array(basis.nlm_list(nmax, lmax)).T
+    R = basis.radial_table(nmax, lmax, s)
+    P = basis.legendre_table(lmax, X)
+    cos_mphi, sin_mphi = basis.azimuthal_table(lmax, phi)
+    phi_nlm = R[n, l] * P[l, m]
+    rows = [(phi_nlm * cos_mphi[m]).T, (phi_nlm * sin_mphi[m]).T]
+    if density == True:
+        # rho_nl = -Knl/(2 pi s (1+s)^2) Phi_nl
+        rho_nlm = -basis.Knl(nmax, lmax)[n, l][:,None]/(2*np.pi*s*(1+s)**2) * phi_nlm
+        rows += [(rho_nlm * cos_mphi[m]).T, (rho_nlm * sin_mphi[m]).T]
+    return np.array(rows)
+
+
+class BasisMatrix:
+    def __init__(self, pos, rs, nmax, lmax, chunk_size=10000, density=False,
+                 filename=None, pool=None):
+        """
+        Parameters:
+        -----------
+        pos : numpy.ndarray with shape (N, 3)
+        rs : float
+            Hernquist halo scale length
+        nmax : int
+        lmax : int
+        chunk_size : int
+            Number of particles evaluated at once.
+        density : bool
+            If True also stores the density basis functions rho_c and rho_s.
+        filename : str
+            If given the matrices are stored in a memory-mapped .npy file
+            with shape (2 or 4, N, ncoeff) instead of in memory.
+        pool : schwimmbad pool
+            If given the chunks of particles are evaluated in parallel, the
+            pool is closed afterwards.
+
+        Attributes:
+        -----------
+        phi_c, phi_s : numpy.ndarray with shape (N, ncoeff)
+            Phi_nlm cos(m phi) and Phi_nlm sin(m phi) of every particle with
+            the columns ordered as in basis.nlm_list. Memory is
+            2*N*ncoeff*8 bytes.
+        rho_c, rho_s : numpy.ndarray with shape (N, ncoeff)
+            rho_nlm cos(m phi) and rho_nlm sin(m phi), only if density=True.
+        factor : numpy.ndarray with shape (ncoeff)
+            (2 - delta_m0) Anl_tilde
+
+        """
+        self.rs = rs
+        self.nmax = nmax
+        self.lmax = lmax
+        self.chunk_size = chunk_size
+        self.n, self.l, self.m = np.array(basis.nlm_list(nmax, lmax)).T
+        self.ncoeff = len(self.n)
+        self.factor = fused_coefficients.coeff_factor(nmax, lmax)[self.n, self.l, self.m]
+
+        s, phi, X = basis.spherical_coordinates(pos, rs)
+        self.npart = len(s)
+        shape = (4 if density == True else 2, self.npart, self.ncoeff)
+        if filename is None:
+            self.matrices = np.empty(shape)
+        else:
+            self.matrices = np.lib.format.open_memmap(filename, mode='w+',
+                                                      dtype=np.float64, shape=shape)
+        self.phi_c, self.phi_s = self.matrices[0], self.matrices[1]
+        if density == True:
+            self.rho_c, self.rho_s = self.matrices[2], self.matrices[3]
+        starts = range(0, self.npart, chunk_size)
+        tasks = ((s[i:i+chunk_size], phi[i:i+chunk_size], X[i:i+chunk_size],
+                  nmax, lmax, density) for i in starts)
+        if pool is None:
+            rows = map(basis_rows, tasks)
+        else:
+            # imap writes every chunk as it arrives instead of holding all
+            # of them
+            rows = getattr(pool, 'imap', pool.map)(basis_rows, tasks)
+        for i, chunk in zip(starts, rows):
+            self.matrices[:, i:i+chunk_size] = chunk
+        if pool is not None:
+            pool.close()
+
+    def coefficients(self, mass, index=None):
+        """
+        S and T (in the order of basis.nlm_list) of the particles in index,
+        all the particles by default.
+        """
+        if index is None:
+            index = slice(None)
+        S = self.factor * (mass @ self.phi_c[index])
+        T = self.factor * (mass @ self.phi_s[index])
+        return S, T
+
+    def coeff_vectors(self, matrices):
+        """
+        Coefficients with shape (nmax+1, lmax+1, lmax+1) or a set of them
+        with shape (nsets, nmax+1, lmax+1, lmax+1) in the order of
+        basis.nlm_list, with shape (ncoeff) or (ncoeff, nsets).
+        """
+        return np.asarray(matrices)[..., self.n, self.l, self.m].T
+
+    def _product(self, A, B, S, T, index=None):
+        # blocks of rows so that memory-mapped matrices are read in pieces,
+        # only the rows in index are multiplied
+        S = np.asarray(S)
+        T = np.asarray(T)
+        if index is None:
+            index = np.arange(self.npart)
+        elif isinstance(index, slice):
+            index = np.arange(self.npart)[index]
+        else:
+            index = np.asarray(index)
+            if index.dtype == bool:
+                index = np.where(index)[0]
+        out = np.empty((len(index),) + S.shape[1:])
+        for i in range(0, len(index), self.chunk_size):
+            k = index[i:i+self.chunk_size]
+            out[i:i+self.chunk_size] = A[k] @ S + B[k] @ T
+        return out
+
+    def potential(self, S, T, index=None, G=1, M=1):
+        """
+        Potential of the particles in index, all the particles by default.
+        Only the rows of the particles in index are multiplied, in blocks
+        of chunk_size rows.
+
+        S and T are in the order of basis.nlm_list with shape (ncoeff) or
+        (ncoeff, nsets) for nsets coefficient sets (see coeff_vectors), the
+        potential has shape (N) or (N, nsets).
+        """
+        return G*M/self.rs * self._product(self.phi_c, self.phi_s, S, T, index)
+
+    def density(self, S, T, index=None, M=1):
+        """
+        Density of the particles in index for one or nsets coefficient
+        sets, see potential. Needs density=True.
+        """
+        return M/self.rs**3 * self._product(self.rho_c, self.rho_s, S, T, index)
@@ -12,6 +12,89 @@ import sys
 from scipy import special
 import math
 import time
+from bfe.coefficients import basis
+from bfe.coefficients import fused_coefficients
+from bfe.coefficients.sparse_coefficients import SparseCoefficients
+
+
+def cartesian_acceleration(s, theta, phi, dpot_ds, dpot_dtheta, dpot_dphi):
+    """
+    Cartesian acceleration -grad(Phi) in units of G M/rs^2 from the
+    derivatives of the potential sum with respect to s, theta and phi (see
+    sparse_coefficients.SparseCoefficients.evaluate).
+
+    Returns:
+    --------
+    acc : numpy.ndarray with shape (len(s), 3)
+
+    """
+    X = np.cos(theta)
+    sintheta = np.sin(theta)
+    a_r = -dpot_ds
+    a_theta = -dpot_dtheta/s
+    a_phi = -dpot_dphi/(s*sintheta)
+    cosphi = np.cos(phi)
+    sinphi = np.sin(phi)
+    acc = np.empty((len(s), 3))
+    acc[:,0] = sintheta*cosphi*a_r + X*cosphi*a_theta - sinphi*a_phi
+    acc[:,1] = sintheta*sinphi*a_r + X*sinphi*a_theta + cosphi*a_phi
+    acc[:,2] = X*a_r - sintheta*a_theta
+    return acc
+
+
+# Points closer to the z axis than 1 - |cos(theta)| = POLE_GAP are evaluated
+# at |cos(theta)| = 1 - POLE_GAP, and the acceleration at the origin is
+# computed from two opposite points at s = ORIGIN_S, see
+# evaluate_acceleration.
+POLE_GAP = 1e-10
+ORIGIN_S = 1e-8
+
+
+def evaluate_acceleration(sparse, s, X, phi, density=False, radial=None):
+    """
+    Potential, density and Cartesian acceleration (in units of G M/rs^2) of
+    the terms of sparse (a SparseCoefficients) at (s, X=cos(theta), phi).
+
+    The derivatives with respect to theta and phi are divided by sin(theta)
+    and s. On the z axis X is moved by POLE_GAP, which gives the limit of
+    the acceleration to O(sqrt(POLE_GAP)). At the origin the l=0 term has a
+    cusp and no limit, the acceleration is the mean of two opposite points
+    at s=ORIGIN_S: the monopole cancels and the l=1 terms give the gradient.
+
+    Returns:
+    --------
+    pot, rho : numpy.ndarray
+        rho is None if density=False.
+    acc : numpy.ndarray with shape (len(s), 3)
+
+    """
+    s = np.asarray(s, dtype=np.float64)
+    origin = s == 0
+    X = np.clip(np.where(origin, 1.0, X), -1 + POLE_GAP, 1 - POLE_GAP)
+    pot = np.empty(len(s))
+    rho = np.empty(len(s)) if density == True else None
+    acc = np.empty((len(s), 3))
+    regular = ~origin
+    pot[regular], rho_regular, dpot_ds, dpot_dtheta, dpot_dphi = sparse.evaluate(
+            s[regular], X[regular], phi[regular], density=density, gradient=True,
+            radial=radial)
+    if density == True:
+        rho[regular] = rho_regular
+    acc[regular] = cartesian_acceleration(s[regular], np.arccos(X[regular]),
+                                          phi[regular], dpot_ds, dpot_dtheta, dpot_dphi)
+    if np.any(origin):
+        pot[origin], rho_origin = sparse.evaluate(s[origin], X[origin], phi[origin],
+                                                  density=density, radial=radial)[:2]
+        if density == True:
+            rho[origin] = rho_origin
+        s0 = np.full(2, ORIGIN_S)
+        X0 = np.array([1 - POLE_GAP, -1 + POLE_GAP])
+        phi0 = np.array([0, np.pi])
+        d_s, d_theta, d_phi = sparse.evaluate(s0, X0, phi0, gradient=True, radial=radial)[2:]
+        acc[origin] = np.mean(cartesian_acceleration(s0, np.arccos(X0), phi0,
+                                                     d_s, d_theta, d_phi), axis=0)
+    return pot, rho, acc
+
 
 class BFEpot:
     def __init__(self, pos, S, T, rs, nmax, lmax, G, M):
@@ -20,16 +103,18 @@ class BFEpot:
         Attributes:
             nlm_list     Creates arrays of indices n, l, m from 3d to 1d.
             bfe_pot      Core function that computed the BFE potential.
-            potential    Computes the potential bfe_pot by receiving a task
-                         with the arguments that are going to run in parallel.
-            main         Runs potential in parallel using a pool to be defined
-                         by the user.
+            potential_nlm  Computes the potential of a single (n,l,m) term.
+            evaluate     Computes the potential, acceleration and density
+                         of a block of points with all the terms.
+            acceleration Computes the acceleration of all the points.
+            main         Runs evaluate in parallel over blocks of points
+                         using a pool to be defined by the user.
 
         Parameters:
         -----------
         pos : numpy.ndarray with shape
-        S : numpy.ndarray
-        T : numpy.ndarray
+        S : numpy.ndarray with shape (nmax+1, lmax+1, lmax+1)
+        T : numpy.ndarray with shape (nmax+1, lmax+1, lmax+1)
         rs : float
             Hernquist halo scale length
         nmax : int
@@ -49,7 +134,8 @@ class BFEpot:
         self.nmax = nmax
         self.lmax = lmax
         self.r = (self.pos[:,0]**2 + self.pos[:,1]**2 + self.pos[:,2]**2)**0.5
-        self.theta = np.arccos(self.pos[:,2]/self.r) # cos(theta)
+        self.theta = np.arccos(np.divide(self.pos[:,2], self.r, out=np.ones(len(self.r)),
+                                         where=self.r > 0))
 
         self.phi = np.arctan2(self.pos[:,1], self.pos[:,0])
         self.s = self.r/self.rs
@@ -57,6 +143,7 @@ class BFEpot:
         self.M = M
         self.S = S
         self.T = T
+        self.sparse = SparseCoefficients(S, T)
         self.nparticles = len(self.s)
 
     def nlm_list(self, ncoeff, nmax, lmax):
@@ -106,35 +193,157 @@ class BFEpot:
     def density_nlm(self, n, l, m):
         rho = self.bfe_rho(n, l, m, self.s, self.theta)\
                 * (self.S[n,l,m]*np.cos(m*self.phi)+self.T[n,l,m]*np.sin(m*self.phi))
-        return rho*self.M/self.rs
+        return rho*self.M/self.rs**3
+
+    def evaluate(self, task):
+        """
+        Potential, acceleration and density of the points in the slice
+        task=(start, stop) from one evaluation of the basis functions.
+
+        The gradient of the potential (Eqs. 17-19 in Lowing+11) is
+
+            dPhi/dr = G M/rs^2 sum dPhi_nl/ds P_lm (S cos(m phi) + T sin(m phi))
+            dPhi/dtheta / r = G M/rs^2 / s sum Phi_nl dP_lm/dtheta (S cos(m phi) + T sin(m phi))
+            dPhi/dphi / (r sin(theta)) = G M/rs^2 / (s sin(theta)) sum Phi_nl P_lm m (T cos(m phi) - S sin(m phi))
+
+        with the derivatives computed with basis.radial_derivative_table and
+        basis.legendre_derivative_table. Only the terms with non-zero
+        coefficients are evaluated (see sparse_coefficients).
+
+        Returns:
+        --------
+        pot : numpy.ndarray
+        acc : numpy.ndarray with shape (len(pot), 3)
+            Cartesian acceleration -grad(Phi)
+        rho : numpy.ndarray
+
+        """
+        k = slice(*task)
+        pot, rho, acc = evaluate_acceleration(self.sparse, self.s[k], np.cos(self.theta[k]),
+                                              self.phi[k], density=True)
+        return pot*self.G*self.M/self.rs, acc*self.G*self.M/self.rs**2, \
+               rho*self.M/self.rs**3
+
+    def acceleration(self):
+        """
+        Cartesian acceleration of all the points.
+        """
+        return self.evaluate((0, self.nparticles))[1]
+
+    def main(self, pool, block_size=10000):
+        """
+        Potential, acceleration and density of all the points computed in
+        parallel over blocks of block_size points.
+        """
+        tasks = fused_coefficients.particle_chunks(
+                self.nparticles, int(np.ceil(self.nparticles/block_size)))
+        results = list(pool.map(self.evaluate, tasks))
+        pool.close()
+        pot = np.concatenate([block[0] for block in results]) if results else np.zeros(0)
+        acc = np.concatenate([block[1] for block in results]) if results else np.zeros((0, 3))
+        rho = np.concatenate([block[2] for block in results]) if results else np.zeros(0)
+        return pot, acc, rho
+
+
+class CompositeField:
+    def __init__(self, pos, G=1, potential=True, acceleration=False,
+                 density=False):
+        """
+        Summed potential, acceleration and density of several expansions
+        (e.g. the MW and the LMC), each one with its own centre, scale
+        length, coefficients and truncation radius.
+
+        The points are stored once, each block of points is shifted to the
+        centre of every component on the fly, so no shifted copies of the
+        full set of points are made.
+
+        Parameters:
+        -----------
+        pos : numpy.ndarray with shape (N, 3)
+        G : float
+            Value of the gravitational constant
+        potential, acceleration, density : bool
+            Quantities returned by evaluate and main.
+
+        """
+        self.pos = pos
+        self.G = G
+        self.compute = (potential, acceleration, density)
+        self.components = []
+        self.nparticles = len(pos)
 
-    def d_phi(self, n, l, m):
+    def add_component(self, S, T, rs, M=1, center=[0,0,0], rcut=np.inf):
         """
-        TODO: Add all the .self
+        Adds an expansion.
+
+        Parameters:
+        -----------
+        S, T : numpy.ndarray with shape (nmax+1, lmax+1, lmax+1)
+        rs : float
+            Hernquist halo scale length
+        M : float
+        center : list
+            position of the centre of the expansion.
+        rcut : float
+            points with r >= rcut from the centre are skipped, the
+            component adds nothing to them.
+
+        """
+        self.components.append({'sparse':SparseCoefficients(S, T), 'rs':rs,
+                                'M':M, 'center':np.asarray(center, dtype=np.float64),
+                                'rcut':rcut})
+        return self
+
+    def evaluate(self, task):
         """
-        factor = np.sqrt(4*np.pi)
-        A_factor = (-l-3*l*self.s-self.s)
-        A = self.s**(l-1)/(1+self.s)**(2*l+2) * special.eval_gegenbauer(n, 2*l+1.5, ((self.s-1)/(self.s+1)))
-        B_factor = -4*(2*l+3/2.)
-        B = self.s**l/(1+self.s)**(2*l+3) * special.eval_gegenbauer(n-1, 2*l+2.5, ((self.s-1)/(self.s+1)))
-        d_phi_dr = factor * ( A_factor*A + B_factor*B) * special.lpmv(m, l, np.cos(self.theta))
-        d_phi_dtheta = m*np.cot(self.theta)*np.sqrt()
+        Potential, acceleration and density of the points in the slice
+        task=(start, stop).
 
-    def acceleration(self, n, l, m, s, theta):
-        # Computes bfe accelerations Eqn: 17-19 in Lowing+11
+        Returns:
+        --------
+        pot, acc, rho : numpy.ndarray
+            acc has shape (N, 3), the quantities that are not computed are
+            None.
 
-        special.lpmv(m, l, np.cos(theta))
-        return 0
+        """
+        potential, acceleration, density = self.compute
+        pos = self.pos[slice(*task)]
+        npoints = len(pos)
+        pot = np.zeros(npoints) if potential == True else None
+        acc = np.zeros((npoints, 3)) if acceleration == True else None
+        rho = np.zeros(npoints) if density == True else None
+        for comp in self.components:
+            rs = comp['rs']
+            s, phi, X = basis.spherical_coordinates(pos - comp['center'], rs)
+            inside = np.where(s*rs < comp['rcut'])[0]
+            s, phi, X = s[inside], phi[inside], X[inside]
+            if acceleration == True:
+                c_pot, c_rho, c_acc = evaluate_acceleration(comp['sparse'], s, X, phi, density)
+                acc[inside] += c_acc*self.G*comp['M']/rs**2
+            else:
+                c_pot, c_rho = comp['sparse'].evaluate(s, X, phi, density=density)[:2]
+            if potential == True:
+                pot[inside] += c_pot*self.G*comp['M']/rs
+            if density == True:
+                rho[inside] += c_rho*comp['M']/rs**3
+        return pot, acc, rho
 
-    def main(self, pool):
-        nlist, llist, mlist = self.nlm_list(len(self.S), self.nmax, self.lmax)
-        #rint(self.S, self.T)
-        tasks = list(zip(nlist, llist, mlist, self.S, self.T))
-        results = pool.map(self.potential, tasks)
-        #for i in range(len(nlist)):
-        #    results = self.potential([nlist[i], llist[i], mlist[i], self.S[i], self.T[i]])
+    def main(self, pool, block_size=10000):
+        """
+        Summed quantities of all the points computed in parallel over
+        blocks of block_size points, see evaluate.
+        """
+        tasks = fused_coefficients.particle_chunks(
+                self.nparticles, int(np.ceil(self.nparticles/block_size)))
+        results = list(pool.map(self.evaluate, tasks))
         pool.close()
-        return np.sum(results, axis=0)
+        if not results:
+            # no points, evaluate gives the empty arrays of the quantities
+            # that are computed
+            return self.evaluate((0, 0))
+        return tuple(None if results[0][i] is None else
+                     np.concatenate([block[i] for block in results])
+                     for i in range(3))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,231 @@
+"""
+Single pass computation of all the SCF coefficients S_nlm, T_nlm.
+
+gala's STnlm_discrete computes one (n,l,m) term per call, so the particles
+are read (nmax+1)(lmax+1)(lmax+2)/2 times and every call evaluates the
+special functions from scratch. Here the particles are read once, in chunks,
+and all the basis functions of a chunk are built with the recurrences in
+bfe.coefficients.basis. The sum over particles is then a matrix product for
+each l.
+
+"""
+
+import numpy as np
+from scipy import special
+from bfe.coefficients import basis
+from bfe.coefficients.tabulated_basis import get_radial_table
+
+
+def _chunk_tables(s, phi, X, mass, nmax, lmax, radial_tol=None):
+    """
+    Basis functions of a chunk of particles weighted by their mass. If
+    radial_tol is given the radial functions are interpolated from a
+    tabulated_basis.RadialTable with that tolerance.
+
+    Returns:
+    --------
+    R : radial functions times mass with shape (nmax+1, lmax+1, K)
+    Pc, Ps : P_lm cos(m phi) and P_lm sin(m phi) with shape (lmax+1, lmax+1, K)
+
+    """
+    if radial_tol is None:
+        R = basis.radial_table(nmax, lmax, s) * mass
+    else:
+        R = get_radial_table(nmax, lmax, radial_tol).radial(s) * mass
+    P = basis.legendre_table(lmax, X)
+    cos_mphi, sin_mphi = basis.azimuthal_table(lmax, phi)
+    return R, P*cos_mphi, P*sin_mphi
+
+
+def coeff_factor(nmax, lmax):
+    """
+    (2 - delta_m0) * Anl_tilde with shape (nmax+1, lmax+1, lmax+1)
+
+    """
+    krond = np.ones(lmax+1)
+    krond[0] = 0.5
+    return 2 * krond[None,None,:] * basis.Anl_tilde(nmax, lmax)[:,:,None]
+
+
+def STnlm_fused(s, phi, X, mass, nmax, lmax, chunk_size=10000, radial_tol=None):
+    """
+    Computes all the S_nlm and T_nlm coefficients in one pass over the
+    particles.
+
+    Parameters:
+    -----------
+    s : numpy.ndarray
+        r/r_s of the particles
+    phi : numpy.ndarray
+        azimuthal angle of the particles
+    X : numpy.ndarray
+        cos(theta) of the particles
+    mass : numpy.ndarray
+        particle masses
+    nmax : int
+    lmax : int
+    chunk_size : int
+        Number of particles processed at once. Memory scales as
+        chunk_size*(nmax+1)*(lmax+1).
+    radial_tol : float
+        If given the radial functions are interpolated with this
+        tolerance (see tabulated_basis.RadialTable).
+
+    Returns:
+    --------
+    S, T : numpy.ndarray with shape (nmax+1, lmax+1, lmax+1)
+
+    """
+    S = np.zeros((nmax+1, lmax+1, lmax+1))
+    T = np.zeros((nmax+1, lmax+1, lmax+1))
+    for i in range(0, len(s), chunk_size):
+        k = slice(i, i+chunk_size)
+        R, Pc, Ps = _chunk_tables(s[k], phi[k], X[k], mass[k], nmax, lmax, radial_tol)
+        for l in range(lmax+1):
+            S[:,l,:] += R[:,l] @ Pc[l].T
+            T[:,l,:] += R[:,l] @ Ps[l].T
+    factor = coeff_factor(nmax, lmax)
+    return factor*S, factor*T
+
+
+def STnlm_var_fused(s, phi, X, mass, nmax, lmax, chunk_size=10000, radial_tol=None):
+    """
+    Computes all the coefficients and their variance terms (equivalent to
+    gala's STnlm_var_discrete) in one pass over the particles. The basis
+    functions of each chunk are evaluated once and used for both.
+
+    Returns:
+    --------
+    S, T, varS, varT, varST : numpy.ndarray with shape (nmax+1, lmax+1, lmax+1)
+
+    """
+    ST = np.zeros((5, nmax+1, lmax+1, lmax+1))
+    for i in range(0, len(s), chunk_size):
+        k = slice(i, i+chunk_size)
+        R, Pc, Ps = _chunk_tables(s[k], phi[k], X[k], mass[k], nmax, lmax, radial_tol)
+        R2 = R**2
+        for l in range(lmax+1):
+            ST[0,:,l,:] += R[:,l] @ Pc[l].T
+            ST[1,:,l,:] += R[:,l] @ Ps[l].T
+            ST[2,:,l,:] += R2[:,l] @ (Pc[l]**2).T
+            ST[3,:,l,:] += R2[:,l] @ (Ps[l]**2).T
+            ST[4,:,l,:] += R2[:,l] @ (Pc[l]*Ps[l]).T
+    factor = coeff_factor(nmax, lmax)
+    ST[:2] *= factor
+    ST[2:] *= factor**2
+    return tuple(ST)
+
+
+def STnlm_var_single(s, phi, X, mass, n, l, m):
+    """
+    S, T and the variance terms of a single (n,l,m) term. The basis function
+    of every particle is evaluated once, calling gala's STnlm_discrete and
+    STnlm_var_discrete evaluates it twice.
+
+    Returns:
+    --------
+    S, T, varS, varT, varST : float
+
+    """
+    xi = (s-1) / (s+1)
+    norm = np.sqrt((2*l+1) * np.exp(special.gammaln(l-m+1) - special.gammaln(l+m+1)))
+    phi_nlm = -s**l * (1+s)**(-2*l-1) * special.eval_gegenbauer(n, 2*l+1.5, xi) \
+              * norm * special.lpmv(m, l, X)
+    factor = coeff_factor(n, l)[n,l,m]
+    Sk = mass * phi_nlm * np.cos(m*phi)
+    Tk = mass * phi_nlm * np.sin(m*phi)
+    return factor*np.sum(Sk), factor*np.sum(Tk), factor**2*np.sum(Sk**2), \
+           factor**2*np.sum(Tk**2), factor**2*np.sum(Sk*Tk)
+
+
+def STnlm_partial(s, phi, X, mass, nmax, lmax, var=False, chunk_size=10000,
+                  radial_tol=None):
+    """
+    Coefficients (and variance terms if var=True) of a subset of particles
+    stacked in a single array. The coefficients are sums over particles, so
+    the partial arrays of disjoint subsets can be added to get the
+    coefficients of the full set.
+
+    Returns:
+    --------
+    ST : numpy.ndarray with shape (2, nmax+1, lmax+1, lmax+1) with S, T or
+         (5, nmax+1, lmax+1, lmax+1) with S, T, varS, varT, varST if var=True.
+
+    """
+    if var == True:
+        return np.array(STnlm_var_fused(s, phi, X, mass, nmax, lmax, chunk_size, radial_tol))
+    return np.array(STnlm_fused(s, phi, X, mass, nmax, lmax, chunk_size, radial_tol))
+
+
+def STnlm_batches(s, phi, X, mass, labels, nbatches, nmax, lmax, var=True,
+                  chunk_size=10000, radial_tol=None):
+    """
+    Coefficients (and variance terms if var=True) of every batch of
+    particles in one pass. The particles are sorted by label so each chunk
+    contains a few contiguous batches, the basis functions of a chunk are
+    evaluated once and summed separately for each batch.
+
+    Parameters:
+    -----------
+    s, phi, X, mass : numpy.ndarray
+        see STnlm_fused
+    labels : numpy.ndarray of int
+        batch of each particle, 0 <= labels < nbatches
+    nbatches : int
+    var : bool
+    chunk_size : int
+    radial_tol : float
+        see STnlm_fused
+
+    Returns:
+    --------
+    ST : numpy.ndarray with shape (2 or 5, nbatches, nmax+1, lmax+1, lmax+1)
+        S, T (and varS, varT, varST) of each batch. The coefficients of all
+        the particles are ST.sum(axis=1).
+
+    """
+    order = np.argsort(labels, kind='stable')
+    edges = np.searchsorted(labels[order], np.arange(nbatches+1))
+    ST = np.zeros((5 if var == True else 2, nbatches, nmax+1, lmax+1, lmax+1))
+    for i in range(0, len(s), chunk_size):
+        k = order[i:i+chunk_size]
+        R, Pc, Ps = _chunk_tables(s[k], phi[k], X[k], mass[k], nmax, lmax, radial_tol)
+        first = np.searchsorted(edges, i, side='right') - 1
+        last = np.searchsorted(edges, i+len(k), side='left')
+        for b in range(first, last):
+            j = slice(max(edges[b]-i, 0), min(edges[b+1]-i, len(k)))
+            if j.stop <= j.start:
+                continue
+            for l in range(lmax+1):
+                Rl = R[:,l,j]
+                ST[0,b,:,l,:] += Rl @ Pc[l,:,j].T
+                ST[1,b,:,l,:] += Rl @ Ps[l,:,j].T
+                if var == True:
+                    R2 = Rl**2
+                    ST[2,b,:,l,:] += R2 @ (Pc[l,:,j]**2).T
+                    ST[3,b,:,l,:] += R2 @ (Ps[l,:,j]**2).T
+                    ST[4,b,:,l,:] += R2 @ (Pc[l,:,j]*Ps[l,:,j]).T
+    factor = coeff_factor(nmax, lmax)
+    ST[:2] *= factor
+    ST[2:] *= factor**2
+    return ST
+
+
+def particle_chunks(npart, nchunks):
+    """
+    Splits npart particles into nchunks contiguous (start, stop) slices.
+
+    """
+    edges = np.linspace(0, npart, nchunks+1).astype(int)
+    return [(edges[i], edges[i+1]) for i in range(nchunks) if edges[i+1] > edges[i]]
+
+
+def coeff_results(nmax, lmax, *coeff_matrices):
+    """
+    Flattens coefficient matrices into the results format returned by
+    Coeff_parallel.main, i.e. an array with shape (ncoeff, len(coeff_matrices))
+    with the rows ordered as in basis.nlm_list.
+
+    """
+    n, l, m = np.array(basis.nlm_list(nmax, lmax)).T
+    return np.array([matrix[n, l, m] for matrix in coeff_matrices]).T
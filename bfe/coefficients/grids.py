@@ -0,0 +1,264 @@
+"""
+Evaluation of an expansion on grids of points.
+
+On a spherical grid r_i x theta_j x phi_k the basis functions are products
+of a radial, a polar and an azimuthal factor, so the tables of each factor
+are built once on their own axis and contracted:
+
+    A_lm(r) = sum_n Phi_nl(r) S_nlm,  B_lm(r) = sum_n Phi_nl(r) T_nlm
+    Bc_m(r, theta) = sum_l P_lm(theta) A_lm(r),  Bs_m = sum_l P_lm B_lm
+    f(r, theta, phi) = sum_m Bc_m cos(m phi) + Bs_m sin(m phi)
+
+and on a regular phi grid the last sum is an inverse real FFT.
+
+Cartesian grids are not separable, CartesianGrid evaluates them in slabs of
+planes in parallel and writes them into one (optionally memory-mapped)
+array.
+
+"""
+
+import numpy as np
+from bfe.coefficients import basis
+from bfe.coefficients import fused_coefficients
+from bfe.coefficients.fields import evaluate_acceleration
+from bfe.coefficients.sparse_coefficients import SparseCoefficients
+
+
+def azimuthal_sum(Bc, Bs, phi):
+    """
+    sum_m Bc_m cos(m phi) + Bs_m sin(m phi) for the coefficients Bc, Bs with
+    shape (mmax+1, ...). If phi is an int the sum is evaluated at the nphi=phi
+    points phi_k = 2 pi k/nphi with an inverse real FFT, with
+
+        X_0 = nphi Bc_0, X_m = nphi/2 (Bc_m - i Bs_m)
+
+    which needs mmax < nphi/2. Otherwise phi is an array of angles.
+
+    Returns:
+    --------
+    f : numpy.ndarray with shape Bc.shape[1:] + (nphi,)
+
+    """
+    mmax = len(Bc) - 1
+    if np.isscalar(phi):
+        nphi = int(phi)
+        assert 2*mmax < nphi, "the phi grid needs more than 2*mmax points"
+        X = np.zeros((nphi//2 + 1,) + Bc.shape[1:], dtype=np.complex128)
+        X[0] = nphi*Bc[0]
+        X[1:mmax+1] = 0.5*nphi*(Bc[1:] - 1j*Bs[1:])
+        return np.moveaxis(np.fft.irfft(X, n=nphi, axis=0), 0, -1)
+    cos_mphi, sin_mphi = basis.azimuthal_table(mmax, np.asarray(phi, dtype=np.float64))
+    return np.tensordot(Bc, cos_mphi, axes=(0, 0)) + np.tensordot(Bs, sin_mphi, axes=(0, 0))
+
+
+def spherical_grid_field(r, theta, phi, S, T, rs, G=1, M=1, quantity='density'):
+    """
+    Density or potential of the expansion on the spherical grid
+    r x theta x phi. Memory is (mmax+1)*len(r)*len(theta)*8 bytes for the
+    partial sums plus the output, and only the non-zero coefficients are
+    used (see sparse_coefficients).
+
+    Parameters:
+    -----------
+    r : numpy.ndarray
+        radii of the grid
+    theta : numpy.ndarray
+        polar angles of the grid
+    phi : numpy.ndarray or int
+        azimuthal angles of the grid, an int nphi is the regular grid
+        phi_k = 2 pi k/nphi evaluated with a FFT (see azimuthal_sum).
+    S, T : numpy.ndarray with shape (nmax+1, lmax+1, lmax+1)
+    rs : float
+        Hernquist halo scale length
+    G : float
+    M : float
+    quantity : str
+        'density' or 'potential'
+
+    Returns:
+    --------
+    f : numpy.ndarray with shape (len(r), len(theta), nphi)
+
+    """
+    assert quantity in ['density', 'potential'], "quantity must be density or potential"
+    sparse = SparseCoefficients(S, T)
+    s = np.asarray(r, dtype=np.float64)/rs
+    X = np.cos(np.asarray(theta, dtype=np.float64))
+    nphi = phi if np.isscalar(phi) else len(phi)
+    if sparse.nterms == 0:
+        return np.zeros((len(s), len(X), nphi))
+
+    R = basis.radial_table(sparse.nmax, sparse.lmax, s, sparse.nmax_l)
+    P = basis.legendre_table(sparse.lmax, X, sparse.lmax_m)
+    if quantity == 'density':
+        Knl = basis.Knl(sparse.nmax, sparse.lmax)
+    Bc = np.zeros((sparse.mmax+1, len(s), len(X)))
+    Bs = np.zeros((sparse.mmax+1, len(s), len(X)))
+    for l, m, Sl, Tl in sparse.groups:
+        nl = len(Sl)
+        if quantity == 'density':
+            Sl = Sl*Knl[:nl,l,None]
+            Tl = Tl*Knl[:nl,l,None]
+        A = Sl.T @ R[:nl,l]
+        B = Tl.T @ R[:nl,l]
+        Bc[m] += A[:,:,None]*P[l,m][:,None,:]
+        Bs[m] += B[:,:,None]*P[l,m][:,None,:]
+    f = azimuthal_sum(Bc, Bs, phi)
+    if quantity == 'density':
+        f *= (-1/(2*np.pi*s*(1+s)**2))[:,None,None]
+        return f*M/rs**3
+    return f*G*M/rs
+
+
+class CartesianGrid:
+    def __init__(self, x, y, z, S, T, rs, G=1, M=1, quantity='density',
+                 block_size=100000, output=None, filename=None, subset=None):
+        """
+        Density, potential or acceleration of the expansion at the points
+        (x_i, y_j, z_k) of a Cartesian grid, evaluated in slabs of x planes.
+        Every slab is a vectorized evaluation of the non-zero terms (see
+        sparse_coefficients) in blocks of block_size points.
+
+        Parameters:
+        -----------
+        x, y, z : numpy.ndarray
+            axes of the grid, any size and spacing.
+        S, T : numpy.ndarray with shape (nmax+1, lmax+1, lmax+1)
+        rs : float
+            Hernquist halo scale length
+        G : float
+        M : float
+        quantity : str
+            'density', 'potential' or 'acceleration'
+        block_size : int
+            Number of points evaluated at once, a slab has
+            max(block_size // (len(y)*len(z)), 1) planes.
+        output : numpy.ndarray
+            Preallocated array with shape (len(x), len(y), len(z)) or
+            (len(x), len(y), len(z), 3) for the acceleration.
+        filename : str
+            If given (and output is not) the grid is a memory-mapped .npy
+            file, the workers of the pool write their slabs directly into
+            it. Only for pools that share a filesystem.
+        subset : numpy.ndarray of bool with shape (nmax+1, lmax+1, lmax+1)
+            If given the density or potential of all the terms, of the
+            terms in subset (see sparse_coefficients.subset_mask) and
+            their ratio are computed from the same basis functions and
+            stored in a last axis of size 3.
+
+        Attributes:
+        -----------
+        output : numpy.ndarray
+            q[i,j,k] at (x_i, y_j, z_k), with a last axis of size 3 for
+            the acceleration or for (full, subset, full/subset) if subset
+            is given.
+
+        """
+        assert quantity in ['density', 'potential', 'acceleration'], \
+                "quantity must be density, potential or acceleration"
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.z = np.asarray(z, dtype=np.float64)
+        self.rs = rs
+        self.G = G
+        self.M = M
+        self.quantity = quantity
+        self.block_size = block_size
+        self.subset = subset
+        assert (subset is None) | (quantity != 'acceleration'), \
+                "subset is only available for the density and the potential"
+        self.sparse = SparseCoefficients(S, T)
+        shape = self.output_shape()
+        self.filename = None
+        if output is not None:
+            assert output.shape == shape, "output does not match the grid"
+            self.output = output
+        elif filename is not None:
+            self.filename = filename
+            self.output = np.lib.format.open_memmap(filename, mode='w+',
+                                                    dtype=np.float64, shape=shape)
+        else:
+            self.output = np.empty(shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the output stays in the main process or in the memory-mapped file
+        state['output'] = None
+        return state
+
+    def points(self, i0, i1):
+        """
+        Cartesian coordinates with shape (K, 3) of the planes i0 <= i < i1.
+        """
+        x, y, z = np.meshgrid(self.x[i0:i1], self.y, self.z, indexing='ij')
+        return np.array([x.flatten(), y.flatten(), z.flatten()]).T
+
+    def evaluate(self, task):
+        """
+        Values of the planes task=(i0, i1) with shape (i1-i0, len(y), len(z))
+        (and 3, see output_shape).
+        """
+        i0, i1 = task
+        pos = self.points(i0, i1)
+        s, phi, X = basis.spherical_coordinates(pos, self.rs)
+        q = np.empty((len(s),) + self.output_shape()[3:])
+        for i in range(0, len(s), self.block_size):
+            k = slice(i, i+self.block_size)
+            if self.subset is not None:
+                full, part = self.sparse.evaluate_subset(
+                        s[k], X[k], phi[k], self.subset, density=(self.quantity == 'density'))
+                if self.quantity == 'density':
+                    norm = self.M/self.rs**3
+                else:
+                    norm = self.G*self.M/self.rs
+                q[k,0] = full*norm
+                q[k,1] = part*norm
+                q[k,2] = full/part
+            elif self.quantity == 'acceleration':
+                acc = evaluate_acceleration(self.sparse, s[k], X[k], phi[k])[2]
+                q[k] = acc*self.G*self.M/self.rs**2
+            elif self.quantity == 'potential':
+                q[k] = self.sparse.evaluate(s[k], X[k], phi[k])[0]*self.G*self.M/self.rs
+            else:
+                q[k] = self.sparse.evaluate(s[k], X[k], phi[k], density=True)[1]*self.M/self.rs**3
+        return q.reshape((i1-i0,) + self.output_shape()[1:])
+
+    def output_shape(self):
+        """
+        (len(x), len(y), len(z)) and 3 for the acceleration or a subset.
+        """
+        shape = (len(self.x), len(self.y), len(self.z))
+        if (self.quantity == 'acceleration') | (self.subset is not None):
+            return shape + (3,)
+        return shape
+
+    def evaluate_memmap(self, task):
+        """
+        Writes the planes task=(i0, i1) into the memory-mapped file.
+        """
+        output = np.load(self.filename, mmap_mode='r+')
+        output[task[0]:task[1]] = self.evaluate(task)
+        output.flush()
+        return 0
+
+    def tasks(self):
+        planes = max(self.block_size // (len(self.y)*len(self.z)), 1)
+        return fused_coefficients.particle_chunks(
+                len(self.x), int(np.ceil(len(self.x)/planes)))
+
+    def main(self, pool):
+        """
+        Evaluates all the slabs in parallel and returns the output array.
+        """
+        tasks = self.tasks()
+        if self.filename is not None:
+            self.output.flush()
+            list(pool.map(self.evaluate_memmap, tasks))
+            pool.close()
+            self.output = np.load(self.filename, mmap_mode='r+')
+            return self.output
+        results = list(pool.map(self.evaluate, tasks))
+        pool.close()
+        for (i0, i1), q in zip(tasks, results):
+            self.output[i0:i1] = q
+        return self.output
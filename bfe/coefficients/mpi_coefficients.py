@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Distributed computation of the SCF coefficients with MPI.
+
+Each rank reads its own hyperslab of the PartType1 datasets of a Gadget-4
+HDF5 snapshot in chunks (see stream_coefficients), selects the host or satellite particles, re-centers and
+truncates them, and computes the partial coefficients and variances of its
+particles with the fused kernel. The partial sums are combined with a single
+MPI_Allreduce. No rank ever holds the full snapshot.
+
+Usage:
+------
+mpirun -n 4 python mpi_coefficients.py --snap snapshot_000.hdf5 --rs 40.85 \\
+        --nmax 20 --lmax 20 --out BFE_host_snap_000
+
+"""
+
+import numpy as np
+from argparse import ArgumentParser
+from bfe.coefficients import fused_coefficients
+from bfe.coefficients import stream_coefficients
+from bfe.ios.gadget_reader import iter_snap_chunks, snap_npart
+
+
+def rank_slice(npart, rank, size):
+    """
+    Contiguous (start, stop) hyperslab of the particles read by a rank.
+    """
+    edges = np.linspace(0, npart, size+1).astype(int)
+    return edges[rank], edges[rank+1]
+
+
+def mpi_id_cut(comm, ids, N_host_particles):
+    """
+    ID of the first satellite particle, this is the same cut used by
+    bfe.ios.io_snaps.host_particles (np.sort(pids)[N_host_particles]) but
+    found with a bisection on the ID values, each step only needs the
+    number of particles below the trial value.
+    """
+    from mpi4py import MPI
+    lo = comm.allreduce(int(ids.min()) if len(ids) else np.iinfo(np.int64).max, op=MPI.MIN)
+    hi = comm.allreduce(int(ids.max()) if len(ids) else np.iinfo(np.int64).min, op=MPI.MAX)
+    # smallest value v with N_host_particles+1 particles with id <= v
+    while lo < hi:
+        mid = (lo + hi) // 2
+        nbelow = comm.allreduce(int(np.count_nonzero(ids <= mid)), op=MPI.SUM)
+        if nbelow >= N_host_particles + 1:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def mpi_com(comm, snapname, start, stop, galaxy=None, id_cut=None, chunk_size=1000000,
+            shrink_factor=0.9, min_particles=1000, starting_rmax=500):
+    """
+    Shrinking sphere center of the particles of all ranks, the same
+    spheres as stream_coefficients.stream_com (and pynbody
+    shrink_sphere_center in read_snap_coordinates): the center of mass of
+    all the particles, then of the particles within starting_rmax, with
+    the radius reduced by shrink_factor until the sphere has min_particles
+    or less. Each sphere is a pass of every rank over its hyperslab
+    [start, stop) in chunks and one Allreduce.
+    """
+    from mpi4py import MPI
+    center = np.zeros(3)
+    rmax = np.inf
+    npart = np.inf
+    iteration = 0
+    while npart > min_particles:
+        local = np.zeros(5)
+        for pos, mass, ids in iter_snap_chunks(
+                snapname, 'PartType1', ['Coordinates', 'Masses', 'ParticleIDs'],
+                chunk_size, start, stop):
+            pos, mass = stream_coefficients.select_particles(pos, mass, ids, galaxy, id_cut)
+            offset = pos - center
+            inside = np.sum(offset**2, axis=1) < rmax**2
+            local[:3] += np.sum(offset[inside]*mass[inside,None], axis=0)
+            local[3] += np.sum(mass[inside])
+            local[4] += np.count_nonzero(inside)
+        comm.Allreduce(MPI.IN_PLACE, local, op=MPI.SUM)
+        npart = local[4]
+        if npart == 0:
+            return center
+        center = center + local[:3]/local[3]
+        iteration += 1
+        rmax = rmax*shrink_factor if iteration > 1 else starting_rmax
+    return center
+
+
+def mpi_coefficients(comm, snapname, rs, nmax, lmax, var=True, galaxy=None,
+                     N_host_particles=None, id_cut=None, rcom=None, rcut=0,
+                     chunk_size=1000000):
+    """
+    Computes the coefficients of the particles of a snapshot distributed
+    among the ranks of comm.
+
+    Parameters:
+    -----------
+    comm : mpi4py.MPI.Comm
+    snapname : str
+        Gadget-4 hdf5 snapshot.
+    rs : float
+        Hernquist halo scale length
+    nmax : int
+    lmax : int
+    var : bool
+        If True also computes the variance terms of the coefficients.
+    galaxy : str
+        None uses all the particles, 'host' the particles with ids < id_cut
+        and 'sat' the particles with ids >= id_cut.
+    N_host_particles : int
+        Number of host particles, used to find id_cut if it is not given.
+    id_cut : int
+        ID of the first satellite particle.
+    rcom : numpy.ndarray
+        Center of the expansion. If None it is the center of the disk for
+        the host if the snapshot has a disk (see
+        stream_coefficients.disk_com), otherwise the shrinking sphere
+        center of the selected particles (see mpi_com), the same center as
+        the other engines.
+    rcut : float
+        If > 0 only particles with r < rcut are used.
+    chunk_size : int
+        Number of particles read at once by each rank.
+
+    Returns:
+    --------
+    results : numpy.ndarray with the format of Coeff_parallel.main.
+        The same in every rank.
+    pmass : float
+        particle mass
+    rcom : numpy.ndarray
+        center of the expansion
+
+    """
+    from mpi4py import MPI
+    assert (galaxy is None) | (N_host_particles is not None) | (id_cut is not None), \
+            "galaxy {} needs N_host_particles or id_cut".format(galaxy)
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    npart = snap_npart(snapname, 'PartType1')
+    start, stop = rank_slice(npart, rank, size)
+
+    if (galaxy is not None) & (id_cut is None):
+        ids = np.concatenate([chunk[0] for chunk in iter_snap_chunks(
+                snapname, 'PartType1', ['ParticleIDs'], chunk_size, start, stop)])
+        id_cut = mpi_id_cut(comm, ids, N_host_particles)
+        del ids
+
+    if (rcom is None) & (galaxy != 'sat'):
+        rcom = stream_coefficients.disk_com(snapname, chunk_size)
+    if rcom is None:
+        rcom = mpi_com(comm, snapname, start, stop, galaxy, id_cut, chunk_size)
+
+    partial, pmass = stream_coefficients.partial_coefficients(
+            snapname, rs, nmax, lmax, var, galaxy, id_cut, rcom, rcut,
+            chunk_size, start, stop)
+    comm.Allreduce(MPI.IN_PLACE, partial, op=MPI.SUM)
+    pmass = comm.allreduce(pmass, op=MPI.MAX)
+    return fused_coefficients.coeff_results(nmax, lmax, *partial), pmass, rcom
+
+
+if __name__ == "__main__":
+    from mpi4py import MPI
+    from bfe.ios.io_snaps import write_coefficients_hdf5
+
+    parser = ArgumentParser(description="MPI computation of BFE coefficients")
+    parser.add_argument("--snap", dest="snap", type=str, help="Gadget-4 hdf5 snapshot")
+    parser.add_argument("--out", dest="out", type=str, help="output file name")
+    parser.add_argument("--rs", dest="rs", type=float, help="Hernquist scale length")
+    parser.add_argument("--nmax", dest="nmax", type=int)
+    parser.add_argument("--lmax", dest="lmax", type=int)
+    parser.add_argument("--galaxy", dest="galaxy", default=None, type=str, help="host or sat")
+    parser.add_argument("--npart-host", dest="npart_host", default=None, type=int,
+                        help="Number of host particles")
+    parser.add_argument("--rcom", dest="rcom", default=None, type=float, nargs=3)
+    parser.add_argument("--rcut", dest="rcut", default=0, type=float)
+    parser.add_argument("--no-var", dest="var", default=True, action="store_false",
+                        help="Do not compute the variance terms")
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    results, pmass, rcom = mpi_coefficients(
+            comm, args.snap, args.rs, args.nmax, args.lmax, var=args.var,
+            galaxy=args.galaxy, N_host_particles=args.npart_host,
+            rcom=args.rcom, rcut=args.rcut)
+
+    if comm.Get_rank() == 0:
+        write_coefficients_hdf5(args.out, results, [args.nmax, args.lmax, args.lmax],
+                                [args.rs, pmass, 0], rcom)
@@ -7,12 +7,72 @@ TODO:
 
 import numpy as np
 import schwimmbad 
-from gala.potential.scf._computecoeff import STnlm_discrete, STnlm_var_discrete
+from gala.potential.scf._computecoeff import STnlm_discrete
+from bfe.coefficients import basis
+from bfe.coefficients import fused_coefficients
+from bfe.coefficients.shared_arrays import SharedArrays
+from bfe.coefficients.tabulated_basis import get_radial_table
 from bfe.ios import read_snap
 from bfe.ios import write_coefficients
 
 class Coeff_parallel(object):
-    def __init__(self, pos, mass, r_s, var, nmax, lmax):
+    def __init__(self, pos, mass, r_s, var, nmax, lmax, engine='gala',
+                 chunk_size=10000, mode='nlm', ntasks=None, shared_memory=False,
+                 labels=None, radial_tol=None):
+        """
+        Computes the SCF coefficients of a set of particles.
+
+        Parameters:
+        -----------
+        pos : numpy.ndarray with shape (N, 3)
+        mass : numpy.ndarray
+        r_s : float
+            Hernquist halo scale length
+        var : bool
+            If True also computes the variance terms of the coefficients.
+        nmax : int
+        lmax : int
+        engine : str
+            'gala' computes one (n,l,m) term per task with gala's
+            STnlm_discrete. 'fused' computes all the terms in a single pass
+            over the particles using recurrence relations
+            (see bfe.coefficients.fused_coefficients), the particles are
+            always split between the workers as in mode='particles'.
+        chunk_size : int
+            Number of particles per chunk in the 'fused' engine.
+        mode : str
+            How the work is split between the workers of the pool. 'nlm'
+            sends one (n,l,m) term per task. 'particles' splits the
+            particles into contiguous slices, each worker computes all the
+            terms (and the variances) of its slice with the fused kernel and
+            the partial coefficients are added at the end.
+        ntasks : int
+            Number of particle slices in mode='particles'. By default one
+            per worker of the pool.
+        shared_memory : bool
+            If True s, phi, X and mass are stored in shared memory and only
+            their names are sent to the workers of the pool instead of
+            pickling the arrays for every task. Only for pools running in a
+            single node (e.g schwimmbad.MultiPool). The buffers are released
+            at the end of main.
+        labels : numpy.ndarray of int
+            Batch of each particle (0, 1, ..., nbatches-1). If given, main
+            returns the coefficients of every batch computed in one pass
+            over the particles (see fused_coefficients.STnlm_batches), the
+            particles are split between the workers as in mode='particles'.
+        radial_tol : float
+            If given the fused kernels interpolate the radial functions from
+            a table with this tolerance (see tabulated_basis.RadialTable).
+            The table is cached on disk and loaded once by every worker.
+
+        """
+        assert engine in ['gala', 'fused'], "engine must be 'gala' or 'fused'"
+        assert mode in ['nlm', 'particles'], "mode must be 'nlm' or 'particles'"
+        self.engine = engine
+        self.chunk_size = chunk_size
+        # the fused kernel computes all the (n,l,m) terms at once
+        self.mode = 'particles' if engine == 'fused' else mode
+        self.ntasks = ntasks
         self.pos = pos
         self.mass = np.ascontiguousarray(mass).astype("float64")
         self.r_s = r_s
@@ -23,34 +83,119 @@ class Coeff_parallel(object):
         self.X = np.ascontiguousarray(self.pos[:,2] / self.r).astype("float64")
         self.nmax = nmax
         self.lmax = lmax
+        self.labels = labels
+        if labels is not None:
+            self.labels = np.ascontiguousarray(labels).astype(int)
+            self.nbatches = int(self.labels.max()) + 1
+        self.radial_tol = radial_tol
+        if radial_tol is not None:
+            # builds (or loads) the table before the workers need it
+            get_radial_table(nmax, lmax, radial_tol)
+        self.shared = None
+        if shared_memory == True:
+            arrays = {'s':self.s, 'phi':self.phi, 'X':self.X, 'mass':self.mass}
+            if labels is not None:
+                arrays['labels'] = self.labels
+            self.shared = SharedArrays(arrays)
+            self.attach_shared()
+            del self.r
         print("* Computing SCF coefficients in parallel")
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared is not None:
+            # workers attach to the shared arrays by name
+            for key in ['pos', 's', 'phi', 'X', 'mass', 'labels']:
+                del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared is not None:
+            self.attach_shared()
+
+    def attach_shared(self):
+        self.s, self.phi, self.X, self.mass = [self.shared[k] for k in ['s', 'phi', 'X', 'mass']]
+        self.labels = self.shared['labels'] if 'labels' in self.shared.handles else None
+
+    def release(self):
+        """
+        Frees the shared memory buffers.
+        """
+        if self.shared is not None:
+            self.s = self.phi = self.X = self.mass = self.labels = None
+            self.shared.release()
+            self.shared = None
+
     def nlm_list(self, nmax, lmax):
         """
-        
+        See basis.nlm_list.
         """
-        nlm = []
-        for n in range(nmax+1):
-            for l in range(lmax+1):
-                for m in range(l+1):
-                    nlm.append((n,l,m))                 
-        return nlm
+        return basis.nlm_list(nmax, lmax)
                                                                                             
     def compute_coeffs_discrete_parallel(self, task):
         n, l, m = task
-        S, T = STnlm_discrete(self.s, self.phi, self.X, self.mass, n, l, m)
-
         if self.var == True:
-            Svar, Tvar, STvar = STnlm_var_discrete(self.s, self.phi, self.X, self.mass, n, l, m)
-            return S, T, Svar, Tvar, STvar
+            # one evaluation of the basis functions for S, T and the variances
+            return fused_coefficients.STnlm_var_single(
+                    self.s, self.phi, self.X, self.mass, n, l, m)
         else :
+            S, T = STnlm_discrete(self.s, self.phi, self.X, self.mass, n, l, m)
             return S, T
 
+    def compute_coeffs_particles(self, task):
+        """
+        Partial coefficients of the particles in the slice task=(start, stop).
+
+        """
+        k = slice(*task)
+        return fused_coefficients.STnlm_partial(
+                self.s[k], self.phi[k], self.X[k], self.mass[k], self.nmax,
+                self.lmax, self.var, self.chunk_size, self.radial_tol)
+
+    def compute_coeffs_batches(self, task):
+        """
+        Partial coefficients of every batch of the particles in the slice
+        task=(start, stop).
+
+        """
+        k = slice(*task)
+        return fused_coefficients.STnlm_batches(
+                self.s[k], self.phi[k], self.X[k], self.mass[k], self.labels[k],
+                self.nbatches, self.nmax, self.lmax, self.var, self.chunk_size,
+                self.radial_tol)
+
+    def particle_tasks(self, pool):
+        ntasks = self.ntasks
+        if ntasks is None:
+            # MultiPool stores the number of processes in _processes and
+            # MPIPool the number of workers in size.
+            ntasks = getattr(pool, 'size', None) or getattr(pool, '_processes', None) or 1
+        return fused_coefficients.particle_chunks(len(self.s), ntasks)
+
     def main(self, pool):
+        if self.labels is not None:
+            # coefficients of each batch with shape
+            # (2 or 5, nbatches, nmax+1, lmax+1, lmax+1)
+            tasks = self.particle_tasks(pool)
+            partial = list(pool.map(self.compute_coeffs_batches, tasks))
+            pool.close()
+            self.release()
+            return np.sum(partial, axis=0)
+
+        if self.mode == 'particles':
+            tasks = self.particle_tasks(pool)
+            partial = list(pool.map(self.compute_coeffs_particles, tasks))
+            pool.close()
+            self.release()
+            return fused_coefficients.coeff_results(
+                    self.nmax, self.lmax, *np.sum(partial, axis=0))
+
         tasks = self.nlm_list(self.nmax, self.lmax)
  
-        results = pool.map(self.compute_coeffs_discrete_parallel, tasks)
+        results = list(pool.map(self.compute_coeffs_discrete_parallel, tasks))
         pool.close()
+        self.release()
 
         return np.array(results)
 
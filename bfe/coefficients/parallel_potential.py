@@ -9,27 +9,60 @@ in Ben Lowing et al+11 equation 14 (MNRAS 416, 2697-2711).
 import numpy as np
 import schwimmbad
 import sys
-from scipy import special
-import math
 import time
+import os
+from bfe.coefficients import basis
+from bfe.coefficients import fused_coefficients
+from bfe.coefficients.shared_arrays import SharedArrays
+from bfe.coefficients.sparse_coefficients import SparseCoefficients
+from bfe.coefficients.tabulated_basis import get_radial_table
+
+
+def available_memory():
+    """
+    Available physical memory in bytes, None if it can not be found.
+    """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def block_size_from_memory(nmax, lmax, nworkers=1, memory_fraction=0.25,
+                           max_block_size=1000000):
+    """
+    Number of points per block such that the tables of nworkers blocks
+    evaluated at the same time (see PBFEpot.evaluate) use at most
+    memory_fraction of the available memory.
+    """
+    # radial table + Legendre tables (P, P cos, P sin) + cos, sin and sums
+    bytes_per_point = 8*((nmax+1)*(lmax+1) + 3*(lmax+1)**2 + 6*(lmax+1))
+    memory = available_memory()
+    if memory is None:
+        return 10000
+    block_size = int(memory_fraction*memory / (bytes_per_point*max(nworkers, 1)))
+    return min(max(block_size, 1000), max_block_size)
+
 
 class PBFEpot:
-    def __init__(self, pos, S, T, rs, nmax, lmax, G, M):
+    def __init__(self, pos, S, T, rs, nmax, lmax, G, M, shared_memory=False,
+                 block_size=None, radial_tol=None):
         """
         Computes parallel BFE potential and density
         Attributes:
-            nlm_list     Creates arrays of indices n, l, m from 3d to 1d.
-            bfe_pot      Core function that computed the BFE potential.
-            potential    Computes the potential bfe_pot by receiving a task
-                         with the arguments that are going to run in parallel.
-            main         Runs potential in parallel using a pool to be defined
-                         by the user.
+            evaluate     Computes the potential and density of a block of
+                         points with all the (n,l,m) terms.
+            main         Runs evaluate in parallel over blocks of points
+                         using a pool to be defined by the user.
 
         Parameters:
         -----------
         pos : numpy.ndarray with shape
         S : numpy.ndarray
         T : numpy.ndarray
+            Coefficients as 1d arrays in the order of basis.nlm_list (the format
+            of Coeff_parallel.main), flattened (nmax+1, lmax+1, lmax+1)
+            matrices or (nmax+1, lmax+1, lmax+1) matrices.
         rs : float
             Hernquist halo scale length
         nmax : int
@@ -42,6 +75,21 @@ class PBFEpot:
             Total mass of the halo (M=1) if the masses
             of each particle where already used for computing the
             coefficients.
+        shared_memory : bool
+            If True s, theta and phi are stored in shared memory and only
+            their names are sent to the workers of the pool, the workers
+            write the potential of their points directly into a shared
+            output array. Only for pools running in a single node
+            (e.g schwimmbad.MultiPool). The buffers are released at the end
+            of main.
+        block_size : int
+            Number of points evaluated at once by each task. Memory of a
+            task scales as block_size*(nmax+1)*(lmax+1). By default it is
+            set from the available memory and the number of workers (see
+            block_size_from_memory).
+        radial_tol : float
+            If given the radial functions are interpolated from a table
+            with this tolerance (see tabulated_basis.RadialTable).
 
         """
         self.pos = pos
@@ -57,89 +105,138 @@ class PBFEpot:
         self.M = M
         self.S = S
         self.T = T
+        self.S_matrix = self.coeff_matrix(S)
+        self.T_matrix = self.coeff_matrix(T)
+        self.sparse = SparseCoefficients(self.S_matrix, self.T_matrix)
+        self.block_size = block_size
+        self.compute_density = False
         self.nparticles = len(self.s)
-
-    def nlm_list(self, ncoeff, nmax, lmax):
-        n_list = np.zeros(ncoeff)
-        l_list = np.zeros(ncoeff)
-        m_list = np.zeros(ncoeff)
-        i=0
-        for n in range(nmax+1):
-            for l in range(lmax+1):
-                for m in range(l+1):
-                    n_list[i] = n
-                    l_list[i] = l
-                    m_list[i] = m
-                    i+=1
-        return n_list, l_list, m_list
-
-    def bfe_pot(self, n, l, m, s, theta):
-        #r, theta, phi = spherical_coordinates(pos)
-
-        phi_l = -s**l * (1+s)**(-2*l-1)
-        #phi_nlm = special.eval_gegenbauer(n, 2*l+1.5, (s-1)/(s+1)) * special.sph_harm(m, l, 0, theta)
-        phi_nlm = special.eval_gegenbauer(n, 2*l+1.5, ((s-1)/(s+1))) * special.lpmv(m, l, np.cos(theta))
-        factor = ((2*l+1) * math.factorial(l-m)/math.factorial(l+m))**0.5
-        #factor=1
-        #factor = 1#(4*np.pi)**0.5
-        return  factor*phi_l*phi_nlm #np.sqrt(4*np.pi)
-
-
-    def potential(self, task):
-        #s, phi, theta = task
-        #nlist, llist, mlist = self.nlm_list(len(self.S), self.nmax, self.lmax)
-        nlist, llist, mlist, S, T = task
-        #pot = np.zeros(len(nlist))
-        #for i in range(len(self.S)):
-        pot = self.bfe_pot(nlist, llist, mlist, self.s, self.theta)\
-                * (S*np.cos(mlist*self.phi)+T*np.sin(mlist*self.phi))
-        return pot*self.G*self.M/self.rs
-
-    def bfe_rho(self, n, l, m, s, theta):
-        # Eq 10 in Lowing+11
-
-        rho_l = s**(l-1) * (1+s)**(-2*l-3)
-        rho_nlm = special.eval_gegenbauer(n, 2*l+1.5, ((s-1)/(s+1))) * special.lpmv(m, l, np.cos(theta))
-        factor = ((2*l+1) * math.factorial(l-m)/math.factorial(l+m))**0.5
-        #factor=1
-        Knl = 0.5*n*(n+4*l+3) + (l+1)*(2*l+1)
-        return  factor*Knl*rho_l*phi_nlm/(2*np.pi)
-
-    def d_phi(self, n, l, m):
+        self.shared = None
+        self.output = None
+        self.radial_tol = radial_tol
+        if radial_tol is not None:
+            # builds (or loads) the table before the workers need it
+            get_radial_table(nmax, lmax, radial_tol)
+        if shared_memory == True:
+            self.shared = SharedArrays({'s':self.s, 'theta':self.theta, 'phi':self.phi})
+            self.s, self.theta, self.phi = [self.shared[k] for k in ['s', 'theta', 'phi']]
+            del self.r
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared is not None:
+            # workers attach to the shared arrays by name
+            for key in ['pos', 's', 'theta', 'phi']:
+                del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared is not None:
+            self.s, self.theta, self.phi = [self.shared[k] for k in ['s', 'theta', 'phi']]
+
+    def release(self):
         """
-        TODO: Add all the .self
+        Frees the shared memory buffers.
         """
-        factor = np.sqrt(4*np.pi)
-        A_factor = (-l-3*l*self.s-self.s)
-        A = self.s**(l-1)/(1+self.s)**(2*l+2) * special.eval_gegenbauer(n, 2*l+1.5, ((self.s-1)/(self.s+1)))
-        B_factor = -4*(2*l+3/2.)
-        B = self.s**l/(1+self.s)**(2*l+3) * special.eval_gegenbauer(n-1, 2*l+2.5, ((self.s-1)/(self.s+1)))
-        d_phi_dr = factor * ( A_factor*A + B_factor*B) * special.lpmv(m, l, np.cos(self.theta))
-        d_phi_dtheta = m*np.cot(self.theta)*np.sqrt()
-
-    def acceleration(self, n, l, m, s, theta):
-        # Computes bfe accelerations Eqn: 17-19 in Lowing+11
-
-        special.lpmv(m, l, np.cos(theta))
-        return 0
+        if self.shared is not None:
+            self.s = self.theta = self.phi = None
+            self.shared.release()
+            self.shared = None
+        if self.output is not None:
+            self.output.release()
+            self.output = None
+
+    def coeff_matrix(self, coeff):
+        """
+        Coefficients as a (nmax+1, lmax+1, lmax+1) matrix.
+        """
+        coeff = np.asarray(coeff, dtype=np.float64)
+        shape = (self.nmax+1, self.lmax+1, self.lmax+1)
+        if coeff.ndim == 3:
+            return coeff
+        if coeff.size == np.prod(shape):
+            return coeff.reshape(shape)
+        n, l, m = np.array(basis.nlm_list(self.nmax, self.lmax)).T
+        assert coeff.size == len(n), "S and T do not match nmax and lmax"
+        matrix = np.zeros(shape)
+        matrix[n, l, m] = coeff
+        return matrix
+
+    def evaluate(self, task):
+        """
+        Potential and density of the points in the slice task=(start, stop).
+        Only the (n,l,m) terms with non-zero coefficients are evaluated
+        (see sparse_coefficients.SparseCoefficients), with the sum over n
+        done first:
 
-    def density(self, task):
-        # Eq 13 in Lowing+2011
-        nlist, llist, mlist, S, T = task
-        rho = self.bfe_rho(nlist, llist, mlist, self.s, self.theta)\
-                * (S*np.cos(mlist*self.phi)+T*np.sin(mlist*self.phi))
-        return rho*self.M/self.rs
+            A_lm = sum_n Phi_nl S_nlm, B_lm = sum_n Phi_nl T_nlm
+            Phi = sum_lm P_lm (A_lm cos(m phi) + B_lm sin(m phi))
 
-    def main(self, pool):
-        nlist, llist, mlist = self.nlm_list(len(self.S), self.nmax, self.lmax)
-        #rint(self.S, self.T)
-        tasks = list(zip(nlist, llist, mlist, self.S, self.T))
-        results = pool.map(self.potential, tasks)
-        #for i in range(len(nlist)):
-        #    results = self.potential([nlist[i], llist[i], mlist[i], self.S[i], self.T[i]])
-        pool.close()
-        return np.sum(results, axis=0)
+        The density uses rho_nl = -Knl/(2 pi s (1+s)^2) Phi_nl.
 
+        """
+        k = slice(*task)
+        radial = None
+        if self.radial_tol is not None:
+            radial = get_radial_table(self.nmax, self.lmax, self.radial_tol).radial
+        pot, rho = self.sparse.evaluate(self.s[k], np.cos(self.theta[k]), self.phi[k],
+                                        density=self.compute_density, radial=radial)[:2]
+        if rho is None:
+            return pot*self.G*self.M/self.rs, None
+        return pot*self.G*self.M/self.rs, rho*self.M/self.rs**3
+
+    def evaluate_shared(self, task):
+        """
+        Writes the potential (and density) of the points in the slice
+        task=(start, stop) into the shared output arrays.
+        """
+        k = slice(*task)
+        pot, rho = self.evaluate(task)
+        self.output['pot'][k] = pot
+        if rho is not None:
+            self.output['rho'][k] = rho
+        return 0
+
+    def tasks(self, pool):
+        """
+        Slices of block_size points. If block_size is not given it is set
+        from the available memory, with at least one slice per worker.
+        """
+        nworkers = getattr(pool, 'size', None) or getattr(pool, '_processes', None) or 1
+        block_size = self.block_size
+        if block_size is None:
+            block_size = min(block_size_from_memory(self.nmax, self.lmax, nworkers),
+                             int(np.ceil(self.nparticles/nworkers)))
+        return fused_coefficients.particle_chunks(
+                self.nparticles, int(np.ceil(self.nparticles/max(block_size, 1))))
+
+    def main(self, pool, density=False):
+        """
+        Computes the potential of all the points in blocks of block_size
+        points, the density is also returned if density=True.
+        """
+        self.compute_density = density
+        tasks = self.tasks(pool)
+        if self.shared is not None:
+            output = {'pot':np.zeros(self.nparticles)}
+            if density == True:
+                output['rho'] = np.zeros(self.nparticles)
+            self.output = SharedArrays(output)
+            list(pool.map(self.evaluate_shared, tasks))
+            pool.close()
+            pot = np.array(self.output['pot'])
+            rho = np.array(self.output['rho']) if density == True else None
+        else:
+            results = list(pool.map(self.evaluate, tasks))
+            pool.close()
+            pot = np.concatenate([block[0] for block in results]) if results else np.zeros(0)
+            if density == True:
+                rho = np.concatenate([block[1] for block in results]) if results else np.zeros(0)
+        self.release()
+        if density == True:
+            return pot, rho
+        return pot
 
 if __name__ == "__main__":
     print("Start")
@@ -148,13 +245,9 @@ if __name__ == "__main__":
     coeff = np.loadtxt('/rsgrps/gbeslastudents/nicolas/MWLMC_sims/BFE/MW/MWLMC5/BFE_MWLMC5_b1snap_061.txt')
     S = coeff[:,0]
     T = coeff[:,2]
-    Smatrix = coefficients_smoothing.reshape_matrix(S, 20, 20, 20)
-    Tmatrix = coefficients_smoothing.reshape_matrix(T, 20, 20, 20)
     pos = np.random.randint(-100, 100, (npoints, 3))
-    halo = PBFEpot(pos, S, T, 40.85, 21, 21, 1, 1)
+    halo = PBFEpot(pos, S, T, 40.85, 20, 20, 1, 1)
     pool = schwimmbad.choose_pool(mpi=False, processes=16)# start 4 worker processes
-    r = halo.main(pool)
-    r_arr = np.array(r)
-    r_all = np.sum(r_arr, axis=0)
+    pot = halo.main(pool)
     t2 = time.time()
-    print("Done")
+    print("Done: potential of {} points in {:.1f} s".format(len(pot), t2-t1))
@@ -0,0 +1,88 @@
+"""
+Coefficients of a halo truncated at any radius from a single expansion.
+
+The coefficients are sums over particles, so once the particles are sorted
+by radius the coefficients of all the particles with r < rcut are a prefix
+sum. The particles are split into radial bins with the same number of
+particles, the coefficients of each bin are computed in one pass
+(see fused_coefficients.STnlm_batches) and accumulated. The coefficients
+for any rcut are the cumulative sum up to the bin that contains rcut plus
+the particles of that bin with r < rcut, and the coefficients of a shell
+rmin <= r < rmax are the difference of two of them.
+
+"""
+
+import numpy as np
+from bfe.coefficients import basis
+from bfe.coefficients import fused_coefficients
+
+
+class RadialCoefficients:
+    def __init__(self, pos, mass, rs, nmax, lmax, var=True, nbins=100,
+                 chunk_size=10000):
+        """
+        Parameters:
+        -----------
+        pos : numpy.ndarray with shape (N, 3)
+        mass : numpy.ndarray
+        rs : float
+            Hernquist halo scale length
+        nmax : int
+        lmax : int
+        var : bool
+            If True also computes the variance terms of the coefficients.
+        nbins : int
+            Number of radial bins. A lookup computes at most N/nbins
+            particles, memory is (2 or 5)*nbins*(nmax+1)*(lmax+1)**2*8 bytes.
+        chunk_size : int
+            Number of particles processed at once.
+
+        """
+        self.rs = rs
+        self.nmax = nmax
+        self.lmax = lmax
+        self.var = var
+        self.chunk_size = chunk_size
+        s, phi, X = basis.spherical_coordinates(pos, rs)
+        order = np.argsort(s, kind='stable')
+        self.s = s[order]
+        self.phi = phi[order]
+        self.X = X[order]
+        self.mass = np.ascontiguousarray(mass, dtype=np.float64)[order]
+        self.r = self.s*rs
+
+        npart = len(self.s)
+        nbins = max(min(nbins, npart), 1)
+        # particle index of the edges of the bins
+        self.edges = np.linspace(0, npart, nbins+1).astype(int)
+        labels = np.repeat(np.arange(nbins), np.diff(self.edges))
+        bins = fused_coefficients.STnlm_batches(
+                self.s, self.phi, self.X, self.mass, labels, nbins, nmax, lmax,
+                var, chunk_size)
+        self.cumulative = np.zeros((len(bins), nbins+1, nmax+1, lmax+1, lmax+1))
+        self.cumulative[:,1:] = np.cumsum(bins, axis=1)
+
+    def cumulative_coefficients(self, rcut):
+        """
+        Stacked coefficients (see fused_coefficients.STnlm_partial) of the
+        particles with r < rcut.
+        """
+        i = np.searchsorted(self.r, rcut, side='left')
+        b = np.searchsorted(self.edges, i, side='right') - 1
+        ST = self.cumulative[:,b].copy()
+        if i > self.edges[b]:
+            k = slice(self.edges[b], i)
+            ST += fused_coefficients.STnlm_partial(
+                    self.s[k], self.phi[k], self.X[k], self.mass[k], self.nmax,
+                    self.lmax, self.var, self.chunk_size)
+        return ST
+
+    def coefficients(self, rcut=np.inf, rmin=0):
+        """
+        Coefficients of the particles with rmin <= r < rcut with the format
+        of Coeff_parallel.main, by default all the particles.
+        """
+        ST = self.cumulative_coefficients(rcut)
+        if rmin > 0:
+            ST -= self.cumulative_coefficients(rmin)
+        return fused_coefficients.coeff_results(self.nmax, self.lmax, *ST)
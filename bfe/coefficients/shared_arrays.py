@@ -0,0 +1,128 @@
+"""
+Zero-copy transport of particle arrays to the workers of a multiprocessing
+pool.
+
+pool.map(self.method, tasks) pickles self, and with it every particle
+array, for every chunk of tasks. SharedArrays copies the arrays once into
+multiprocessing.shared_memory blocks and pickles only their names, shapes
+and dtypes. Workers attach to the blocks by name, so every process maps the
+same physical memory.
+
+This only works for pools whose workers run on the same node as the
+parent process (schwimmbad.MultiPool, schwimmbad.SerialPool).
+
+"""
+
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+# Blocks attached by this process. They are kept open for the lifetime of
+# the worker, this avoids attaching again for every task and keeps the
+# buffers alive while numpy views of them exist.
+_attached = {}
+
+
+def _attach(name):
+    if name not in _attached:
+        try:
+            _attached[name] = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # python < 3.13 has no track argument and registers the block
+            # with the resource tracker of the worker, which unlinks it
+            # when the worker exits. The block is attached without
+            # registering it, as track=False does.
+            register = resource_tracker.register
+            resource_tracker.register = lambda name, rtype: None
+            try:
+                _attached[name] = shared_memory.SharedMemory(name=name)
+            finally:
+                resource_tracker.register = register
+    return _attached[name]
+
+
+class SharedArrays:
+    def __init__(self, arrays):
+        """
+        Copies numpy arrays into shared memory.
+
+        Parameters:
+        -----------
+        arrays : dict
+            name : numpy.ndarray
+
+        Attributes:
+        -----------
+        arrays : dict
+            name : numpy.ndarray view of the shared memory block.
+
+        """
+        self.owner = True
+        self.arrays = {}
+        self.handles = {}
+        self._blocks = []
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            self._allocate(key, array.shape, array.dtype)[...] = array
+
+    @classmethod
+    def empty(cls, shapes):
+        """
+        Uninitialized shared arrays, for outputs that the workers fill in
+        without a copy of them in the parent process.
+
+        Parameters:
+        -----------
+        shapes : dict
+            name : (shape, dtype)
+
+        """
+        shared = cls({})
+        for key, (shape, dtype) in shapes.items():
+            shared._allocate(key, tuple(shape), np.dtype(dtype))
+        return shared
+
+    def _allocate(self, key, shape, dtype):
+        nbytes = int(np.prod(shape, dtype=np.int64))*dtype.itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self._blocks.append(shm)
+        self.arrays[key] = view
+        self.handles[key] = (shm.name, shape, dtype.str)
+        return view
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def __getstate__(self):
+        # Only the names of the blocks are sent to the workers.
+        return {'handles': self.handles}
+
+    def __setstate__(self, state):
+        self.owner = False
+        self.handles = state['handles']
+        self._blocks = []
+        self.arrays = {}
+        for key, (name, shape, dtype) in self.handles.items():
+            shm = _attach(name)
+            self.arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+    def release(self):
+        """
+        Frees the shared memory blocks. Has to be called by the process
+        that created them once the workers are done. Views of the arrays
+        must not be used afterwards.
+
+        """
+        self.arrays = {}
+        if not self.owner:
+            return 0
+        for shm in self._blocks:
+            try:
+                shm.close()
+            except BufferError:
+                # views still exist, the memory is unmapped when they are
+                # garbage collected.
+                pass
+            shm.unlink()
+        self._blocks = []
+        return 0
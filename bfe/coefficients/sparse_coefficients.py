@@ -0,0 +1,198 @@
+"""
+Sparse representation of a set of coefficients.
+
+After smoothing (coefficients_smoothing.smooth_coeff_matrix) most of the
+S_nlm, T_nlm are exactly zero. SparseCoefficients keeps only the (n,l,m)
+terms with S != 0 or T != 0 grouped by l, and the evaluation:
+
+    - skips the l values and the m values of each l without terms,
+    - stops the Gegenbauer recurrence of each l at its highest n,
+    - stops the Legendre recurrence of each m at its highest l.
+
+"""
+
+import numpy as np
+from bfe.coefficients import basis
+
+
+class SparseCoefficients:
+    def __init__(self, S, T):
+        """
+        Parameters:
+        -----------
+        S, T : numpy.ndarray with shape (nmax+1, lmax+1, lmax+1)
+
+        Attributes:
+        -----------
+        n, l, m : numpy.ndarray
+            indices of the terms with S != 0 or T != 0.
+        groups : list
+            (l, m values, S, T) for every l with terms, S and T are
+            matrices with shape (nmax_l[l]+1, len(m values)).
+        nmax_l : numpy.ndarray
+            highest n of each l, -1 if the l has no terms.
+        lmax_m : numpy.ndarray
+            highest l of each m, -1 if the m has no terms.
+
+        """
+        S = np.asarray(S, dtype=np.float64)
+        T = np.asarray(T, dtype=np.float64)
+        self.n, self.l, self.m = np.nonzero((S != 0) | (T != 0))
+        self.S = S[self.n, self.l, self.m]
+        self.T = T[self.n, self.l, self.m]
+        self.nterms = len(self.n)
+        lmax = S.shape[1] - 1
+        self.nmax_l = np.full(lmax+1, -1)
+        self.lmax_m = np.full(lmax+1, -1)
+        np.maximum.at(self.nmax_l, self.l, self.n)
+        np.maximum.at(self.lmax_m, self.m, self.l)
+        # the tables are only built up to the highest n, l and m with terms
+        self.nmax = max(int(self.nmax_l.max()), 0)
+        self.lmax = max(int(self.lmax_m.max()), 0)
+        self.mmax = int(self.m.max()) if self.nterms > 0 else 0
+        self.nmax_l = self.nmax_l[:self.lmax+1]
+        self.lmax_m = self.lmax_m[:self.lmax+1]
+
+        self.groups = []
+        for l in np.unique(self.l):
+            m_values = np.unique(self.m[self.l == l])
+            nl = self.nmax_l[l] + 1
+            self.groups.append((l, m_values, S[:nl,l][:,m_values], T[:nl,l][:,m_values]))
+
+    def evaluate(self, s, X, phi, density=False, gradient=False, radial=None):
+        """
+        Sums of the basis functions times the coefficients at the points
+        (s, X=cos(theta), phi). The potential is G M/rs pot and the density
+        M/rs^3 rho.
+
+        Parameters:
+        -----------
+        density : bool
+            also returns the density sum.
+        gradient : bool
+            also returns the derivatives of the potential sum with respect
+            to s, theta and phi.
+        radial : callable
+            function of s that returns the radial functions with shape
+            (nmax+1, lmax+1, len(s)) (e.g. tabulated_basis.RadialTable.radial),
+            only used if gradient=False.
+
+        Returns:
+        --------
+        pot, rho, dpot_ds, dpot_dtheta, dpot_dphi : numpy.ndarray
+            rho is None if density=False and the derivatives are None if
+            gradient=False.
+
+        """
+        npoints = len(s)
+        pot = np.zeros(npoints)
+        rho = np.zeros(npoints) if density == True else None
+        dpot_ds = dpot_dtheta = dpot_dphi = None
+        if self.nterms == 0:
+            if gradient == True:
+                dpot_ds, dpot_dtheta, dpot_dphi = np.zeros((3, npoints))
+            return pot, rho, dpot_ds, dpot_dtheta, dpot_dphi
+
+        if gradient == True:
+            R, dR = basis.radial_derivative_table(self.nmax, self.lmax, s, self.nmax_l)
+            dpot_ds = np.zeros(npoints)
+            dpot_dtheta = np.zeros(npoints)
+            dpot_dphi = np.zeros(npoints)
+        elif radial is not None:
+            R = radial(s)
+        else:
+            R = basis.radial_table(self.nmax, self.lmax, s, self.nmax_l)
+        P = basis.legendre_table(self.lmax, X, self.lmax_m)
+        if gradient == True:
+            dP = basis.legendre_derivative_table(self.lmax, X, P)
+        cos_mphi, sin_mphi = basis.azimuthal_table(self.mmax, phi)
+        if density == True:
+            Knl = basis.Knl(self.nmax, self.lmax)
+
+        for l, m, S, T in self.groups:
+            nl = len(S)
+            A = S.T @ R[:nl,l]
+            B = T.T @ R[:nl,l]
+            AB = A*cos_mphi[m] + B*sin_mphi[m]
+            pot += np.sum(P[l,m]*AB, axis=0)
+            if density == True:
+                KA = (S*Knl[:nl,l,None]).T @ R[:nl,l]
+                KB = (T*Knl[:nl,l,None]).T @ R[:nl,l]
+                rho += np.sum(P[l,m]*(KA*cos_mphi[m] + KB*sin_mphi[m]), axis=0)
+            if gradient == True:
+                dpot_dtheta += np.sum(dP[l,m]*AB, axis=0)
+                dpot_dphi += np.sum(P[l,m]*m[:,None]*(B*cos_mphi[m] - A*sin_mphi[m]), axis=0)
+                dA = S.T @ dR[:nl,l]
+                dB = T.T @ dR[:nl,l]
+                dpot_ds += np.sum(P[l,m]*(dA*cos_mphi[m] + dB*sin_mphi[m]), axis=0)
+        if density == True:
+            rho *= -1/(2*np.pi*s*(1+s)**2)
+        return pot, rho, dpot_ds, dpot_dtheta, dpot_dphi
+
+    def evaluate_subset(self, s, X, phi, subset, density=False):
+        """
+        Sums of all the terms and of the terms in subset at the points
+        (s, X=cos(theta), phi) from the same basis function tables, e.g.
+        to get the contrast of the density with respect to its monopole
+        without a second evaluation.
+
+        Parameters:
+        -----------
+        subset : numpy.ndarray of bool with shape (nmax+1, lmax+1, lmax+1)
+            terms of the subset, see subset_mask.
+        density : bool
+            If True the density sums are returned instead of the potential
+            sums.
+
+        Returns:
+        --------
+        full, part : numpy.ndarray
+
+        """
+        full = np.zeros(len(s))
+        part = np.zeros(len(s))
+        if self.nterms == 0:
+            return full, part
+        R = basis.radial_table(self.nmax, self.lmax, s, self.nmax_l)
+        P = basis.legendre_table(self.lmax, X, self.lmax_m)
+        cos_mphi, sin_mphi = basis.azimuthal_table(self.mmax, phi)
+        Knl = basis.Knl(self.nmax, self.lmax)
+        for l, m, S, T in self.groups:
+            nl = len(S)
+            if density == True:
+                S = S*Knl[:nl,l,None]
+                T = T*Knl[:nl,l,None]
+            mask = subset[:nl,l][:,m]
+            for coeff, q in [((S, T), full), ((S*mask, T*mask), part)]:
+                A = coeff[0].T @ R[:nl,l]
+                B = coeff[1].T @ R[:nl,l]
+                q += np.sum(P[l,m]*(A*cos_mphi[m] + B*sin_mphi[m]), axis=0)
+        if density == True:
+            factor = -1/(2*np.pi*s*(1+s)**2)
+            full *= factor
+            part *= factor
+        return full, part
+
+
+def subset_mask(nmax, lmax, nmax_subset=None, lmax_subset=None, m=None):
+    """
+    Terms with n <= nmax_subset, l <= lmax_subset and m in the given m
+    values (all of them if None). The monopole S_000 is
+    subset_mask(nmax, lmax, nmax_subset=0, lmax_subset=0).
+
+    Returns:
+    --------
+    mask : numpy.ndarray of bool with shape (nmax+1, lmax+1, lmax+1)
+
+    """
+    n_values = np.arange(nmax+1)[:,None,None]
+    l_values = np.arange(lmax+1)[None,:,None]
+    m_values = np.arange(lmax+1)[None,None,:]
+    mask = np.ones((nmax+1, lmax+1, lmax+1), dtype=bool)
+    if nmax_subset is not None:
+        mask &= n_values <= nmax_subset
+    if lmax_subset is not None:
+        mask &= l_values <= lmax_subset
+    if m is not None:
+        mask &= np.isin(m_values, m)
+    return mask
@@ -0,0 +1,236 @@
+"""
+Out-of-core computation of the SCF coefficients.
+
+The particles of a Gadget-4 HDF5 snapshot, in one or several files, are read
+in chunks of a fixed number of particles. Each chunk is selected (host or satellite), re-centered,
+truncated and added to the coefficients with the fused kernel before the
+next chunk is read, so the memory is set by the chunk size and not by the
+size of the snapshot.
+
+"""
+
+import numpy as np
+from bfe.coefficients import basis
+from bfe.coefficients import fused_coefficients
+from bfe.ios.gadget_reader import iter_snap_chunks, snap_npart
+from bfe.ios.com import com_disk_potential
+
+
+def host_id_cut(snapname, N_host_particles, partType='PartType1',
+                chunk_size=1000000, nbins=65536):
+    """
+    ID of the first satellite particle, the same cut used by
+    bfe.ios.io_snaps.host_particles (np.sort(pids)[N_host_particles]).
+
+    The IDs are read in chunks. Each pass counts the IDs in nbins bins of
+    the range that contains the cut and keeps only the bin where the cut
+    is, so the memory is set by chunk_size and a few passes are enough
+    even for 64 bits IDs.
+    """
+    lo, hi = None, None
+    for (ids,) in iter_snap_chunks(snapname, partType, ['ParticleIDs'], chunk_size):
+        if len(ids) == 0:
+            continue
+        lo = int(ids.min()) if lo is None else min(lo, int(ids.min()))
+        hi = int(ids.max()) if hi is None else max(hi, int(ids.max()))
+    # number of IDs smaller than lo
+    nbelow = 0
+    while lo < hi:
+        width = -(-(hi - lo + 1) // nbins)
+        counts = np.zeros(nbins, dtype=np.int64)
+        for (ids,) in iter_snap_chunks(snapname, partType, ['ParticleIDs'], chunk_size):
+            inside = ids[(ids >= lo) & (ids <= hi)]
+            # scalars of the IDs type keep the arithmetic exact for 64 bits IDs
+            bins = (inside - ids.dtype.type(lo)) // ids.dtype.type(width)
+            counts += np.bincount(bins.astype(np.int64), minlength=nbins)
+        below = nbelow + np.cumsum(counts)
+        b = int(np.searchsorted(below, N_host_particles + 1))
+        nbelow = int(below[b-1]) if b > 0 else nbelow
+        lo, hi = lo + b*width, min(hi, lo + (b+1)*width - 1)
+    return lo
+
+
+def select_particles(pos, mass, ids, galaxy=None, id_cut=None, rcom=None, rcut=0):
+    """
+    Selects the host (ids < id_cut) or the satellite (ids >= id_cut)
+    particles, re-centers them on rcom and keeps the ones with r < rcut
+    if rcut > 0.
+    """
+    if galaxy == 'host':
+        select = ids < id_cut
+        pos, mass = pos[select], mass[select]
+    elif galaxy == 'sat':
+        select = ids >= id_cut
+        pos, mass = pos[select], mass[select]
+    if rcom is not None:
+        pos = pos - np.asarray(rcom)
+    if rcut > 0:
+        select = np.sum(pos**2, axis=1) < rcut**2
+        pos, mass = pos[select], mass[select]
+    return pos, mass
+
+
+def partial_coefficients(snapname, rs, nmax, lmax, var=True, galaxy=None,
+                         id_cut=None, rcom=None, rcut=0, chunk_size=1000000,
+                         start=0, stop=None, kernel_chunk_size=10000):
+    """
+    Coefficients of the particles in [start, stop) of a snapshot read in
+    chunks of chunk_size particles.
+
+    Returns:
+    --------
+    partial : numpy.ndarray
+        Stacked coefficients (see fused_coefficients.STnlm_partial).
+    pmass : float
+        mass of the last particle read, 0 if no particles were selected.
+
+    """
+    partial = np.zeros((5 if var == True else 2, nmax+1, lmax+1, lmax+1))
+    pmass = 0.
+    for pos, mass, ids in iter_snap_chunks(
+            snapname, 'PartType1', ['Coordinates', 'Masses', 'ParticleIDs'],
+            chunk_size, start, stop):
+        pos, mass = select_particles(pos, mass, ids, galaxy, id_cut, rcom, rcut)
+        if len(mass) == 0:
+            continue
+        s, phi, X = basis.spherical_coordinates(pos, rs)
+        partial += fused_coefficients.STnlm_partial(
+                s, phi, X, np.ascontiguousarray(mass, dtype=np.float64), nmax,
+                lmax, var, kernel_chunk_size)
+        pmass = float(mass[-1])
+    return partial, pmass
+
+
+def _sphere_pass(snapname, galaxy, id_cut, center, rmax, chunk_size, nsample):
+    # mass weighted offset from center of the particles within rmax, and
+    # the (at most nsample) particles closest to center, which are all
+    # the particles within rload of center.
+    sums = np.zeros(4)
+    npart = 0
+    rload2 = np.inf
+    pos_kept, mass_kept, dist2_kept = np.empty((0, 3)), np.empty(0), np.empty(0)
+    for pos, mass, ids in iter_snap_chunks(
+            snapname, 'PartType1', ['Coordinates', 'Masses', 'ParticleIDs'],
+            chunk_size):
+        pos, mass = select_particles(pos, mass, ids, galaxy, id_cut)
+        dist2 = np.sum((pos-center)**2, axis=1)
+        inside = dist2 < rmax**2
+        sums[:3] += np.sum((pos[inside]-center)*mass[inside,None], axis=0)
+        sums[3] += np.sum(mass[inside])
+        npart += np.count_nonzero(inside)
+        keep = dist2 < rload2
+        pos_kept = np.concatenate([pos_kept, pos[keep]])
+        mass_kept = np.concatenate([mass_kept, mass[keep]])
+        dist2_kept = np.concatenate([dist2_kept, dist2[keep]])
+        if len(dist2_kept) > nsample:
+            rload2 = np.partition(dist2_kept, nsample)[nsample]
+            keep = dist2_kept < rload2
+            pos_kept, mass_kept, dist2_kept = pos_kept[keep], mass_kept[keep], dist2_kept[keep]
+    return sums, npart, (center, np.sqrt(rload2), pos_kept, mass_kept)
+
+
+def stream_com(snapname, galaxy=None, id_cut=None, chunk_size=1000000,
+               nsample=1000000, shrink_factor=0.9, min_particles=1000,
+               starting_rmax=500):
+    """
+    Center of mass of the host or the satellite with the shrinking sphere
+    used for the host by bfe.ios.io_snaps.read_snap_coordinates (pynbody
+    shrink_sphere_center with the same parameters): the center of mass of
+    all the particles, then of the particles within starting_rmax, with
+    the radius reduced by shrink_factor until the sphere has min_particles
+    or less.
+
+    Spheres are computed in passes over the snapshot, each pass also keeps
+    the nsample particles closest to its center. Once the next sphere is
+    inside the ball of the kept particles it is computed in memory, so the
+    memory is set by chunk_size and nsample.
+    """
+    center = np.zeros(3)
+    rmax = np.inf
+    loaded = None
+    npart = np.inf
+    iteration = 0
+    while npart > min_particles:
+        if (loaded is not None) and (np.sqrt(np.sum((center-loaded[0])**2)) + rmax <= loaded[1]):
+            offset = loaded[2] - center
+            inside = np.sum(offset**2, axis=1) < rmax**2
+            sums = np.append(np.sum(offset[inside]*loaded[3][inside,None], axis=0),
+                             np.sum(loaded[3][inside]))
+            npart = np.count_nonzero(inside)
+        else:
+            sums, npart, loaded = _sphere_pass(snapname, galaxy, id_cut, center,
+                                               rmax, chunk_size, nsample)
+        if npart == 0:
+            return center
+        center = center + sums[:3]/sums[3]
+        iteration += 1
+        rmax = rmax*shrink_factor if iteration > 1 else starting_rmax
+    return center
+
+
+def disk_com(snapname, chunk_size=1000000):
+    """
+    Host center from the minimum of the disk (PartType2) potential, as in
+    bfe.ios.io_snaps.read_snap_coordinates, or None if the snapshot has no
+    disk. The disk fields are small and read in full.
+    """
+    if snap_npart(snapname, 'PartType2') == 0:
+        return None
+    chunks = list(iter_snap_chunks(snapname, 'PartType2',
+                                   ['Coordinates', 'Velocities', 'Potential'], chunk_size))
+    pos, vel, pot = [np.concatenate([chunk[k] for chunk in chunks]) for k in range(3)]
+    return com_disk_potential(pos, vel, pot)[0]
+
+
+def stream_coefficients(snapname, rs, nmax, lmax, var=True, galaxy=None,
+                        N_host_particles=None, id_cut=None, rcom=None, rcut=0,
+                        chunk_size=1000000):
+    """
+    Computes the coefficients of a snapshot without loading it in memory.
+
+    Parameters:
+    -----------
+    snapname : str
+        Gadget-4 hdf5 file, or name of a snapshot written in several files
+        (see bfe.ios.gadget_reader.snap_files).
+    rs : float
+        Hernquist halo scale length
+    nmax : int
+    lmax : int
+    var : bool
+        If True also computes the variance terms of the coefficients.
+    galaxy : str
+        None uses all the particles, 'host' the particles with ids < id_cut
+        and 'sat' the particles with ids >= id_cut.
+    N_host_particles : int
+        Number of host particles, used to find id_cut if it is not given.
+    id_cut : int
+        ID of the first satellite particle.
+    rcom : numpy.ndarray
+        Center of the expansion. If None it is the center of the disk (see
+        disk_com) for the host if the snapshot has a disk, otherwise it is
+        computed with stream_com.
+    rcut : float
+        If > 0 only particles with r < rcut are used.
+    chunk_size : int
+        Number of particles read at once.
+
+    Returns:
+    --------
+    results : numpy.ndarray with the format of Coeff_parallel.main.
+    pmass : float
+        particle mass
+    rcom : numpy.ndarray
+        center of the expansion
+
+    """
+    if (galaxy is not None) & (id_cut is None):
+        id_cut = host_id_cut(snapname, N_host_particles)
+    if (rcom is None) & (galaxy != 'sat'):
+        rcom = disk_com(snapname, chunk_size)
+    if rcom is None:
+        rcom = stream_com(snapname, galaxy, id_cut, chunk_size)
+    partial, pmass = partial_coefficients(
+            snapname, rs, nmax, lmax, var, galaxy, id_cut, rcom, rcut,
+            chunk_size)
+    return fused_coefficients.coeff_results(nmax, lmax, *partial), pmass, rcom
@@ -0,0 +1,146 @@
+"""
+Tabulated radial basis functions.
+
+In xi = (s-1)/(s+1) the radial functions are polynomials:
+
+    Phi_nl = -s^l (1+s)^(-2l-1) C_n^(2l+3/2)(xi)
+           = -(1+xi)^l (1-xi)^(l+1) / 2^(2l+1) C_n^(2l+3/2)(xi)
+
+so they are smooth in -1 <= xi <= 1 and a cubic spline on a regular grid
+reproduces them to a given tolerance. The spline of all the (n,l)
+functions is built once, stored in a npz file per (nmax, lmax, tol) and
+loaded by any snapshot or process that needs the same expansion.
+
+"""
+
+import os
+import warnings
+import numpy as np
+from scipy import interpolate
+from bfe.coefficients import basis
+
+
+# Tables loaded by this process, see get_radial_table.
+_tables = {}
+
+
+def default_cache_dir():
+    return os.environ.get("BFE_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "bfe-py"))
+
+
+def radial_xi(nmax, lmax, xi):
+    """
+    Radial functions Phi_nl as a function of xi with shape
+    (nmax+1, lmax+1, len(xi)).
+    """
+    l = np.arange(lmax+1)[:,None]
+    power = -(1+xi)**l * (1-xi)**(l+1) / 2.**(2*l+1)
+    return basis.gegenbauer_table(nmax, lmax, xi) * power
+
+
+class RadialTable:
+    def __init__(self, nmax, lmax, tol=1e-8, cache_dir=None, cache=True,
+                 npoints=256, max_npoints=2**14+1):
+        """
+        Cubic spline of the radial functions Phi_nl(xi).
+
+        Parameters:
+        -----------
+        nmax : int
+        lmax : int
+        tol : float
+            Maximum relative error of every (n,l) function: the error of
+            the spline at the middle of the grid intervals divided by the
+            maximum of |Phi_nl| of that (n,l), so the functions with a
+            small amplitude (large l) get the same relative accuracy as
+            the others.
+        cache_dir : str
+            Directory of the npz files, by default $BFE_CACHE_DIR or
+            ~/.cache/bfe-py
+        cache : bool
+            If False the table is neither read from nor written to disk.
+        npoints : int
+            Initial number of grid points, doubled until tol is reached.
+        max_npoints : int
+            Maximum number of grid points. The spline uses
+            32*max_npoints*(nmax+1)*(lmax+1) bytes, the error of a cubic
+            spline decreases as npoints**-4.
+
+        Attributes:
+        -----------
+        error : numpy.ndarray with shape (nmax+1, lmax+1)
+            relative error of each (n,l) function reached by the table.
+
+        """
+        self.nmax = nmax
+        self.lmax = lmax
+        self.tol = tol
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        filename = os.path.join(cache_dir, "radial_table_n{:d}_l{:d}_rtol{:.1e}.npz".format(
+                                nmax, lmax, tol))
+        if cache & os.path.isfile(filename):
+            table = np.load(filename)
+            xi, c, error = table['xi'], table['c'], table['error']
+        else:
+            xi, c, error = self.build(npoints, max_npoints)
+            if cache == True:
+                os.makedirs(cache_dir, exist_ok=True)
+                # written to a temporary file first so other processes
+                # never read a partial table
+                tmp = filename + ".{:d}.tmp.npz".format(os.getpid())
+                np.savez(tmp, xi=xi, c=c, error=error)
+                os.replace(tmp, filename)
+        self.spline = interpolate.PPoly(c, xi)
+        self.npoints = len(xi)
+        self.error = error.reshape(nmax+1, lmax+1)
+
+    def build(self, npoints, max_npoints):
+        ncols = (self.nmax+1)*(self.lmax+1)
+        while True:
+            xi = np.linspace(-1, 1, npoints)
+            values = radial_xi(self.nmax, self.lmax, xi).reshape(ncols, npoints).T
+            spline = interpolate.CubicSpline(xi, values, axis=0)
+            xi_mid = 0.5*(xi[1:] + xi[:-1])
+            exact = radial_xi(self.nmax, self.lmax, xi_mid).reshape(ncols, -1).T
+            # error of each (n,l) relative to its own amplitude
+            scale = np.max(np.abs(values), axis=0)
+            error = np.max(np.abs(spline(xi_mid) - exact), axis=0) / scale
+            if np.max(error) < self.tol:
+                return xi, spline.c, error
+            if 2*npoints - 1 > max_npoints:
+                n, l = np.unravel_index(np.argmax(error), (self.nmax+1, self.lmax+1))
+                warnings.warn("RadialTable: tol={:.1e} not reached with {:d} points, "
+                              "the maximum relative error is {:.1e} at n={:d}, l={:d}".format(
+                              self.tol, npoints, np.max(error), n, l))
+                return xi, spline.c, error
+            npoints = 2*npoints - 1
+
+    def radial(self, s):
+        """
+        Phi_nl(s) with shape (nmax+1, lmax+1, len(s)), the same as
+        basis.radial_table.
+        """
+        xi = (s-1) / (s+1)
+        return self.spline(xi).T.reshape(self.nmax+1, self.lmax+1, len(s))
+
+    def density(self, s):
+        """
+        Radial part of the density basis functions
+        rho_nl = -Knl/(2 pi s (1+s)^2) Phi_nl with shape
+        (nmax+1, lmax+1, len(s)).
+        """
+        Knl = basis.Knl(self.nmax, self.lmax)[:,:,None]
+        return -Knl/(2*np.pi*s*(1+s)**2) * self.radial(s)
+
+
+def get_radial_table(nmax, lmax, tol):
+    """
+    RadialTable of this process for (nmax, lmax, tol). Workers of a pool
+    only receive tol and load the table from the cache once.
+    """
+    key = (nmax, lmax, tol)
+    if key not in _tables:
+        _tables[key] = RadialTable(nmax, lmax, tol)
+    return _tables[key]
@@ -0,0 +1,171 @@
+"""
+Memory mapped reader of Gadget-2 binary snapshots (snapformat=1).
+
+A Gadget-2 snapshot is a sequence of Fortran records (int32 size, data,
+int32 size): the 256 bytes header and then one block per quantity (POS,
+VEL, ID, MASS, ...) with the particles ordered by particle type. In format
+2 every block is preceded by an 8 bytes record with its 4 characters name.
+The reader only walks the record markers to find the offset of each block,
+the blocks are then np.memmap views of the file, so selecting particles
+only reads the pages that are touched and nothing is copied.
+
+In format 1 the blocks have no names and they are identified by their
+order and size: POS, VEL, ID, MASS (only if a particle type has no mass in
+the header), the gas blocks (U, RHO, NE, NH, HSML, SFR) and POT and ACCE
+for all the particles.
+
+"""
+
+import numpy as np
+
+
+HEADER = np.dtype([('npart', 'i4', 6), ('massarr', 'f8', 6), ('time', 'f8'),
+                   ('redshift', 'f8'), ('flag_sfr', 'i4'),
+                   ('flag_feedback', 'i4'), ('npartTotal', 'u4', 6),
+                   ('flag_cooling', 'i4'), ('num_files', 'i4'),
+                   ('BoxSize', 'f8'), ('Omega0', 'f8'), ('OmegaLambda', 'f8'),
+                   ('HubbleParam', 'f8'), ('fill', 'u1', 96)])
+
+# load_snapshot names of the blocks and particle types
+BLOCKS = {'pos':'POS', 'vel':'VEL', 'pid':'ID', 'mass':'MASS', 'pot':'POT',
+          'acc':'ACCE'}
+PTYPES = {'gas':0, 'dm':1, 'disk':2, 'bulge':3}
+GAS_BLOCKS = ['U', 'RHO', 'NE', 'NH', 'HSML', 'SFR']
+VECTOR_BLOCKS = ['POS', 'VEL', 'ACCE']
+
+
+class GadgetBinary:
+    def __init__(self, snapname):
+        """
+        Parameters:
+        -----------
+        snapname : str
+            path and name of the snapshot file.
+
+        Attributes:
+        -----------
+        header : dict
+            npart, massarr, time, redshift, ... of the header.
+        blocks : dict
+            name : (offset, dtype, shape, particle types in the block)
+
+        """
+        self.snapname = snapname
+        with open(snapname, 'rb') as f:
+            first = np.fromfile(f, dtype='<i4', count=1)[0]
+        # the first record is the header (256 bytes) in format 1 and the
+        # name of the header block (8 bytes) in format 2
+        if first in (8, 256):
+            self.endian = '<'
+        elif first.byteswap() in (8, 256):
+            self.endian = '>'
+            first = first.byteswap()
+        else:
+            raise ValueError('{} is not a Gadget-2 snapshot'.format(snapname))
+        self.snapformat = 2 if first == 8 else 1
+        self.blocks = {}
+        self._maps = {}
+        self._scan()
+
+    def _records(self):
+        # (name, offset, size) of the records of the file
+        marker = np.dtype(self.endian+'i4')
+        with open(self.snapname, 'rb') as f:
+            f.seek(0, 2)
+            end = f.tell()
+            f.seek(0)
+            name = None
+            while f.tell() < end:
+                size = int(np.frombuffer(f.read(4), dtype=marker)[0])
+                offset = f.tell()
+                if self.snapformat == 2 and name is None:
+                    name = f.read(4).decode('ascii').strip()
+                    f.seek(offset + size + 4)
+                    continue
+                f.seek(offset + size)
+                if int(np.frombuffer(f.read(4), dtype=marker)[0]) != size:
+                    raise ValueError('Corrupted block at byte {} of {}'.format(offset, self.snapname))
+                yield name, offset, size
+                name = None
+
+    def _scan(self):
+        records = self._records()
+        name, offset, size = next(records)
+        header = np.fromfile(self.snapname, dtype=HEADER.newbyteorder(self.endian),
+                             count=1, offset=offset)[0]
+        self.header = {key:header[key] for key in HEADER.names if key != 'fill'}
+        npart = self.header['npart'].astype(np.int64)
+        massarr = self.header['massarr']
+        ptypes_all = np.where(npart > 0)[0]
+        ptypes_mass = np.where((npart > 0) & (massarr == 0))[0]
+        n_all = np.sum(npart)
+
+        order = ['POS', 'VEL', 'ID']
+        if len(ptypes_mass) > 0:
+            order.append('MASS')
+        gas = 0
+        for name, offset, size in records:
+            if name is None:
+                # format 1: blocks identified by their order and size
+                if len(order) > 0:
+                    name = order.pop(0)
+                elif (npart[0] > 0) & (gas < len(GAS_BLOCKS)) & \
+                        (size in (4*npart[0], 8*npart[0])) & ('POT' not in self.blocks):
+                    name = GAS_BLOCKS[gas]
+                    gas += 1
+                elif (size == 4*n_all or size == 8*n_all) and 'POT' not in self.blocks:
+                    name = 'POT'
+                else:
+                    name = 'ACCE'
+            if name == 'MASS':
+                ptypes = ptypes_mass
+            elif name in GAS_BLOCKS:
+                ptypes = np.array([0])
+            else:
+                ptypes = ptypes_all
+            n = np.sum(npart[ptypes])
+            dim = 3 if name in VECTOR_BLOCKS else 1
+            itemsize = size // (n*dim)
+            if name == 'ID':
+                dtype = 'u4' if itemsize == 4 else 'u8'
+            else:
+                dtype = 'f4' if itemsize == 4 else 'f8'
+            shape = (n, 3) if dim == 3 else (n,)
+            self.blocks[name] = (offset, np.dtype(self.endian+dtype), shape, ptypes)
+
+    def block(self, name):
+        """
+        Full block as a read only np.memmap.
+        """
+        if name not in self._maps:
+            offset, dtype, shape, ptypes = self.blocks[name]
+            self._maps[name] = np.memmap(self.snapname, dtype=dtype, mode='r',
+                                         offset=offset, shape=shape)
+        return self._maps[name]
+
+    def read(self, quantity, ptype):
+        """
+        Quantity of a particle type as a view of the file.
+
+        Parameters:
+        -----------
+        quantity : str
+            pos, vel, mass, pot, pid, acc (or a block name)
+        ptype : str
+            gas, dm, disk, bulge
+
+        Returns:
+        --------
+        numpy.ndarray (np.memmap) or the header masses if the particle
+        type has no MASS block.
+
+        """
+        name = BLOCKS.get(quantity, quantity)
+        p = PTYPES.get(ptype, ptype)
+        npart = self.header['npart'].astype(np.int64)
+        if (name == 'MASS') & (self.header['massarr'][p] != 0):
+            return np.full(npart[p], self.header['massarr'][p])
+        offset, dtype, shape, ptypes = self.blocks[name]
+        assert p in ptypes, 'particle type {} is not in block {}'.format(ptype, name)
+        start = np.sum(npart[ptypes[ptypes < p]])
+        return self.block(name)[start:start+npart[p]]
@@ -5,8 +5,10 @@ Nico Garavito-Camargo 2021
 
 """
 
+import os
 import numpy 
 import h5py
+from bfe.ios.multifile import subfiles
 
 def read_snap(snap_name, partType, properties):
 	"""
@@ -29,6 +31,86 @@ def read_snap(snap_name, partType, properties):
 	return part_prop
 
 
+def snap_files(snap_name):
+	"""
+	Files of a snapshot: [snap_name] if it is a file, otherwise the files
+	of the snapshot snap_name (without the .hdf5 extension) written in
+	one or several files (see bfe.ios.multifile.subfiles).
+	"""
+	if os.path.isfile(snap_name):
+		return [snap_name]
+	return subfiles(snap_name)
+
+
+def _file_npart(f, partType):
+	# number of particles of partType in an open file
+	if partType not in f:
+		return 0
+	keys = list(f[partType].keys())
+	return f[partType][keys[0]].shape[0] if keys else 0
+
+
+def _table_mass(f, partType, n):
+	# Gadget stores the mass of particle types with equal masses in the
+	# header MassTable instead of a Masses dataset
+	ptype_number = int(partType[len('PartType'):])
+	return numpy.full(n, f['Header'].attrs['MassTable'][ptype_number])
+
+
+def snap_npart(snap_name, partType):
+	"""
+	Number of particles of partType in all the files of a snapshot.
+	"""
+	npart = 0
+	for filename in snap_files(snap_name):
+		with h5py.File(filename, 'r') as f:
+			npart += _file_npart(f, partType)
+	return npart
+
+
+def iter_snap_chunks(snap_name, partType, properties, chunk_size, start=0, stop=None):
+	"""
+	Iterates over a snapshot in chunks of particles. Only one chunk of each
+	property is in memory at a time.
+
+	snap_name : str
+		 hdf5 file or name of a snapshot written in several files (see
+		 snap_files), the particles are numbered in file order.
+	partType: str
+		 PartType1, PartType2, following Gadget's convention of particles types
+	properties : list
+		 list of properties e.g ['Coordinates', 'Masses', 'ParticleIDs'],
+		 Masses is taken from the header MassTable if the file has no
+		 Masses dataset.
+	chunk_size : int
+		 number of particles per chunk, chunks do not cross files.
+	start, stop : int
+		 range of particles to iterate over, by default all the particles.
+
+	yields:
+
+	list of numpy arrays with the properties of the particles in the chunk
+
+	"""
+
+	offset = 0
+	for filename in snap_files(snap_name):
+		with h5py.File(filename, 'r') as f:
+			n = _file_npart(f, partType)
+			first = max(start - offset, 0)
+			last = n if stop is None else min(stop - offset, n)
+			offset += n
+			if first >= last:
+				continue
+			particles = f[partType]
+			for i in range(first, last, chunk_size):
+				j = min(i+chunk_size, last)
+				yield [_table_mass(f, partType, j-i) if (prop == 'Masses') and (prop not in particles)
+				       else particles[prop][i:j] for prop in properties]
+		if (stop is not None) and (offset >= stop):
+			return
+
+
 def read_header(snap_name):
 	## time 
 	## 
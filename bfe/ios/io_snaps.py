@@ -1,7 +1,7 @@
 import numpy as np
 import h5py
-from bfe.ios.read_snap import load_snapshot as readsnap
-from bfe.ios.gadget_reader import is_parttype_in_file
+from bfe.ios.snapshot import Snapshot
+from bfe.ios.selection import IdSelection, host_id_cut
 import bfe.ios.com as com
 from pynbody.analysis._com import shrink_sphere_center as ssc
 
@@ -16,7 +16,7 @@ def reshape_matrix(matrix, nmax, lmax, mmax):
     return col_matrix
 
 
-def host_particles(xyz, vxyz, pids, pot, mass, N_host_particles):
+def host_particles(xyz, vxyz, pids, pot, mass, N_host_particles, id_cut=None):
     """
     Function that return the host and the sat particles
     positions and velocities.
@@ -27,19 +27,21 @@ def host_particles(xyz, vxyz, pids, pot, mass, N_host_particles):
     vxys: snapshot velocities with shape (n,3)
     pids: particles ids
     Nhost_particles: Number of host particles in the snapshot
+    id_cut: ID of the first satellite particle, found with
+        selection.host_id_cut if not given.
     
     Returns:
     --------
     xyz, vxyz, ids, pot, mass.
 
     """
-    sort_indexes = np.sort(pids)
-    N_cut = sort_indexes[N_host_particles]
-    host_ids = np.where(pids<N_cut)[0]
+    if id_cut is None:
+        id_cut = host_id_cut(pids, N_host_particles)
+    host_ids = np.where(pids<id_cut)[0]
     return xyz[host_ids], vxyz[host_ids], pids[host_ids], pot[host_ids], mass[host_ids]
 
 
-def sat_particles(xyz, vxyz, pids, pot, mass, Nhost_particles):
+def sat_particles(xyz, vxyz, pids, pot, mass, Nhost_particles, id_cut=None):
     """
     Function that return the host and the sat particles
     positions and velocities.
@@ -50,17 +52,29 @@ def sat_particles(xyz, vxyz, pids, pot, mass, Nhost_particles):
     vxys: snapshot velocities with shape (n,3)
     pids: particles ids
     Nhost_particles: Number of host particles in the snapshot
+    id_cut: ID of the first satellite particle, found with
+        selection.host_id_cut if not given.
     Returns:
     --------
     xyz, vxyz, ids, pot, mass.
 
     """
-    sort_indexes = np.sort(pids)
-    N_cut = sort_indexes[Nhost_particles]
-    sat_ids = np.where(pids>=N_cut)[0]
+    if id_cut is None:
+        id_cut = host_id_cut(pids, Nhost_particles)
+    sat_ids = np.where(pids>=id_cut)[0]
     return xyz[sat_ids], vxyz[sat_ids], pids[sat_ids], pot[sat_ids], mass[sat_ids]
 
-def read_snap_coordinates(path, snap, N_halo_part, com_frame='host', galaxy='host', snapformat=3):
+def disk_com(snapshot):
+    """
+    Position and velocity of the host center from the minimum of the disk
+    (PartType2) potential of a bfe.ios.Snapshot.
+    """
+    return com.com_disk_potential(snapshot.get('pos', 'disk'), snapshot.get('vel', 'disk'),
+                                  snapshot.get('pot', 'disk'))
+
+
+def read_snap_coordinates(path, snap, N_halo_part, com_frame='host', galaxy='host', snapformat=3,
+                          selection=None, snapshot=None):
     """
     Returns the MW properties.
     
@@ -79,6 +93,14 @@ def read_snap_coordinates(path, snap, N_halo_part, com_frame='host', galaxy='hos
         satellite (sat), or in the LSR (LSR)
     galaxy : str
         galaxy coordinates to be returned (MW) or (sat)
+    selection : bfe.ios.selection.IdSelection
+        host/satellite ID cut of the simulation, derived from the IDs of
+        this snapshot if not given. Only the particles of the galaxy are
+        read.
+    snapshot : bfe.ios.Snapshot
+        snapshot already opened (and loaded, see Snapshot.load) by the
+        caller, shared by several calls. By default path+snap is opened and
+        closed here.
     Returns:
     --------
     MWpos : 
@@ -87,40 +109,35 @@ def read_snap_coordinates(path, snap, N_halo_part, com_frame='host', galaxy='hos
     MWmass : 
     
     """
-    # Load data
+    # Load data, the file is opened once
     print("Loading snapshot: "+path+snap)
-    all_pos = readsnap(path+snap, snapformat, 'pos', 'dm')
-    all_vel = readsnap(path+snap, snapformat, 'vel', 'dm')
-    all_ids = readsnap(path+snap, snapformat, 'pid', 'dm')
-    all_pot = readsnap(path+snap, snapformat, 'pot', 'dm')
-    all_mass = readsnap(path+snap, snapformat, 'mass', 'dm')
-
+    close_snapshot = snapshot is None
+    if close_snapshot:
+        snapshot = Snapshot(path+snap, snapformat)
+    all_ids = snapshot.get('pid', 'dm')
+    if selection is None:
+        selection = IdSelection.from_pids(all_ids, N_halo_part)
+    disk_particles = snapshot.has_parttype('disk')
+
+    def galaxy_particles(galaxy):
+        index = selection.index(all_ids, galaxy)
+        return [snapshot.get(quantity, 'dm', index) for quantity in ['pos', 'vel', 'pid', 'pot', 'mass']]
 
-    
-    
     print("Loading MW particles and LMC particles")
 
     if galaxy == 'host':
         print("Loading host particle")
-        pos, vel, ids, pot, mass = host_particles(all_pos, all_vel, all_ids, all_pot, all_mass, N_halo_part)
+        pos, vel, ids, pot, mass = galaxy_particles('host')
 
     elif galaxy == 'sat':
         print("Loading satellite particles")
-        pos, vel, ids, pot, mass = sat_particles(all_pos, all_vel, all_ids, all_pot, all_mass, N_halo_part)
+        pos, vel, ids, pot, mass = galaxy_particles('sat')
 
     if com_frame == 'host': 
         print("Computing coordinates in the hots's COM frame")
-        disk_particles = is_parttype_in_file(path+snap+".hdf5", 'PartType2')
-
         if disk_particles == True:
             print("* Computing host COM using minimum of the disk potential with partype: {}".format("PartType2"))
-            pos_disk = readsnap(path+snap, snapformat,  'pos', 'disk')
-            vel_disk = readsnap(path+snap, snapformat,  'vel', 'disk')
-            pot_disk = readsnap(path+snap, snapformat, 'pot', 'disk')
-            pos_cm, vel_cm = com.com_disk_potential(pos_disk, vel_disk, pot_disk)
-            del pos_disk
-            del vel_disk
-            del pot_disk
+            pos_cm, vel_cm = disk_com(snapshot)
         else:
             print("* Computing host COM using shrinking sphere in  partype: {}".format("PartType1"))
             pos_cm = ssc(np.ascontiguousarray(pos, dtype=float), np.ascontiguousarray(mass, dtype=float), min_particles=1000, shrink_factor=0.9, starting_rmax=500, num_threads=2)
@@ -132,7 +149,7 @@ def read_snap_coordinates(path, snap, N_halo_part, com_frame='host', galaxy='hos
     elif com_frame == 'sat':
         print('Computing coordinates in the satellite COM frame')
         if galaxy == 'host':
-            LMC_pos, LMC_vel, LMC_ids, LMC_pot, LMC_mass = sat_particles(all_pos, all_vel, all_ids, all_pot, all_mass, N_halo_part)
+            LMC_pos, LMC_vel, LMC_ids, LMC_pot, LMC_mass = galaxy_particles('sat')
             pos_cm, vel_cm  = com.CM(LMC_pos, LMC_vel, LMC_mass)
         else:
             # TODO: organize this method in a function
@@ -193,9 +210,9 @@ def read_snap_coordinates(path, snap, N_halo_part, com_frame='host', galaxy='hos
         print('Computing coordinates in the LSR frame')
         if disk_particles == True:
             print("Computing host COM with partype: {}".format("PartType2"))
-            pos_disk = readsnap(path+snap, snapformat, 'pos', 'disk')
-            vel_disk = readsnap(path+snap, snapformat, 'vel', 'disk')
-            pot_disk = readsnap(path+snap, snapformat, 'pot', 'disk')
+            pos_disk = snapshot.get('pos', 'disk')
+            vel_disk = snapshot.get('vel', 'disk')
+            pot_disk = snapshot.get('pot', 'disk')
             pos_cm, vel_cm = com.com_disk_potential(pos_disk, vel_disk, pot_disk)
             del pos_disk
             del vel_disk
@@ -215,11 +232,9 @@ def read_snap_coordinates(path, snap, N_halo_part, com_frame='host', galaxy='hos
     vel_new = com.re_center(vel, vel_cm)
     del pos
     del vel
-    del all_pos
-    del all_vel
-    del all_pot
-    del all_mass
     del all_ids
+    if close_snapshot:
+        snapshot.close()
     return pos_new, vel_new, pot, mass, ids, pos_cm, vel_cm
     
 
@@ -0,0 +1,126 @@
+"""
+Parallel reader of Gadget-4 snapshots written in several files.
+
+Large runs write snap_XXX.0.hdf5 ... snap_XXX.N.hdf5. The particles of a
+particle type are stored in file order, file i holds NumPart_ThisFile
+particles of each type, so the offset of every file in the full arrays is
+known from the headers alone. The full arrays are allocated once in shared
+memory and the workers of a pool read one file each and write their
+particles directly into their part of the arrays, so the files are read
+concurrently and no array is copied or concatenated afterwards.
+
+"""
+
+import os
+import numpy as np
+import h5py
+import schwimmbad
+
+
+def subfiles(snapname):
+    """
+    Files of a snapshot: [snapname.hdf5] for a single file snapshot or
+    snapname.i.hdf5 for i < NumFilesPerSnapshot.
+    """
+    if os.path.isfile(snapname+".hdf5"):
+        return [snapname+".hdf5"]
+    with h5py.File(snapname+".0.hdf5", 'r') as f:
+        nfiles = int(f['Header'].attrs['NumFilesPerSnapshot'])
+    return [snapname+".{:d}.hdf5".format(i) for i in range(nfiles)]
+
+
+def particles_per_file(files, partType):
+    """
+    NumPart_ThisFile of partType ('PartType1', ...) in every file.
+    """
+    ptype_number = int(partType[len('PartType'):])
+    counts = np.zeros(len(files), dtype=np.int64)
+    for i, filename in enumerate(files):
+        with h5py.File(filename, 'r') as f:
+            counts[i] = f['Header'].attrs['NumPart_ThisFile'][ptype_number]
+    return counts
+
+
+class ParallelReader:
+    def __init__(self, files, partType, properties, counts=None):
+        """
+        Reads properties of partType from all the files of a snapshot into
+        shared memory arrays.
+
+        Parameters:
+        -----------
+        files : list
+            files of the snapshot, see subfiles.
+        partType : str
+            PartType1, PartType2, ...
+        properties : list
+            hdf5 names of the datasets, e.g ['Coordinates', 'ParticleIDs']
+        counts : numpy.ndarray
+            NumPart_ThisFile of partType in each file, read from the
+            headers if not given.
+
+        Attributes:
+        -----------
+        output : SharedArrays
+            property : numpy.ndarray with all the particles in file order.
+
+        """
+        # bfe.coefficients imports bfe.ios
+        from bfe.coefficients.shared_arrays import SharedArrays
+        self.files = files
+        self.partType = partType
+        self.properties = properties
+        if counts is None:
+            counts = particles_per_file(files, partType)
+        self.counts = counts
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        # shape and dtype of each property from the first file with particles
+        first = files[int(np.argmax(counts > 0))]
+        shapes = {}
+        with h5py.File(first, 'r') as f:
+            for prop in properties:
+                dset = f[partType][prop]
+                shapes[prop] = ((self.offsets[-1],) + dset.shape[1:], dset.dtype)
+        self.output = SharedArrays.empty(shapes)
+
+    def read_file(self, task):
+        """
+        Writes the particles of file task into the shared arrays.
+        """
+        start, stop = self.offsets[task], self.offsets[task+1]
+        if stop == start:
+            return 0
+        with h5py.File(self.files[task], 'r') as f:
+            particles = f[self.partType]
+            for prop in self.properties:
+                particles[prop].read_direct(self.output[prop], dest_sel=np.s_[start:stop])
+        return 0
+
+    def main(self, pool):
+        """
+        Reads the files in parallel, one file per task.
+
+        Returns:
+        --------
+        output : SharedArrays
+            release it (or the Snapshot that owns it) when the arrays are
+            not needed anymore.
+
+        """
+        list(pool.map(self.read_file, range(len(self.files))))
+        pool.close()
+        return self.output
+
+
+def read_snap_files(snapname, partType, prop, nreaders=1):
+    """
+    Single property of a multi-file snapshot as a numpy array (the
+    multi-file counterpart of gadget_reader.read_snap). The shared block
+    is copied once and released.
+    """
+    files = subfiles(snapname)
+    reader = ParallelReader(files, partType, [prop])
+    output = reader.main(schwimmbad.choose_pool(mpi=False, processes=nreaders))
+    q = output[prop].copy()
+    output.release()
+    return q
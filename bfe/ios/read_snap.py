@@ -1,12 +1,15 @@
 import numpy as np
-#from pygadgetreader import readsnap
 import sys
+import os
 from bfe.ios.gadget_reader import read_snap
+from bfe.ios.multifile import read_snap_files
+from bfe.ios.gadget2_reader import GadgetBinary
 
 def load_snapshot(snapname, snapformat, quantity, ptype):
 
 	if snapformat == 1:
-		q = readsnap(snapname, quantity, ptype)
+		# memory mapped, only the particles that are used are read
+		q = GadgetBinary(snapname).read(quantity, ptype)
 
 	elif snapformat == 3:
 		if quantity == 'pos':
@@ -34,7 +37,11 @@ def load_snapshot(snapname, snapformat, quantity, ptype):
 		if ptype == "bulge":
 			ptype =	'PartType3'
 			
-		q = read_snap(snapname+".hdf5", ptype, q)
+		if os.path.isfile(snapname+".hdf5"):
+			q = read_snap(snapname+".hdf5", ptype, q)
+		else:
+			# snapname.0.hdf5, snapname.1.hdf5, ...
+			q = read_snap_files(snapname, ptype, q)
 		#a = read_snap(snapname, 'PartType1', 'Acceleration')
 		#potential = read_snap(snapname, 'PartType1', 'Potential')
 		#print(mass[0], a[0], potential[0])
@@ -0,0 +1,130 @@
+"""
+Selection of the host and satellite particles by particle ID.
+
+The host particles are the N_host_particles particles with the smallest
+IDs, i.e. the particles with ID < id_cut. id_cut is the same for every
+snapshot of a simulation, so it is found once with np.partition (instead of
+sorting all the IDs) and stored in a sidecar yaml file next to the
+outputs. The selection of a snapshot is then a single comparison, or a
+slice if the host particles are stored first in the file, in which case
+only the part of each dataset that is needed is read.
+
+"""
+
+import os
+import numpy as np
+import yaml
+
+
+def host_id_cut(pids, N_host_particles):
+    """
+    ID of the first satellite particle, equivalent to
+    np.sort(pids)[N_host_particles] without the full sort.
+    """
+    return np.partition(pids, N_host_particles)[N_host_particles]
+
+
+class IdSelection:
+    def __init__(self, id_cut, N_host_particles, ordered=False):
+        """
+        Parameters:
+        -----------
+        id_cut : int
+            ID of the first satellite particle, host particles have
+            ID < id_cut.
+        N_host_particles : int
+        ordered : bool
+            True if the host particles are the first N_host_particles
+            particles of the snapshots. It is checked on every snapshot
+            with the IDs, the particles are selected with a comparison if
+            a snapshot is not ordered.
+
+        """
+        self.id_cut = int(id_cut)
+        self.N_host_particles = int(N_host_particles)
+        self.ordered = bool(ordered)
+
+    @classmethod
+    def from_pids(cls, pids, N_host_particles):
+        """
+        Selection from the IDs of a snapshot.
+        """
+        id_cut = host_id_cut(pids, N_host_particles)
+        ordered = bool(np.all(pids[:N_host_particles] < id_cut))
+        return cls(id_cut, N_host_particles, ordered)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, N_host_particles, filename=None):
+        """
+        Selection stored in filename if it exists and matches
+        N_host_particles, otherwise it is derived from the IDs of the
+        snapshot (a bfe.ios.Snapshot) and written to filename.
+        """
+        selection = cls._stored(filename, N_host_particles)
+        if selection is None:
+            selection = cls.from_pids(snapshot.get('pid', 'dm'), N_host_particles)
+            if filename is not None:
+                selection.write(filename)
+        return selection
+
+    @classmethod
+    def from_chunks(cls, snapname, N_host_particles, filename=None, chunk_size=1000000):
+        """
+        Same as from_snapshot but the IDs of the snapshot (a hdf5 file or
+        the name of a multi-file snapshot) are read in chunks of
+        chunk_size, the full array of IDs is never loaded.
+        """
+        # bfe.coefficients imports bfe.ios
+        from bfe.coefficients.stream_coefficients import host_id_cut as stream_id_cut
+        from bfe.ios.gadget_reader import iter_snap_chunks
+        selection = cls._stored(filename, N_host_particles)
+        if selection is None:
+            id_cut = stream_id_cut(snapname, N_host_particles, chunk_size=chunk_size)
+            ordered = True
+            offset = 0
+            for (ids,) in iter_snap_chunks(snapname, 'PartType1', ['ParticleIDs'], chunk_size):
+                host = np.arange(offset, offset+len(ids)) < N_host_particles
+                ordered &= bool(np.all((ids < id_cut) == host))
+                offset += len(ids)
+            selection = cls(id_cut, N_host_particles, ordered)
+            if filename is not None:
+                selection.write(filename)
+        return selection
+
+    @classmethod
+    def _stored(cls, filename, N_host_particles):
+        # selection of the sidecar file if it exists and matches N_host_particles
+        if (filename is not None) and os.path.isfile(filename):
+            selection = cls.read(filename)
+            if selection.N_host_particles == N_host_particles:
+                return selection
+        return None
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename) as f:
+            d = yaml.safe_load(f)
+        return cls(d["hostIdCut"], d["npartHalo"], d["ordered"])
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            yaml.safe_dump({"hostIdCut":self.id_cut,
+                            "npartHalo":self.N_host_particles,
+                            "ordered":self.ordered}, f)
+
+    def index(self, pids, galaxy):
+        """
+        Particles of galaxy ('host' or 'sat') in a snapshot with IDs pids.
+
+        Returns:
+        --------
+        index : slice if the snapshot is ordered, otherwise numpy.ndarray
+
+        """
+        n = self.N_host_particles
+        if self.ordered:
+            if np.all(pids[:n] < self.id_cut) & np.all(pids[n:] >= self.id_cut):
+                return slice(0, n) if galaxy == 'host' else slice(n, None)
+        if galaxy == 'host':
+            return np.where(pids < self.id_cut)[0]
+        return np.where(pids >= self.id_cut)[0]
@@ -0,0 +1,240 @@
+"""
+Snapshot opened once with its fields loaded on demand.
+
+read_snap_coordinates used to call load_snapshot for every field, and
+every call opened the hdf5 file again. A Snapshot opens the file once,
+reads the header and the particle types present in the file, and loads each
+field when it is first needed. Subsets of a field (slices or index arrays)
+are read from the file without loading the full dataset.
+
+Snapshots written in several files (snapname.0.hdf5, snapname.1.hdf5, ...)
+are read with bfe.ios.multifile, one file per process.
+
+"""
+
+import os
+import numpy as np
+import h5py
+import schwimmbad
+from bfe.ios.read_snap import load_snapshot
+from bfe.ios.multifile import subfiles, particles_per_file, ParallelReader
+from bfe.ios.gadget2_reader import GadgetBinary
+
+
+# load_snapshot names of the quantities and particle types in Gadget-4
+# hdf5 files.
+FIELDS = {'pos':'Coordinates', 'vel':'Velocities', 'mass':'Masses',
+          'pot':'Potential', 'pid':'ParticleIDs', 'acc':'Acceleration'}
+PARTTYPES = {'gas':'PartType0', 'dm':'PartType1', 'disk':'PartType2',
+             'bulge':'PartType3'}
+
+
+class Snapshot:
+    def __init__(self, snapname, snapformat=3, cache=True, nreaders=1):
+        """
+        Parameters:
+        -----------
+        snapname : str
+            path and name of the snapshot without the .hdf5 extension (as
+            in load_snapshot).
+        snapformat : int
+            (1) Gadget2/3 binary or (3) Gadget4 (HDF5). The fields of
+            format 1 snapshots are memory mapped views of the file.
+        cache : bool
+            If True the full fields read with get are kept in memory.
+        nreaders : int
+            number of processes that read the files of a multi-file
+            snapshot.
+
+        Attributes:
+        -----------
+        header : dict
+            attributes of the Header group.
+        npart : dict
+            number of particles of each particle type in the file.
+        files : list
+            files of the snapshot.
+
+        """
+        self.snapname = snapname
+        self.snapformat = snapformat
+        self.cache = cache
+        self.nreaders = nreaders
+        self.fields = {}
+        self.file = None
+        self.header = {}
+        self.npart = {}
+        self.files = [snapname+".hdf5"]
+        self.multifile = False
+        self._counts = {}
+        self._shared = []
+        if (snapformat == 3) & (not os.path.isfile(snapname+".hdf5")) & os.path.isfile(snapname+".0.hdf5"):
+            self.multifile = True
+            self.files = subfiles(snapname)
+            with h5py.File(self.files[0], 'r') as f:
+                self.header = dict(f['Header'].attrs)
+            for i in range(len(self.header['NumPart_ThisFile'])):
+                ptype = 'PartType{:d}'.format(i)
+                counts = particles_per_file(self.files, ptype)
+                if np.sum(counts) > 0:
+                    self._counts[ptype] = counts
+                    self.npart[ptype] = int(np.sum(counts))
+        elif snapformat == 1:
+            self.binary = GadgetBinary(snapname)
+            self.files = [snapname]
+            self.header = self.binary.header
+            for p in np.where(self.header['npart'] > 0)[0]:
+                self.npart['PartType{:d}'.format(p)] = int(self.header['npart'][p])
+        elif snapformat == 3:
+            self.file = h5py.File(snapname+".hdf5", 'r')
+            if 'Header' in self.file:
+                self.header = dict(self.file['Header'].attrs)
+            for ptype in self.file.keys():
+                if ptype.startswith('PartType'):
+                    group = self.file[ptype]
+                    keys = list(group.keys())
+                    self.npart[ptype] = group[keys[0]].shape[0] if keys else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Closes the file and drops the cached fields.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.fields = {}
+        for shared in self._shared:
+            shared.release()
+        self._shared = []
+
+    def has_parttype(self, ptype):
+        """
+        True if the particle type ('dm', 'disk', ... or 'PartTypeX') is in
+        the snapshot.
+        """
+        if self.snapformat not in (1, 3):
+            return True
+        return PARTTYPES.get(ptype, ptype) in self.npart
+
+    def load(self, quantities, ptype='dm'):
+        """
+        Reads and caches the full fields so that every later get (with
+        or without index) is served from memory, e.g. when the host and
+        the satellite are both selected from the same snapshot.
+        """
+        if self.multifile:
+            # all the quantities are read in one pass over the files
+            missing = [q for q in quantities if (q, ptype) not in self.fields]
+            self.fields.update(self._read_files(missing, ptype))
+            return self
+        for quantity in quantities:
+            if (quantity, ptype) not in self.fields:
+                self.fields[(quantity, ptype)] = self.get(quantity, ptype)
+        return self
+
+    def _read_files(self, quantities, ptype):
+        # full fields of a multi-file snapshot, read in parallel into
+        # shared memory that is released by close
+        partType = PARTTYPES.get(ptype, ptype)
+        counts = self._counts[partType]
+        first = self.files[int(np.argmax(counts > 0))]
+        with h5py.File(first, 'r') as f:
+            present = [q for q in quantities if FIELDS.get(q, q) in f[partType]]
+        fields = {}
+        if len(present) > 0:
+            reader = ParallelReader(self.files, partType,
+                                    [FIELDS.get(q, q) for q in present], counts)
+            pool = schwimmbad.choose_pool(mpi=False, processes=self.nreaders)
+            output = reader.main(pool)
+            self._shared.append(output)
+            for q in present:
+                fields[(q, ptype)] = output[FIELDS.get(q, q)]
+        for q in quantities:
+            if (q not in present) and (q == 'mass'):
+                fields[(q, ptype)] = self._masses(ptype, self.npart[partType])
+        return fields
+
+    def _dataset(self, quantity, ptype):
+        group = self.file[PARTTYPES.get(ptype, ptype)]
+        name = FIELDS.get(quantity, quantity)
+        if name in group:
+            return group[name]
+        return None
+
+    def _masses(self, ptype, n):
+        # Gadget stores the mass of particle types with equal masses in the
+        # header MassTable instead of a Masses dataset
+        ptype_number = int(PARTTYPES.get(ptype, ptype)[len('PartType'):])
+        return np.full(n, self.header['MassTable'][ptype_number])
+
+    def get(self, quantity, ptype='dm', index=None):
+        """
+        Field of a particle type.
+
+        Parameters:
+        -----------
+        quantity : str
+            pos, vel, mass, pot, pid, acc (see load_snapshot)
+        ptype : str
+            dm, disk, bulge
+        index : slice or numpy.ndarray
+            If given only these particles are returned. If the field is not
+            cached they are read from the file without loading the full
+            dataset.
+
+        Returns:
+        --------
+        numpy.ndarray
+
+        """
+        key = (quantity, ptype)
+        if key in self.fields:
+            q = self.fields[key]
+            return q if index is None else q[index]
+        if self.snapformat == 1:
+            # views of the file, nothing to cache
+            q = self.binary.read(quantity, ptype)
+            return q if index is None else q[index]
+        if self.snapformat != 3:
+            q = load_snapshot(self.snapname, self.snapformat, quantity, ptype)
+            if self.cache == True:
+                self.fields[key] = q
+            return q if index is None else q[index]
+        if self.multifile:
+            q = self._read_files([quantity], ptype)[key]
+            if self.cache == True:
+                self.fields[key] = q
+            return q if index is None else q[index]
+
+        dset = self._dataset(quantity, ptype)
+        if index is None:
+            if dset is None and quantity == 'mass':
+                q = self._masses(ptype, self.npart[PARTTYPES.get(ptype, ptype)])
+            else:
+                q = np.ascontiguousarray(dset[()])
+            if self.cache == True:
+                self.fields[key] = q
+            return q
+
+        if not isinstance(index, slice):
+            index = np.asarray(index)
+            if index.dtype == bool:
+                index = np.where(index)[0]
+        if dset is None and quantity == 'mass':
+            npart = self.npart[PARTTYPES.get(ptype, ptype)]
+            n = len(range(npart)[index]) if isinstance(index, slice) else len(index)
+            return self._masses(ptype, n)
+        if isinstance(index, slice):
+            return np.ascontiguousarray(dset[index])
+        if len(index) == 0:
+            return np.empty((0,) + dset.shape[1:], dtype=dset.dtype)
+        # reads the hyperslab that contains the particles, much faster than
+        # a h5py point selection
+        start = index.min()
+        return np.ascontiguousarray(dset[start:index.max()+1][index-start])
@@ -57,9 +57,10 @@ import numpy as np
 import schwimmbad
 import bfe.ios.io_snaps as ios
 import bfe.coefficients.parallel_coefficients as cop
-import bfe.coefficients.parallel_potential as pop
 import sys
 import bfe.coefficients.coefficients_smoothing as coefficients_smoothing
+from bfe.coefficients.fused_coefficients import coeff_results
+from bfe.coefficients.basis_matrix import BasisMatrix
 
 def coeff_computation_all(pos, r_s, nmax, lmax, out_filename, cores=2):
     """
@@ -113,43 +114,84 @@ def random_halo_sample(n_batches, pos):
 
 
 
-def coeff_computation(pos, r_s, nmax, lmax, out_filename, sn, cores=2):
+def coeff_batches_all(batch_coeffs):
     """
-    Computes coefficients in N-batches
+    Coefficients of all the particles from the coefficients of the batches.
+
+    Each particle has mass 1/Npart_batch in its batch and
+    1/(n_batches*Npart_batch) in the full sample, so the full coefficients
+    are the sum over batches divided by n_batches and the variance terms
+    (quadratic in the mass) divided by n_batches**2.
+
+    Parameters:
+    -----------
+    batch_coeffs : numpy.ndarray with shape (5, n_batches, nmax+1, lmax+1, lmax+1)
+        output of coeff_computation
+
+    Returns:
+    --------
+    coeffs : numpy.ndarray with shape (5, nmax+1, lmax+1, lmax+1)
+        S, T, varS, varT, varST of all the particles.
+
+    """
+    n_batches = np.shape(batch_coeffs)[1]
+    coeffs = np.sum(batch_coeffs, axis=1)
+    coeffs[:2] /= n_batches
+    coeffs[2:] /= n_batches**2
+    return coeffs
+
+
+def coeff_computation(pos, r_s, nmax, lmax, out_filename, sn, cores=2,
+                      basis_filename=None):
+    """
+    Computes coefficients in N-batches. The coefficients of all the
+    batches are computed in a single pass over the particles.
+
+    basis_filename : str
+        If given the basis functions of each batch are stored in this
+        memory-mapped .npy file (see BasisMatrix) instead of in memory.
+
+    Returns:
+    --------
+    batch_coeffs : numpy.ndarray with shape (5, n_batches, nmax+1, lmax+1, lmax+1)
+        S, T, varS, varT, varST of each batch.
 
     """
     n_batches = np.shape(pos)[0]
     npart_sample = np.shape(pos)[1]
     mass = np.ones(npart_sample)/npart_sample
+    labels = np.repeat(np.arange(n_batches), npart_sample)
+    print('computing coefficients in {:d} batches'.format(n_batches))
+    pool = schwimmbad.choose_pool(mpi=False, processes=cores)
+    batches = cop.Coeff_parallel(pos.reshape(-1, 3), np.tile(mass, n_batches), r_s,
+                                 True, nmax, lmax, labels=labels)
+    batch_coeffs = batches.main(pool)
+    print('Done computing coefficients in all batches')
     for k in range(n_batches):    
-        print('computing coefficients in batch {:d}'.format(k))
-        pool = schwimmbad.choose_pool(mpi=False, processes=cores)
-        batch = cop.Coeff_parallel(pos[k], mass, r_s, True, nmax, lmax)
-        results = batch.main(pool)
-        print('Done computing coefficients in batch {:d}'.format(k))
+        results = coeff_results(nmax, lmax, *batch_coeffs[:,k])
         ios.write_coefficients(out_filename+'_coefficients_batch_{:0>3d}.txt'.format(k), \
                                results, nmax, lmax,\
                                r_s, mass[0], rcom=0, vcom=0)
+        S = coefficients_smoothing.reshape_matrix(results[:,0], nmax, lmax, lmax)
+        T = coefficients_smoothing.reshape_matrix(results[:,1], nmax, lmax, lmax)
+        SS = coefficients_smoothing.reshape_matrix(results[:,2], nmax, lmax, lmax)
+        TT = coefficients_smoothing.reshape_matrix(results[:,3], nmax, lmax, lmax)
+        ST = coefficients_smoothing.reshape_matrix(results[:,4], nmax, lmax, lmax)
+        Ssmooth = np.zeros((len(sn), nmax+1, lmax+1, lmax+1))
+        Tsmooth = np.zeros((len(sn), nmax+1, lmax+1, lmax+1))
+        for j, s in enumerate(sn):
+            Ssmooth[j], Tsmooth[j], N = coefficients_smoothing.smooth_coeff_matrix(
+                    S, T, SS, TT, ST, mass[0], nmax, lmax, lmax, s)
+        # The basis functions of the batch are evaluated once, the
+        # potential of all the SN cuts is a single matrix product.
+        batch_basis = BasisMatrix(pos[k], r_s, nmax, lmax, filename=basis_filename)
         rho_all = np.zeros((npart_sample, len(sn)+1))
-        j=0
-        for s in sn:
-            pool_dens = schwimmbad.choose_pool(mpi=False, processes=cores)
-            S = coefficients_smoothing.reshape_matrix(results[:,0], nmax, lmax, lmax)
-            T = coefficients_smoothing.reshape_matrix(results[:,1], nmax, lmax, lmax)
-            SS = coefficients_smoothing.reshape_matrix(results[:,2], nmax, lmax, lmax)
-            TT = coefficients_smoothing.reshape_matrix(results[:,3], nmax, lmax, lmax)
-            ST = coefficients_smoothing.reshape_matrix(results[:,4], nmax, lmax, lmax)
-            print(np.shape(S))
-            Ssmooth, Tsmooth, N = coefficients_smoothing.smooth_coeff_matrix(S, T, SS, TT, ST, mass[0],
-                                   nmax, lmax, lmax, s)
-            print(len(Ssmooth))
-            batch_dens = pop.PBFEpot(pos[k], Ssmooth.flatten(),  Tsmooth.flatten(), r_s, nmax, lmax, G=1, M=1)
-            rho =  batch_dens.main(pool_dens)
-            print(len(Ssmooth))
-            rho_all[:,j] = rho 
-            j+=1
+        rho_all[:,:len(sn)] = batch_basis.potential(
+                batch_basis.coeff_vectors(Ssmooth), batch_basis.coeff_vectors(Tsmooth),
+                G=1, M=1)
+        del batch_basis
         np.savetxt(out_filename + "_rho_batch_{:0>3d}.txt".format(k), rho_all)
-    return 0
+    return batch_coeffs
 
 if __name__ == "__main__":
     filename = sys.argv[1]
@@ -166,7 +208,10 @@ if __name__ == "__main__":
     ## This lines is to sample a high resolution halo! 
     pos_rand = np.random.randint(0, len(pos), Npart_sample)
     sn = np.arange(0, 11, 0.2)
-    coeff_computation_all(pos[pos_rand], r_s, nmax, lmax, outname)
     # Particles per batch are automatically found
     pos_batches = random_halo_sample(nbatches, pos[pos_rand])
-    coeff_computation(pos_batches, r_s, nmax, lmax, outname, sn)
+    batch_coeffs = coeff_computation(pos_batches, r_s, nmax, lmax, outname, sn)
+    # The coefficients of all the particles are the sum over batches
+    ios.write_coefficients(outname+'.txt', \
+                           coeff_results(nmax, lmax, *coeff_batches_all(batch_coeffs)),\
+                           nmax, lmax, r_s, 1/Npart_sample, rcom=0, vcom=0)
@@ -34,6 +34,10 @@ def readparams(paramfile):
     samplePartSat = d["samplePartSat"]
     snapformat = d["snapformat"]
     variance = d["variance"]
+    coeff_engine = d.get("coeffEngine", "gala")
+    coeff_mode = d.get("coeffMode", "nlm")
+    stream_chunk = d.get("streamChunk", 0)
+    rcut_list = d.get("rhaloCutList", [])
 
     assert type(inpath)==str, "inpath parameter  must be a string"
     assert type(snapname)==str, "snapname parameter must be a string"
@@ -55,9 +59,14 @@ def readparams(paramfile):
     assert type(snapformat)==int, "snap format must be an integer 0, 1, 2"
     assert snapformat <= 3, "snap format must be an integer 0, 1, 2"
     assert type(variance) == bool, "variance format must be bool"
+    assert coeff_engine in ["gala", "fused"], "coeffEngine must be gala or fused"
+    assert coeff_mode in ["nlm", "particles"], "coeffMode must be nlm or particles"
+    assert type(stream_chunk)==int, "streamChunk parameter must be an integer"
+    assert type(rcut_list)==list, "rhaloCutList parameter must be a list"
     return [inpath, snapname, outpath, outname, npartHalo, samplePart, nmax,
             lmax, mmax, rs, ncores, mpi, rhaloCut, initSnap, finalSnap, SatBFE,
             sat_rs, nmax_sat, lmax_sat, mmax_sat, HostBFE, SatBoundParticles,
             HostSatUnboundPart, write_snaps_ascii, out_ids_bound_unbound_sat, 
-            plot_scatter_sample, samplePartSat, snapformat, variance]
+            plot_scatter_sample, samplePartSat, snapformat, variance,
+            coeff_engine, coeff_mode, stream_chunk, rcut_list]
 
@@ -19,8 +19,12 @@ import bfe.satellites as lmcb
 import bfe.ios.gadget_to_ascii as g2a
 import bfe.ios.io_snaps as ios
 import bfe.coefficients.parallel_coefficients as cop
+import bfe.coefficients.stream_coefficients as scop
+from bfe.coefficients.radial_coefficients import RadialCoefficients
 import allvars
 from bfe.ios.com import re_center
+from bfe.ios.snapshot import Snapshot
+from bfe.ios.selection import IdSelection
 
 from argparse import ArgumentParser
 from quick_viz_check import scatter_plot, density_plot
@@ -92,21 +96,56 @@ if __name__ == "__main__":
     snapformat = params[27]
     # rcut_sat = params[26]
     variance=params[28]
+    coeff_engine = params[29]
+    coeff_mode = params[30]
+    stream_chunk = params[31]
+    rcut_list = params[32]
+    # Host coefficients can be computed reading the snapshot in chunks
+    # only if no other stage needs the host particles in memory.
+    stream_host = ((stream_chunk > 0) & (snapformat == 3) & (HostBFE == 1)
+                   & (HostSatUnboundBFE == 0) & (SatBFE == 0) & (npart_sample == 0)
+                   & (plot_scatter_sample == 0) & (write_snaps_ascii == 0))
 	# Printing welcome message
 		
 
+    # Host/satellite ID cut, derived once per simulation and stored in a
+    # sidecar file next to the outputs.
+    selection = None
+
     for i in range(init_snap, final_snap):
         with open(outpath+'info.log', 'a') as out_log:
             out_log.write("**************************\n")
             out_log.write("loading snap {}{} \n".format(snapname, i))
 
             # *********************** Loading data: **************************
-            
-            if ((HostBFE == 1) | (HostSatUnboundBFE == 1)):
+
+            # The snapshot is opened once and shared by the host and the
+            # satellite stages.
+            read_host = ((HostBFE == 1) | (HostSatUnboundBFE == 1)) & (stream_host == False)
+            read_sat = (SatBFE == 1) | (HostSatUnboundBFE == 1)
+            snapshot = Snapshot(in_path+snapname+"_{:03d}".format(i), snapformat,
+                                nreaders=args.n_cores)
+            if selection is None:
+                if stream_host == True:
+                    # the IDs are read in chunks as the rest of the host
+                    selection = IdSelection.from_chunks(
+                            snapshot.snapname, n_halo_part, outpath+out_name+"_id_cut.yaml",
+                            stream_chunk)
+                else:
+                    selection = IdSelection.from_snapshot(
+                            snapshot, n_halo_part, outpath+out_name+"_id_cut.yaml")
+                out_log.write("host particles ID < {} (ordered: {}) \n".format(
+                        selection.id_cut, selection.ordered))
+            if read_host & read_sat:
+                # both galaxies are selected from one read of the dm fields
+                snapshot.load(['pos', 'vel', 'pid', 'pot', 'mass'])
+
+            if read_host:
                 out_log.write("reading host particles")
                 halo = ios.read_snap_coordinates(
                         in_path, snapname+"_{:03d}".format(i),
-                        n_halo_part, com_frame='host', galaxy='host', snapformat=snapformat)
+                        n_halo_part, com_frame='host', galaxy='host', snapformat=snapformat,
+                        selection=selection, snapshot=snapshot)
                 rcom_halo = halo[5]
                 vcom_halo = halo[6]
                 # Truncates halo:
@@ -139,13 +178,28 @@ if __name__ == "__main__":
                                     mass_tr, npart_sample, ids_tr)
                 out_log.write("Host halo particle mass {} \n".format(mass_tr[0]))
 
+            if stream_host == True:
+                out_log.write("Computing Host BFE reading chunks of {} particles \n".format(stream_chunk))
+                # same center as read_snap_coordinates: the minimum of the
+                # disk potential if there is a disk, otherwise the shrinking
+                # sphere of the dm (see stream_coefficients)
+                results_BFE_host, pmass_host, rcom_halo = scop.stream_coefficients(
+                        snapshot.snapname, rs, nmax, lmax,
+                        variance, galaxy='host', id_cut=selection.id_cut,
+                        rcut=rcut_halo, chunk_size=stream_chunk)
+                out_log.write("Done computing Host BFE")
+                ios.write_coefficients_hdf5(
+                        outpath+out_name+"_host_snap_{:03d}".format(i),
+                        results_BFE_host, [nmax, lmax, mmax], [rs, pmass_host, 0],  rcom_halo)
+
             # Truncating satellite for BFE computation
-            if ((SatBFE == 1) | (HostSatUnboundBFE == 1)):
+            if read_sat:
                 out_log.write("reading satellite particles \n")
                 
                 satellite = ios.read_snap_coordinates(
                         in_path, snapname+"_{:03d}".format(i),
-                        n_halo_part, com_frame='sat', galaxy='sat', snapformat=snapformat)
+                        n_halo_part, com_frame='sat', galaxy='sat', snapformat=snapformat,
+                        selection=selection, snapshot=snapshot)
 
                 rcom_sat = satellite[5]
                 vcom_sat = satellite[6]
@@ -181,6 +235,10 @@ if __name__ == "__main__":
                     del(mass_sat_tr)
                     del(ids_sat_tr)
 
+            # frees the cached fields of the snapshot
+            snapshot.close()
+            del snapshot
+
             if plot_scatter_sample == 1:
                 # Plot 2d projections scatter plots
 
@@ -203,12 +261,7 @@ if __name__ == "__main__":
                 # *** Compute satellite bound paticles ***
                 armadillo = lmcb.find_bound_particles(
                         pos_sat_em, vel_sat_em, mass_sat_em, ids_sat_em, 
-                        sat_rs, nmax_sat, lmax_sat, ncores,
-                        npart_sample = 100000)
-
-                # npart_sample sets the number of particles to compute the
-                # potential in each cpu more than 100000 usually generate memory
-                # errors
+                        sat_rs, nmax_sat, lmax_sat, ncores)
 
                 # removing old variables
                 del(pos_sat_em)
@@ -249,6 +302,22 @@ if __name__ == "__main__":
                     out_log.write("writing satellite bound id \n")
                     np.savetxt(outpath+snapname+"_bound_sat_ids_{:03d}".format(i), ids_bound)
 
+            if ((HostBFE == 1) | (HostSatUnboundBFE == 1)) & (stream_host == False):
+                pool_host = schwimmbad.choose_pool(mpi=args.mpi,
+                    processes=args.n_cores)
+                out_log.write("Computing Host BFE \n")
+                # The host+debris expansion reuses the host coefficients and
+                # their variances, so they are computed if any of the two is
+                # needed.
+                halo_coeff = cop.Coeff_parallel(
+                        pos_halo_tr, mass_tr, rs, variance | (HostSatUnboundBFE == 1),
+                        nmax, lmax, engine=coeff_engine, mode=coeff_mode,
+                        shared_memory=not args.mpi)
+                
+                results_BFE_host = halo_coeff.main(pool_host)
+                print(np.shape(results_BFE_host)) 
+                out_log.write("Done computing Host BFE")
+
             if HostSatUnboundBFE == 1:
                 pool_host_sat = schwimmbad.choose_pool(mpi=args.mpi,
                     processes=args.n_cores)
@@ -263,39 +332,49 @@ if __name__ == "__main__":
                 #density_plot(outpath+snapname+"_unbound_lmc_frame_{:03d}.png".format(i), 
                 #             pos_unbound)
 
-                pos_host_sat = np.vstack((pos_halo_tr, pos_unbound_mw_frame))
-                # TODO : Check mass array?
                 density_plot(outpath+snapname+"_unbound_mw_lmc_frame_{:03d}.png".format(i), 
-                             pos_host_sat)
-                mass_Host_Debris = np.hstack((mass_tr, mass_unbound_array))
+                             [pos_halo_tr, pos_unbound_mw_frame])
                 np.savetxt(outpath+snapname+"halo_particles_{:03d}.txt".format(i), pos_halo_tr)
                 np.savetxt(outpath+snapname+"debris_particles_{:03d}.txt".format(i), pos_unbound_mw_frame)
                 #out_log.write("Debris_mass=" mass_unbound_array[0])
                 #out_log.write("Halo_mass=" mass_tr[0])
 
-                halo_debris_coeff = cop.Coeff_parallel(
-                        pos_host_sat, mass_Host_Debris, rs, True, nmax, lmax)
+                # The coefficients and the variance terms are sums over
+                # particles, the host+debris expansion is the host expansion
+                # plus the debris expansion with the same center and rs.
+                debris_coeff = cop.Coeff_parallel(
+                        pos_unbound_mw_frame, mass_unbound_array, rs, True, nmax, lmax,
+                        engine=coeff_engine, mode=coeff_mode,
+                        shared_memory=not args.mpi)
             
-                results_BFE_halo_debris = halo_debris_coeff.main(pool_host_sat)
+                results_BFE_halo_debris = results_BFE_host + debris_coeff.main(pool_host_sat)
                 out_log.write("Done computing Host & satellite debris potential")
                 ios.write_coefficients_hdf5(
                         outpath+out_name+"_host_sat_unbound_snap_{:03d}".format(i),
-                        results_BFE_halo_debris, [nmax, lmax, mmax], [rs, mass_Host_Debris[0], 0],  rcom_halo)
+                        results_BFE_halo_debris, [nmax, lmax, mmax], [rs, mass_tr[0], 0],  rcom_halo)
             
     
-            if HostBFE == 1:
-                pool_host = schwimmbad.choose_pool(mpi=args.mpi,
-                    processes=args.n_cores)
-                out_log.write("Computing Host BFE \n")
-                halo_coeff = cop.Coeff_parallel(
-                        pos_halo_tr, mass_tr, rs, variance, nmax, lmax)
-                
-                results_BFE_host = halo_coeff.main(pool_host)
-                print(np.shape(results_BFE_host)) 
-                out_log.write("Done computing Host BFE")
+            if (HostBFE == 1) & (stream_host == False):
+                if variance == False:
+                    # drop the variance terms computed for the host+debris expansion
+                    results_BFE_host = results_BFE_host[:,:2]
                 ios.write_coefficients_hdf5(
                         outpath+out_name+"_host_snap_{:03d}".format(i),
                         results_BFE_host, [nmax, lmax, mmax], [rs, mass_tr[0], 0],  rcom_halo)
+
+                if len(rcut_list) > 0:
+                    # Host coefficients truncated at each radius of
+                    # rhaloCutList, computed from cumulative sums over
+                    # radially sorted particles.
+                    out_log.write("Computing Host BFE at rcut = {} \n".format(rcut_list))
+                    radial_coeff = RadialCoefficients(
+                            pos_halo_tr, mass_tr, rs, nmax, lmax, variance)
+                    for rcut in rcut_list:
+                        ios.write_coefficients_hdf5(
+                                outpath+out_name+"_host_rcut_{}_snap_{:03d}".format(rcut, i),
+                                radial_coeff.coefficients(rcut), [nmax, lmax, mmax],
+                                [rs, mass_tr[0], 0], rcom_halo)
+                    del radial_coeff
         
 
             if ((SatBFE == 1) & (SatBoundParticles == 1)):
@@ -303,7 +382,9 @@ if __name__ == "__main__":
                 pool_sat = schwimmbad.choose_pool(mpi=args.mpi,
                                                   processes=args.n_cores)
                 sat_coeff = cop.Coeff_parallel(
-                        pos_bound, mass_bound_array, sat_rs, variance, nmax_sat, lmax_sat)
+                        pos_bound, mass_bound_array, sat_rs, variance, nmax_sat, lmax_sat,
+                        engine=coeff_engine, mode=coeff_mode,
+                        shared_memory=not args.mpi)
 
                 results_BFE_sat = sat_coeff.main(pool_sat)
                 out_log.write("Done computing Sat BFE \n")
@@ -318,7 +399,9 @@ if __name__ == "__main__":
                 pool_sat = schwimmbad.choose_pool(mpi=args.mpi,
                                                   processes=args.n_cores)
                 sat_coeff = cop.Coeff_parallel(
-                        pos_sat_em, mass_sat_em, sat_rs, variance, nmax_sat, lmax_sat)
+                        pos_sat_em, mass_sat_em, sat_rs, variance, nmax_sat, lmax_sat,
+                        engine=coeff_engine, mode=coeff_mode,
+                        shared_memory=not args.mpi)
 
                 results_BFE_sat = sat_coeff.main(pool_sat)
                 out_log.write("Done computing Sat BFE \n")
@@ -23,14 +23,24 @@ def scatter_plot(snap, data):
 
 
 def density_plot(snap, data):
-    x = data[:,0]
-    y = data[:,1]
-    z = data[:,2]
-    r = np.sqrt(np.sum(data**2, axis=1))
-    index_cut = np.where((r<300) & (np.abs(x<5)))[0]
-    hist_slice = np.histogram2d(y[index_cut], z[index_cut], 100)
+    """
+    yz density of the slice x < 5 and r < 300. data is an array of
+    positions or a list of them, the histograms of the arrays are added
+    so they are never stacked.
+    """
+    if not isinstance(data, (list, tuple)):
+        data = [data]
+    hist_slice = np.zeros((100, 100))
+    for pos in data:
+        x = pos[:,0]
+        y = pos[:,1]
+        z = pos[:,2]
+        r = np.sqrt(np.sum(pos**2, axis=1))
+        index_cut = np.where((r<300) & (np.abs(x<5)))[0]
+        hist_slice += np.histogram2d(y[index_cut], z[index_cut], 100,
+                                     range=[[-300, 300], [-300, 300]])[0]
     fig, ax = plt.subplots(1, 1, figsize=(5, 5))
-    im1= ax.imshow(np.log10(np.abs(hist_slice[0].T)), origin='lower',  cmap='coolwarm', extent=[-300, 300, -300, 300], vmin=0, vmax=3)
+    im1= ax.imshow(np.log10(np.abs(hist_slice.T)), origin='lower',  cmap='coolwarm', extent=[-300, 300, -300, 300], vmin=0, vmax=3)
     ax.set_xlim(-200, 200)
     ax.set_ylim(-200, 200)
     plt.savefig(snap+"_yz_density.png", bbox_inches='tight')
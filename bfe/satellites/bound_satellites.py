@@ -12,6 +12,7 @@ from scipy import optimize
 import schwimmbad
 import bfe.coefficients.parallel_coefficients as parallel_coefficients 
 import bfe.coefficients.parallel_potential as parallel_potential
+from bfe.coefficients.basis_matrix import BasisMatrix
 
 def enclosed_mass(pos, m):
     r = np.sqrt(np.sum(pos**2, axis=1))
@@ -46,10 +47,11 @@ def find_scale_length(pos, mass, rs_max):
 
 
 def parallel_potential_batches(pos, S, T, rs, nmax, lmax, G, ncores,
-                               npart_sample):
+                               npart_sample=None):
     """
-    Function to compute potential in parallel. To avoid 
-    large memory errors the particle's potential is computed in batches.
+    Function to compute potential in parallel. A single pool is used for
+    all the particles, each worker receives slices of points and writes
+    their potential into a preallocated shared memory array.
 
     Parameters:
     ----------
@@ -61,50 +63,24 @@ def parallel_potential_batches(pos, S, T, rs, nmax, lmax, G, ncores,
     lmax : maximum l number in expansion
     G : value of gravitational constant
     ncores : number of cores used to compute the potential in parallel
-    npart_sample : number of particles 
+    npart_sample : number of particles per slice, None sets it from the
+        available memory (see parallel_potential.block_size_from_memory).
 
     """
     
     Nparticles = len(pos[:,0])
-    # compute n batches to split the particles
-    nbatches = int(Nparticles/npart_sample)
-    print('computing potential in parallel in {} batches of particles'.format(nbatches))
-    pot_all = np.array([])
-
-    if nbatches < 1:
-      pos_batch = pos
-      halo_pot = parallel_potential.PBFEpot(pos_batch, S, T, rs, nmax, lmax, G=G, M=1)
-
-      # choosing pool to compute the potential in parallel
-      pool2 = schwimmbad.choose_pool(mpi=False, processes=ncores)
-      # Compute potential in parallel
-      pot_all = halo_pot.main(pool2)
-
-    else :
-        for i in range(nbatches):
-            # making batches
-            if i < (nbatches-1):
-                pos_batch = pos[i*npart_sample:(i+1)*npart_sample]
-            elif i == (nbatches-1):
-                pos_batch = pos[i*npart_sample:]
-            else :
-                pos_batch = pos
-
-            print("Done batch {}".format(i))
-            halo_pot = parallel_potential.PBFEpot(pos_batch, S, T, rs, nmax, lmax, G=G, M=1)
-            pool2 = schwimmbad.choose_pool(mpi=False, processes=ncores)
-            pot = halo_pot.main(pool2)
-            pot_all = np.hstack((pot_all, pot))
-
-            # clean memory
-            del(pot, pos_batch, pool2)
-    # clean memory
-    del(pos)
+    halo_pot = parallel_potential.PBFEpot(pos, S, T, rs, nmax, lmax, G=G, M=1,
+                                          shared_memory=True, block_size=npart_sample)
+    pool = schwimmbad.choose_pool(mpi=False, processes=ncores)
+    print('computing potential in parallel in {} slices of particles'.format(
+          len(halo_pot.tasks(pool))))
+    pot_all = halo_pot.main(pool)
+    del(pos, halo_pot)
 
     assert (len(pot_all)==Nparticles), 'Hey some potentials are missing here'
     return pot_all
 
-def compute_scf_pot(pos, rs, nmax, lmax, mass, ncores, npart_sample):
+def compute_scf_pot(pos, rs, nmax, lmax, mass, ncores, npart_sample=None):
     """
     
     """
@@ -120,7 +96,7 @@ def compute_scf_pot(pos, rs, nmax, lmax, mass, ncores, npart_sample):
     rs_opt = rs
     # TODO: make rs_max to be an opt parameter
     print("rs", rs_opt)
-    halo_coeff = parallel_coefficients.Coeff_parallel(pos, mass, rs_opt, False, nmax, lmax)
+    halo_coeff = parallel_coefficients.Coeff_parallel(pos, mass, rs_opt, False, nmax, lmax, shared_memory=True)
     results = halo_coeff.main(pool)
     S = results[:,0]
     T = results[:,1]
@@ -150,11 +126,93 @@ def bound_particles(pot, pos, vel, ids, rcut=5):
     return pos[lmc_bound], vel[lmc_bound], ids[lmc_bound], pos[lmc_unbound], vel[lmc_unbound], ids[lmc_unbound]
 
 
-def find_bound_particles(pos, vel, mass, ids, rs, nmax, lmax, ncores, npart_sample):
+def bound_mask(pot, pos, vel, rcut=5):
+    """
+    Boolean mask of the bound particles, same criteria as bound_particles.
+    """
+    T = np.sum(vel**2, axis=1)/2
+    r = np.sqrt(np.sum(pos**2, axis=1))
+    return (2*T+pot<=0) | (r<=rcut)
+
+
+def find_bound_particles_incremental(pos, vel, mass, ids, rs, nmax, lmax, ncores=1):
+    """
+    Iterating to find bound particles updating the expansion with only the
+    particles that become unbound in each iteration.
+
+    The basis functions of all the particles are computed once and stored
+    (see bfe.coefficients.basis_matrix.BasisMatrix), the coefficients are
+    then downdated by subtracting the contribution of the newly unbound
+    particles and the potential of the bound particles is a matrix-vector
+    product with their rows only. Memory is 2*N*ncoeff*8 bytes, see
+    incremental_fits_in_memory. The basis functions are evaluated by ncores
+    processes, the products use the threads of the BLAS library.
+
+    mass : particle mass array
+    """
+    G_gadget = 43007.1
+    N_init = len(pos)
+    pool = schwimmbad.choose_pool(mpi=False, processes=ncores)
+    sat_basis = BasisMatrix(pos, rs, nmax, lmax, pool=pool)
+    S, T = sat_basis.coefficients(mass)
+    pot = sat_basis.potential(S, T, G=G_gadget)
+    bound = bound_mask(pot, pos, vel)
+    # indices of the bound particles and of the unbound particles in the
+    # order they are removed.
+    bound_index = np.where(bound)[0]
+    unbound_index = [np.where(~bound)[0]]
+    N_bound = len(bound_index)
+
+    print('Initial number of particles:', N_init)
+    print('Number of bound particles prior iteration {}'.format(N_bound))
+    i=1
+
+    while (np.abs(N_init-N_bound) > (0.01*N_init)):
+        dS, dT = sat_basis.coefficients(mass[unbound_index[-1]], unbound_index[-1])
+        S -= dS
+        T -= dT
+        pot = sat_basis.potential(S, T, bound_index, G=G_gadget)
+        bound = bound_mask(pot, pos[bound_index], vel[bound_index])
+        unbound_index.append(bound_index[~bound])
+        bound_index = bound_index[bound]
+        N_init = N_bound
+        N_bound = len(bound_index)
+        print("bound mass", np.sum(mass[bound_index]))
+        i+=1
+        print(N_init, N_bound)
+
+    unbound_index = np.hstack(unbound_index)
+    return pos[bound_index], vel[bound_index], ids[bound_index], pos[unbound_index], vel[unbound_index], ids[unbound_index]
+
+
+def incremental_fits_in_memory(npart, nmax, lmax, memory_fraction=0.5):
+    """
+    True if the basis matrices of find_bound_particles_incremental
+    (2*npart*ncoeff*8 bytes) use less than memory_fraction of the available
+    memory.
+    """
+    ncoeff = (nmax+1)*(lmax+1)*(lmax+2)//2
+    memory = parallel_potential.available_memory()
+    if memory is None:
+        return False
+    return 2*npart*ncoeff*8 < memory_fraction*memory
+
+
+def find_bound_particles(pos, vel, mass, ids, rs, nmax, lmax, ncores, npart_sample=None, incremental=None):
     """
     Iterating to find bound particles
     mass : particle mass array
+    incremental : bool or None
+        If True uses find_bound_particles_incremental, the expansion is
+        downdated with the particles that become unbound instead of being
+        computed again in every iteration. None uses it only if its basis
+        matrices fit in memory (see incremental_fits_in_memory).
     """
+    if incremental is None:
+        incremental = incremental_fits_in_memory(len(pos), nmax, lmax)
+    if incremental == True:
+        return find_bound_particles_incremental(pos, vel, mass, ids, rs, nmax, lmax, ncores)
+
     N_init = len(pos)
     pot, rs_opt = compute_scf_pot(pos, rs, nmax, lmax, mass, ncores, npart_sample)
     pos_bound, vel_bound, ids_bound, pos_unbound, vel_unbound, ids_unbound = bound_particles(pot, pos, vel, ids)
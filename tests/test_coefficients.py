@@ -0,0 +1,547 @@
+import os
+import h5py
+import numpy as np
+import schwimmbad
+from bfe.coefficients import Coeff_parallel
+from bfe.coefficients.stream_coefficients import stream_coefficients
+from bfe.coefficients.fused_coefficients import STnlm_partial
+from bfe.coefficients import basis
+
+data_path = os.path.join(os.path.dirname(__file__), "data/plummer_sphere_10K.txt")
+
+
+def load_halo():
+    data = np.loadtxt(data_path)
+    pos = data[:,0:3]
+    mass = data[:,6]
+    return pos, mass
+
+
+def expansion(nmax, lmax, keep=None):
+    """
+    S and T matrices of the halo shifted off the origin, only the terms in
+    keep (a mask in the order of basis.nlm_list) if given.
+    """
+    pos, mass = load_halo()
+    halo_coeff = Coeff_parallel(pos + np.array([2.0, -1.0, 0.5]), mass, 10.0, False, nmax, lmax, engine='fused')
+    results = halo_coeff.main(schwimmbad.SerialPool())
+    n, l, m = np.array(basis.nlm_list(nmax, lmax)).T
+    if keep is None:
+        keep = np.ones(len(n), dtype=bool)
+    S = np.zeros((nmax+1, lmax+1, lmax+1))
+    T = np.zeros((nmax+1, lmax+1, lmax+1))
+    S[n[keep], l[keep], m[keep]] = results[keep,0]
+    T[n[keep], l[keep], m[keep]] = results[keep,1]
+    return S, T
+
+
+def test_fused_engine():
+    pos, mass = load_halo()
+    nmax, lmax = 4, 4
+    gala_coeff = Coeff_parallel(pos, mass, 10.0, True, nmax, lmax, engine='gala')
+    results_gala = gala_coeff.main(schwimmbad.SerialPool())
+    fused_coeff = Coeff_parallel(pos, mass, 10.0, True, nmax, lmax, engine='fused', chunk_size=3000)
+    assert fused_coeff.mode == 'particles'
+    results_fused = fused_coeff.main(schwimmbad.SerialPool())
+
+    assert np.shape(results_fused) == np.shape(results_gala)
+    assert np.allclose(results_fused, results_gala, rtol=1e-8, atol=1e-14), \
+            """bfe-py.coefficients fused engine is failing """
+
+
+def test_particles_mode():
+    pos, mass = load_halo()
+    nmax, lmax = 4, 4
+    fused_coeff = Coeff_parallel(pos, mass, 10.0, True, nmax, lmax, engine='fused')
+    results_fused = fused_coeff.main(schwimmbad.SerialPool())
+    particles_coeff = Coeff_parallel(pos, mass, 10.0, True, nmax, lmax, mode='particles', ntasks=7)
+    results_particles = particles_coeff.main(schwimmbad.SerialPool())
+
+    assert np.allclose(results_particles, results_fused, rtol=1e-10, atol=1e-16), \
+            """bfe-py.coefficients particles mode is failing """
+
+
+def test_stream_coefficients(tmp_path):
+    pos, mass = load_halo()
+    snapname = str(tmp_path / "snap.hdf5")
+    with h5py.File(snapname, 'w') as f:
+        particles = f.create_group('PartType1')
+        particles['Coordinates'] = pos
+        particles['Masses'] = mass
+        particles['ParticleIDs'] = np.arange(len(mass))
+    rcom = np.array([1.0, -2.0, 0.5])
+    nmax, lmax = 4, 4
+    results_stream, pmass, rcom = stream_coefficients(
+            snapname, 10.0, nmax, lmax, True, galaxy='host',
+            N_host_particles=6000, rcom=rcom, rcut=80, chunk_size=999)
+
+    pos_host = pos[:6000] - rcom
+    rcut = np.sqrt(np.sum(pos_host**2, axis=1)) < 80
+    halo_coeff = Coeff_parallel(pos_host[rcut], mass[:6000][rcut], 10.0, True, nmax, lmax, engine='fused')
+    results = halo_coeff.main(schwimmbad.SerialPool())
+
+    assert np.allclose(results_stream, results, rtol=1e-10, atol=1e-16), \
+            """bfe-py.coefficients stream_coefficients is failing """
+
+    # the same snapshot written in three files
+    edges = [0, 2500, 2500, len(mass)]
+    for k in range(3):
+        with h5py.File(str(tmp_path / "multi.{:d}.hdf5".format(k)), 'w') as f:
+            f.create_group('Header').attrs['NumFilesPerSnapshot'] = 3
+            particles = f.create_group('PartType1')
+            particles['Coordinates'] = pos[edges[k]:edges[k+1]]
+            particles['Masses'] = mass[edges[k]:edges[k+1]]
+            particles['ParticleIDs'] = np.arange(edges[k], edges[k+1])
+    results_multi = stream_coefficients(
+            str(tmp_path / "multi"), 10.0, nmax, lmax, True, galaxy='host',
+            N_host_particles=6000, rcom=rcom, rcut=80, chunk_size=999)[0]
+    assert np.allclose(results_multi, results, rtol=1e-10, atol=1e-16), \
+            """bfe-py.coefficients multi-file stream_coefficients is failing """
+
+
+def test_mpi_coefficients(tmp_path):
+    from mpi4py import MPI
+    from bfe.coefficients.mpi_coefficients import mpi_coefficients
+    pos, mass = load_halo()
+    snapname = str(tmp_path / "snap.hdf5")
+    with h5py.File(snapname, 'w') as f:
+        particles = f.create_group('PartType1')
+        particles['Coordinates'] = pos
+        particles['Masses'] = mass
+        particles['ParticleIDs'] = np.arange(len(mass))[::-1]
+    nmax, lmax = 4, 4
+    # single rank, the bisection of the ID cut and the reductions still run
+    results_mpi, pmass, rcom = mpi_coefficients(
+            MPI.COMM_WORLD, snapname, 10.0, nmax, lmax, True, galaxy='host',
+            N_host_particles=6000, rcut=80, chunk_size=999)
+
+    host = np.arange(len(mass))[::-1] < 6000
+    # the same shrinking sphere as stream_com
+    from bfe.coefficients.stream_coefficients import stream_com
+    assert np.allclose(rcom, stream_com(snapname, 'host', 6000, chunk_size=999), rtol=1e-10)
+    pos_host = pos[host] - rcom
+    rcut = np.sqrt(np.sum(pos_host**2, axis=1)) < 80
+    halo_coeff = Coeff_parallel(pos_host[rcut], mass[host][rcut], 10.0, True, nmax, lmax, engine='fused')
+    results = halo_coeff.main(schwimmbad.SerialPool())
+    assert np.allclose(results_mpi, results, rtol=1e-10, atol=1e-16), \
+            """bfe-py.coefficients mpi_coefficients is failing """
+
+    # masses only in the header MassTable
+    tablename = str(tmp_path / "table.hdf5")
+    with h5py.File(tablename, 'w') as f:
+        f.create_group('Header').attrs['MassTable'] = np.array([0, mass[0], 0, 0, 0, 0])
+        particles = f.create_group('PartType1')
+        particles['Coordinates'] = pos
+        particles['ParticleIDs'] = np.arange(len(mass))[::-1]
+    results_table = mpi_coefficients(
+            MPI.COMM_WORLD, tablename, 10.0, nmax, lmax, True, galaxy='host',
+            N_host_particles=6000, rcom=rcom, rcut=80, chunk_size=999)[0]
+    assert np.allclose(results_table, results, rtol=1e-10, atol=1e-16), \
+            """bfe-py.coefficients mpi_coefficients MassTable is failing """
+
+    try:
+        mpi_coefficients(MPI.COMM_WORLD, snapname, 10.0, nmax, lmax, galaxy='host')
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError("mpi_coefficients accepts a galaxy without N_host_particles")
+
+
+def test_var_single():
+    from gala.potential.scf._computecoeff import STnlm_discrete, STnlm_var_discrete
+    from bfe.coefficients.fused_coefficients import STnlm_var_single
+    pos, mass = load_halo()
+    s, phi, X = basis.spherical_coordinates(pos, 10.0)
+    mass = np.ascontiguousarray(mass)
+    for n, l, m in [(0, 0, 0), (3, 2, 1), (6, 8, 5), (10, 10, 10)]:
+        gala_ST = STnlm_discrete(s, phi, X, mass, n, l, m)
+        gala_var = STnlm_var_discrete(s, phi, X, mass, n, l, m)
+        assert np.allclose(STnlm_var_single(s, phi, X, mass, n, l, m),
+                           np.hstack([gala_ST, gala_var]), rtol=1e-8, atol=1e-16), \
+                """bfe-py.coefficients STnlm_var_single is failing """
+
+
+def test_batches():
+    pos, mass = load_halo()
+    nmax, lmax = 4, 4
+    labels = np.random.randint(0, 6, len(mass))
+    labels[labels == 3] = 2 # empty batch
+    batch_coeff = Coeff_parallel(pos, mass, 10.0, True, nmax, lmax, labels=labels, ntasks=3, chunk_size=777)
+    results_batches = batch_coeff.main(schwimmbad.SerialPool())
+    assert np.shape(results_batches) == (5, 6, nmax+1, lmax+1, lmax+1)
+
+    for b in range(6):
+        batch = labels == b
+        results = STnlm_partial(*basis.spherical_coordinates(pos[batch], 10.0),
+                                np.ascontiguousarray(mass[batch]), nmax, lmax, True)
+        assert np.allclose(results_batches[:,b], results, rtol=1e-10, atol=1e-16), \
+                """bfe-py.coefficients batches are failing """
+
+
+def test_radial_coefficients():
+    from bfe.coefficients.radial_coefficients import RadialCoefficients
+    pos, mass = load_halo()
+    nmax, lmax = 4, 4
+    radial_coeff = RadialCoefficients(pos, mass, 10.0, nmax, lmax, True, nbins=37)
+    r = np.sqrt(np.sum(pos**2, axis=1))
+    for rmin, rcut in [(0, 5.3), (0, 40.0), (2.0, 17.5), (0, np.inf)]:
+        shell = (r >= rmin) & (r < rcut)
+        halo_coeff = Coeff_parallel(pos[shell], mass[shell], 10.0, True, nmax, lmax, engine='fused')
+        results = halo_coeff.main(schwimmbad.SerialPool())
+        assert np.allclose(radial_coeff.coefficients(rcut, rmin), results, rtol=1e-8, atol=1e-12), \
+                """bfe-py.coefficients radial_coefficients is failing """
+
+
+def test_pbfepot():
+    import astropy.units as u
+    from gala.potential import SCFPotential
+    from gala.units import UnitSystem
+    from bfe.coefficients import PBFEpot
+    pos, mass = load_halo()
+    nmax, lmax = 4, 4
+    halo_coeff = Coeff_parallel(pos, mass, 10.0, False, nmax, lmax, engine='fused')
+    results = halo_coeff.main(schwimmbad.SerialPool())
+    n, l, m = np.array(basis.nlm_list(nmax, lmax)).T
+    S = np.zeros((nmax+1, lmax+1, lmax+1))
+    T = np.zeros((nmax+1, lmax+1, lmax+1))
+    S[n, l, m] = results[:,0]
+    T[n, l, m] = results[:,1]
+    gala_pot = SCFPotential(m=1, r_s=10.0, Snlm=S, Tnlm=T,
+                            units=UnitSystem(u.kpc, u.Gyr, u.Msun, u.radian))
+    points = pos[::7]
+    halo_pot = PBFEpot(points, results[:,0], results[:,1], 10.0, nmax, lmax,
+                       G=gala_pot.G, M=1, block_size=333)
+    pot, rho = halo_pot.main(schwimmbad.SerialPool(), density=True)
+
+    assert np.allclose(pot, gala_pot.energy(points.T).value, rtol=1e-10), \
+            """bfe-py.coefficients PBFEpot potential is failing """
+    assert np.allclose(rho, gala_pot.density(points.T).value, rtol=1e-10), \
+            """bfe-py.coefficients PBFEpot density is failing """
+
+
+def test_bfepot_acceleration():
+    import astropy.units as u
+    from gala.potential import SCFPotential
+    from gala.units import UnitSystem
+    from bfe.coefficients import BFEpot
+    pos, mass = load_halo()
+    nmax, lmax = 4, 4
+    S, T = expansion(nmax, lmax)
+    gala_pot = SCFPotential(m=1, r_s=10.0, Snlm=S, Tnlm=T,
+                            units=UnitSystem(u.kpc, u.Gyr, u.Msun, u.radian))
+    points = pos[::7]
+    halo = BFEpot(points, S, T, 10.0, nmax, lmax, G=gala_pot.G, M=1)
+    pot, acc, rho = halo.main(schwimmbad.SerialPool(), block_size=333)
+    gala_acc = -gala_pot.gradient(points.T).value.T
+
+    assert np.allclose(pot, gala_pot.energy(points.T).value, rtol=1e-10), \
+            """bfe-py.coefficients BFEpot potential is failing """
+    assert np.allclose(acc, gala_acc, rtol=1e-8, atol=1e-12*np.abs(gala_acc).max()), \
+            """bfe-py.coefficients BFEpot acceleration is failing """
+    assert np.allclose(rho, gala_pot.density(points.T).value, rtol=1e-10), \
+            """bfe-py.coefficients BFEpot density is failing """
+
+
+def test_pbfepot_shared_output():
+    from bfe.coefficients import PBFEpot
+    pos, mass = load_halo()
+    nmax, lmax = 4, 4
+    halo_coeff = Coeff_parallel(pos, mass, 10.0, False, nmax, lmax, engine='fused')
+    results = halo_coeff.main(schwimmbad.SerialPool())
+    pot, rho = PBFEpot(pos, results[:,0], results[:,1], 10.0, nmax, lmax, G=1, M=1).main(
+            schwimmbad.SerialPool(), density=True)
+    halo_pot = PBFEpot(pos, results[:,0], results[:,1], 10.0, nmax, lmax, G=1, M=1,
+                       shared_memory=True, block_size=1234)
+    pot_shared, rho_shared = halo_pot.main(schwimmbad.MultiPool(2), density=True)
+
+    assert np.allclose(pot_shared, pot, rtol=1e-12) & np.allclose(rho_shared, rho, rtol=1e-12), \
+            """bfe-py.coefficients PBFEpot shared output is failing """
+
+
+def test_radial_table(tmp_path):
+    from bfe.coefficients.tabulated_basis import RadialTable
+    nmax, lmax = 8, 12
+    table = RadialTable(nmax, lmax, 1e-9, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    cached = RadialTable(nmax, lmax, 1e-9, cache_dir=str(tmp_path))
+    assert np.all(table.error < 1e-9) & np.all(cached.error == table.error)
+    s = np.logspace(-3, 3, 1000)
+    exact = basis.radial_table(nmax, lmax, s)
+    # the amplitude of the l=12 functions is ~1e-4 of the l=0 ones, the
+    # error of each (n,l) is relative to its own amplitude
+    scale = np.max(np.abs(exact), axis=2)[:,:,None]
+    assert np.all(np.abs(table.radial(s) - exact) < 1e-8*scale), \
+            """bfe-py.coefficients RadialTable is failing """
+    assert np.all(cached.radial(s) == table.radial(s)), \
+            """bfe-py.coefficients RadialTable cache is failing """
+
+
+def test_basis_matrix_sets(tmp_path):
+    from bfe.coefficients import PBFEpot
+    from bfe.coefficients.basis_matrix import BasisMatrix
+    pos, mass = load_halo()
+    nmax, lmax = 4, 3
+    halo_coeff = Coeff_parallel(pos, mass, 10.0, False, nmax, lmax, engine='fused')
+    results = halo_coeff.main(schwimmbad.SerialPool())
+    points = pos[::5]
+    halo_basis = BasisMatrix(points, 10.0, nmax, lmax, chunk_size=777, density=True,
+                             filename=str(tmp_path / "basis.npy"))
+    factors = np.array([1.0, 0.5, -2.0])
+    pot, rho = halo_basis.potential(results[:,0,None]*factors, results[:,1,None]*factors, G=2), \
+               halo_basis.density(results[:,0,None]*factors, results[:,1,None]*factors)
+    pot_pbfe, rho_pbfe = PBFEpot(points, results[:,0], results[:,1], 10.0, nmax, lmax,
+                                 G=2, M=1).main(schwimmbad.SerialPool(), density=True)
+
+    assert np.shape(pot) == (len(points), 3)
+    assert np.allclose(pot, pot_pbfe[:,None]*factors, rtol=1e-10), \
+            """bfe-py.coefficients BasisMatrix potential is failing """
+    assert np.allclose(rho, rho_pbfe[:,None]*factors, rtol=1e-10), \
+            """bfe-py.coefficients BasisMatrix density is failing """
+
+
+def test_cross_validation_memmap(tmp_path):
+    from bfe.noise.cross_validation import coeff_computation
+    pos, mass = load_halo()
+    batches = pos[:3000].reshape(2, 1500, 3)
+    sn = [0, 1.0]
+    in_memory = coeff_computation(batches, 10.0, 3, 2, str(tmp_path / "memory"), sn, cores=1)
+    mapped = coeff_computation(batches, 10.0, 3, 2, str(tmp_path / "mapped"), sn, cores=1,
+                               basis_filename=str(tmp_path / "basis.npy"))
+    assert np.allclose(mapped, in_memory, rtol=1e-12, atol=0)
+    assert os.path.isfile(tmp_path / "basis.npy")
+    for k in range(2):
+        rho_memory = np.loadtxt(tmp_path / "memory_rho_batch_{:0>3d}.txt".format(k))
+        rho_mapped = np.loadtxt(tmp_path / "mapped_rho_batch_{:0>3d}.txt".format(k))
+        assert np.shape(rho_mapped) == (1500, len(sn)+1)
+        assert np.allclose(rho_mapped, rho_memory, rtol=1e-12, atol=0), \
+                """bfe-py.noise cross_validation memory-mapped basis is failing """
+
+
+def test_sparse_coefficients():
+    import astropy.units as u
+    from gala.potential import SCFPotential
+    from gala.units import UnitSystem
+    from bfe.coefficients import PBFEpot, BFEpot
+    from bfe.coefficients.sparse_coefficients import SparseCoefficients
+    pos, mass = load_halo()
+    nmax, lmax = 6, 5
+    n, l, m = np.array(basis.nlm_list(nmax, lmax)).T
+    # zeroes most of the terms as smoothing does, with different highest
+    # n for each l and l for each m
+    keep = (n <= 5 - l) & (m != 1) & ~((l == 3) & (m == 2))
+    S, T = expansion(nmax, lmax, keep)
+    sparse = SparseCoefficients(S, T)
+    gala_pot = SCFPotential(m=1, r_s=10.0, Snlm=S, Tnlm=T,
+                            units=UnitSystem(u.kpc, u.Gyr, u.Msun, u.radian))
+    points = pos[::7]
+    pot, rho = PBFEpot(points, S, T, 10.0, nmax, lmax, G=gala_pot.G, M=1,
+                       block_size=333).main(schwimmbad.SerialPool(), density=True)
+    bfe_pot, acc, bfe_rho = BFEpot(points, S, T, 10.0, nmax, lmax, G=gala_pot.G,
+                                   M=1).main(schwimmbad.SerialPool(), block_size=333)
+    gala_acc = -gala_pot.gradient(points.T).value.T
+
+    assert sparse.nterms == np.count_nonzero((S != 0) | (T != 0)), \
+            """bfe-py.coefficients SparseCoefficients terms are failing """
+    assert np.allclose(pot, gala_pot.energy(points.T).value, rtol=1e-10), \
+            """bfe-py.coefficients sparse potential is failing """
+    assert np.allclose(rho, gala_pot.density(points.T).value, rtol=1e-10), \
+            """bfe-py.coefficients sparse density is failing """
+    assert np.allclose(bfe_pot, pot, rtol=1e-12) & np.allclose(bfe_rho, rho, rtol=1e-12), \
+            """bfe-py.coefficients sparse BFEpot is failing """
+    assert np.allclose(acc, gala_acc, rtol=1e-8, atol=1e-12*np.abs(gala_acc).max()), \
+            """bfe-py.coefficients sparse acceleration is failing """
+
+
+def test_spherical_grid_field():
+    from bfe.coefficients import PBFEpot
+    from bfe.coefficients.grids import spherical_grid_field
+    nmax, lmax = 4, 4
+    S, T = expansion(nmax, lmax)
+    r = np.linspace(1, 50, 6)
+    theta = np.arccos(np.linspace(0.95, -0.95, 5))
+    nphi = 12
+    phi = 2*np.pi*np.arange(nphi)/nphi
+    R, TH, PH = np.meshgrid(r, theta, phi, indexing='ij')
+    points = np.array([R*np.sin(TH)*np.cos(PH), R*np.sin(TH)*np.sin(PH), R*np.cos(TH)]).reshape(3, -1).T
+    pot, rho = PBFEpot(points, S, T, 10.0, nmax, lmax, G=1, M=1).main(
+            schwimmbad.SerialPool(), density=True)
+    rho_fft = spherical_grid_field(r, theta, nphi, S, T, 10.0)
+    pot_fft = spherical_grid_field(r, theta, nphi, S, T, 10.0, quantity='potential')
+    rho_phi = spherical_grid_field(r, theta, phi[::-1], S, T, 10.0)
+
+    assert np.allclose(rho_fft.flatten(), rho, rtol=1e-10), \
+            """bfe-py.coefficients spherical_grid_field density is failing """
+    assert np.allclose(pot_fft.flatten(), pot, rtol=1e-10), \
+            """bfe-py.coefficients spherical_grid_field potential is failing """
+    assert np.allclose(rho_phi, rho_fft[:,:,::-1], rtol=1e-10), \
+            """bfe-py.coefficients spherical_grid_field phi array is failing """
+
+
+def test_cartesian_grid(tmp_path):
+    from bfe.coefficients import BFEpot
+    from bfe.coefficients.grids import CartesianGrid
+    nmax, lmax = 4, 4
+    S, T = expansion(nmax, lmax)
+    x = np.linspace(-40, 40, 7)
+    y = np.linspace(-30, 50, 6)
+    z = np.linspace(-20, 25, 5)
+    X, Y, Z = np.meshgrid(x, y, z, indexing='ij')
+    points = np.array([X.flatten(), Y.flatten(), Z.flatten()]).T
+    pot, acc, rho = BFEpot(points, S, T, 10.0, nmax, lmax, G=1, M=1).main(schwimmbad.SerialPool())
+    grid_rho = CartesianGrid(x, y, z, S, T, 10.0, block_size=50).main(schwimmbad.SerialPool())
+    grid_pot = CartesianGrid(x, y, z, S, T, 10.0, quantity='potential',
+                             filename=str(tmp_path / "pot.npy")).main(schwimmbad.SerialPool())
+    grid_acc = CartesianGrid(x, y, z, S, T, 10.0, quantity='acceleration',
+                             output=np.zeros((7, 6, 5, 3))).main(schwimmbad.SerialPool())
+
+    assert np.allclose(grid_rho.flatten(), rho, rtol=1e-12), \
+            """bfe-py.coefficients CartesianGrid density is failing """
+    assert np.allclose(grid_pot.flatten(), pot, rtol=1e-12), \
+            """bfe-py.coefficients CartesianGrid potential is failing """
+    assert np.all(np.load(tmp_path / "pot.npy") == grid_pot), \
+            """bfe-py.coefficients CartesianGrid memory-mapped file is failing """
+    assert np.allclose(grid_acc.reshape(-1, 3), acc, rtol=1e-12), \
+            """bfe-py.coefficients CartesianGrid acceleration is failing """
+
+
+def test_composite_field():
+    from bfe.coefficients import BFEpot
+    from bfe.coefficients.fields import CompositeField
+    pos, mass = load_halo()
+    nmax, lmax = 4, 4
+    S, T = expansion(nmax, lmax)
+    points = pos[::7]
+    center = np.array([5.0, -8.0, 3.0])
+    rcut = 20.0
+    field = CompositeField(points, G=2.0, acceleration=True, density=True)
+    field.add_component(S, T, 10.0, M=3.0)
+    field.add_component(S[:3,:3,:3], 0.5*T[:3,:3,:3], 4.0, center=center, rcut=rcut)
+    pot, acc, rho = field.main(schwimmbad.SerialPool(), block_size=333)
+
+    pot1, acc1, rho1 = BFEpot(points, S, T, 10.0, nmax, lmax, G=2.0, M=3.0).main(schwimmbad.SerialPool())
+    pot2, acc2, rho2 = BFEpot(points - center, S[:3,:3,:3], 0.5*T[:3,:3,:3], 4.0, 2, 2,
+                              G=2.0, M=1).main(schwimmbad.SerialPool())
+    outside = np.linalg.norm(points - center, axis=1) >= rcut
+    pot2[outside] = 0
+    acc2[outside] = 0
+    rho2[outside] = 0
+
+    assert np.allclose(pot, pot1 + pot2, rtol=1e-12), \
+            """bfe-py.coefficients CompositeField potential is failing """
+    assert np.allclose(acc, acc1 + acc2, rtol=1e-12), \
+            """bfe-py.coefficients CompositeField acceleration is failing """
+    assert np.allclose(rho, rho1 + rho2, rtol=1e-12), \
+            """bfe-py.coefficients CompositeField density is failing """
+
+    empty = CompositeField(np.empty((0, 3)), acceleration=True)
+    empty.add_component(S, T, 10.0)
+    pot, acc, rho = empty.main(schwimmbad.SerialPool())
+    assert (pot.shape == (0,)) & (acc.shape == (0, 3)) & (rho is None), \
+            """bfe-py.coefficients CompositeField without points is failing """
+    pot, acc, rho = BFEpot(np.empty((0, 3)), S, T, 10.0, nmax, lmax, 1, 1).main(schwimmbad.SerialPool())
+    assert (pot.shape == (0,)) & (acc.shape == (0, 3)) & (rho.shape == (0,)), \
+            """bfe-py.coefficients BFEpot without points is failing """
+
+
+def test_subset_contrast():
+    from bfe.coefficients.grids import CartesianGrid
+    from bfe.coefficients.sparse_coefficients import subset_mask
+    nmax, lmax = 4, 4
+    S, T = expansion(nmax, lmax)
+    x = np.linspace(-40, 40, 7)
+    y = np.linspace(-30, 50, 6)
+    z = np.linspace(-20, 25, 5)
+    rho = CartesianGrid(x, y, z, S, T, 10.0).main(schwimmbad.SerialPool())
+    for kwargs in [dict(nmax_subset=0, lmax_subset=0), dict(lmax_subset=2), dict(m=[0, 2])]:
+        subset = subset_mask(nmax, lmax, **kwargs)
+        rho_subset = CartesianGrid(x, y, z, S*subset, T*subset, 10.0).main(schwimmbad.SerialPool())
+        q = CartesianGrid(x, y, z, S, T, 10.0, subset=subset).main(schwimmbad.SerialPool())
+
+        assert np.allclose(q[...,0], rho, rtol=1e-12), \
+                """bfe-py.coefficients subset full density is failing """
+        assert np.allclose(q[...,1], rho_subset, rtol=1e-12), \
+                """bfe-py.coefficients subset density is failing """
+        assert np.allclose(q[...,2], rho/rho_subset, rtol=1e-12), \
+                """bfe-py.coefficients subset ratio is failing """
+
+
+def test_incremental_bound_particles():
+    from bfe.satellites.bound_satellites import find_bound_particles
+    data = np.loadtxt(data_path)[:3000]
+    pos, vel, mass, ids = data[:,0:3], data[:,3:6], 30*data[:,6], np.arange(3000)
+    bound = find_bound_particles(pos, vel, mass, ids, 10.0, 4, 4, 1, incremental=False)
+    bound_incremental = find_bound_particles(pos, vel, mass, ids, 10.0, 4, 4, 2, incremental=True)
+    assert set(bound_incremental[2]) == set(bound[2]), \
+            """bfe-py.satellites incremental bound particles are failing """
+    assert set(bound_incremental[5]) == set(bound[5]), \
+            """bfe-py.satellites incremental unbound particles are failing """
+
+
+def test_shared_memory_pool_first():
+    # the workers of a pool created before the shared arrays attach to
+    # them, they must not unlink them or report them as leaked
+    import subprocess, sys
+    script = "\n".join([
+        "import numpy as np, schwimmbad",
+        "from bfe.coefficients import Coeff_parallel",
+        "data = np.loadtxt({!r})".format(data_path),
+        "pool = schwimmbad.MultiPool(2)",
+        "halo_coeff = Coeff_parallel(data[:,0:3], data[:,6], 10.0, False, 4, 4, shared_memory=True)",
+        "results = halo_coeff.main(pool)",
+        "serial_coeff = Coeff_parallel(data[:,0:3], data[:,6], 10.0, False, 4, 4)",
+        "assert np.allclose(results, serial_coeff.main(schwimmbad.SerialPool()))"])
+    run = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+    assert run.returncode == 0, run.stderr
+    assert 'resource_tracker' not in run.stderr, \
+            """bfe-py.coefficients shared memory with a MultiPool is failing """
+
+
+def test_stream_com_id_cut(tmp_path):
+    # same center and ID cut as the in-memory path of io_snaps
+    from pynbody.analysis._com import shrink_sphere_center as ssc
+    from bfe.coefficients.stream_coefficients import stream_com, host_id_cut
+    pos, mass = load_halo()
+    pos = pos + np.array([30.0, -10.0, 5.0])
+    pids = np.random.default_rng(0).permutation(len(mass)).astype(np.uint64)
+    snapname = str(tmp_path / "snap.hdf5")
+    with h5py.File(snapname, 'w') as f:
+        particles = f.create_group('PartType1')
+        particles['Coordinates'] = pos
+        particles['Masses'] = mass
+        particles['ParticleIDs'] = pids
+    assert host_id_cut(snapname, 6000, chunk_size=999, nbins=64) == np.sort(pids)[6000], \
+            """bfe-py.coefficients host_id_cut is failing """
+
+    host = pids < np.sort(pids)[6000]
+    rcom = ssc(np.ascontiguousarray(pos[host]), np.ascontiguousarray(mass[host]), min_particles=1000,
+               shrink_factor=0.9, starting_rmax=500, num_threads=2)
+    for nsample in [1000000, 2000]:
+        rcom_stream = stream_com(snapname, 'host', np.sort(pids)[6000], chunk_size=999, nsample=nsample)
+        assert np.allclose(rcom_stream, rcom, rtol=0, atol=1e-4), \
+                """bfe-py.coefficients stream_com is failing """
+
+
+def test_acceleration_axis():
+    # grids with an odd number of points per axis have points on the z axis
+    # and at the origin
+    from bfe.coefficients import BFEpot
+    from bfe.coefficients.grids import CartesianGrid
+    S, T = expansion(4, 4)
+    x = np.linspace(-20, 20, 5)
+    grid_acc = CartesianGrid(x, x, x, S, T, 10.0, quantity='acceleration').main(
+            schwimmbad.SerialPool()).reshape(-1, 3)
+    X, Y, Z = np.meshgrid(x, x, x, indexing='ij')
+    points = np.array([X.flatten(), Y.flatten(), Z.flatten()]).T
+    origin = np.all(points == 0, axis=1)
+    assert np.all(np.isfinite(grid_acc)), \
+            """bfe-py.coefficients acceleration on the z axis is failing """
+    # limit on the axis
+    acc_near = BFEpot(points + np.array([1e-7, -1e-7, 0]), S, T, 10.0, 4, 4, G=1, M=1).main(
+            schwimmbad.SerialPool())[1]
+    assert np.allclose(grid_acc[~origin], acc_near[~origin], rtol=0,
+                       atol=1e-5*np.abs(acc_near).max())
+    # mean of two opposite points next to the origin
+    near = np.array([[1e-6, 2e-6, -1e-6], [-1e-6, -2e-6, 1e-6]])
+    acc_origin = np.mean(BFEpot(near, S, T, 10.0, 4, 4, G=1, M=1).main(schwimmbad.SerialPool())[1], axis=0)
+    assert np.allclose(grid_acc[origin], acc_origin, rtol=1e-5), \
+            """bfe-py.coefficients acceleration at the origin is failing """
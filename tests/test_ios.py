@@ -0,0 +1,286 @@
+import h5py
+import numpy as np
+from bfe.ios import Snapshot
+
+
+def write_snapshot(filename, npart=1000, seed=0):
+    """
+    Gadget-4 like hdf5 snapshot with dm and disk particles, the dm
+    masses are only in the header MassTable.
+    """
+    rng = np.random.default_rng(seed)
+    data = {'pos':rng.normal(size=(npart, 3)), 'vel':rng.normal(size=(npart, 3)),
+            'pid':rng.permutation(npart).astype(np.uint64), 'pot':rng.normal(size=npart),
+            'disk_pos':rng.normal(size=(50, 3)), 'disk_mass':rng.uniform(size=50)}
+    with h5py.File(filename, 'w') as f:
+        f.create_group('Header').attrs['MassTable'] = np.array([0, 2.5, 0, 0, 0, 0])
+        dm = f.create_group('PartType1')
+        dm['Coordinates'] = data['pos']
+        dm['Velocities'] = data['vel']
+        dm['ParticleIDs'] = data['pid']
+        dm['Potential'] = data['pot']
+        disk = f.create_group('PartType2')
+        disk['Coordinates'] = data['disk_pos']
+        disk['Velocities'] = rng.normal(size=(50, 3))
+        disk['Potential'] = rng.normal(size=50)
+        disk['Masses'] = data['disk_mass']
+    return data
+
+
+def test_snapshot(tmp_path):
+    data = write_snapshot(str(tmp_path / "snap_000.hdf5"))
+    index = np.array([17, 3, 999, 3, 500])
+    with Snapshot(str(tmp_path / "snap_000")) as snap:
+        assert snap.npart == {'PartType1':1000, 'PartType2':50}
+        assert snap.has_parttype('disk') & (snap.has_parttype('bulge') == False), \
+                """bfe-py.ios.Snapshot particle types are failing """
+        assert np.array_equal(snap.get('pos', index=index), data['pos'][index]), \
+                """bfe-py.ios.Snapshot index is failing """
+        assert np.array_equal(snap.get('pid', index=slice(10, 20)), data['pid'][10:20]), \
+                """bfe-py.ios.Snapshot slice is failing """
+        assert np.array_equal(snap.get('mass', index=index), np.full(5, 2.5)), \
+                """bfe-py.ios.Snapshot MassTable is failing """
+        assert len(snap.fields) == 0
+        pot = snap.get('pot')
+        assert snap.get('pot') is pot, \
+                """bfe-py.ios.Snapshot cache is failing """
+        assert np.array_equal(snap.get('pot', index=index), data['pot'][index])
+        assert np.array_equal(snap.get('mass', 'disk'), data['disk_mass'])
+
+
+def test_id_selection(tmp_path):
+    from bfe.ios.selection import IdSelection, host_id_cut
+    data = write_snapshot(str(tmp_path / "snap_000.hdf5"))
+    pids = data['pid']
+    assert host_id_cut(pids, 700) == np.sort(pids)[700], \
+            """bfe-py.ios.host_id_cut is failing """
+
+    filename = str(tmp_path / "id_cut.yaml")
+    with Snapshot(str(tmp_path / "snap_000")) as snap:
+        selection = IdSelection.from_snapshot(snap, 700, filename)
+    assert (selection.id_cut == 700) & (selection.ordered == False)
+    assert np.array_equal(selection.index(pids, 'sat'), np.where(pids >= 700)[0]), \
+            """bfe-py.ios.IdSelection is failing """
+    stored = IdSelection.read(filename)
+    assert (stored.id_cut, stored.N_host_particles, stored.ordered) == (700, 700, False), \
+            """bfe-py.ios.IdSelection sidecar is failing """
+
+    chunks = IdSelection.from_chunks(str(tmp_path / "snap_000.hdf5"), 700, chunk_size=77)
+    assert (chunks.id_cut, chunks.ordered) == (700, False), \
+            """bfe-py.ios.IdSelection from_chunks is failing """
+
+    ordered = IdSelection.from_pids(np.arange(1000), 700)
+    assert ordered.ordered & (ordered.index(np.arange(1000), 'sat') == slice(700, None)), \
+            """bfe-py.ios.IdSelection ordered is failing """
+    assert np.array_equal(ordered.index(pids, 'host'), np.where(pids < 700)[0]), \
+            """bfe-py.ios.IdSelection unordered snapshot is failing """
+
+
+def test_shared_snapshot(tmp_path):
+    from bfe.ios import read_snap_coordinates
+    from bfe.ios.selection import IdSelection
+    write_snapshot(str(tmp_path / "snap_000.hdf5"))
+    path = str(tmp_path) + "/"
+    sat = read_snap_coordinates(path, "snap_000", 700, com_frame='host', galaxy='sat')
+    with Snapshot(path + "snap_000") as snap:
+        selection = IdSelection.from_snapshot(snap, 700)
+        snap.load(['pos', 'vel', 'pid', 'pot', 'mass'])
+        shared = read_snap_coordinates(path, "snap_000", 700, com_frame='host', galaxy='sat',
+                                       selection=selection, snapshot=snap)
+        assert snap.file is not None
+
+    for a, b in zip(sat, shared):
+        assert np.array_equal(a, b), \
+                """bfe-py.ios shared snapshot is failing """
+
+
+def test_multifile_snapshot(tmp_path):
+    from bfe.ios.read_snap import load_snapshot
+    data = write_snapshot(str(tmp_path / "snap_000.hdf5"))
+    # the same particles split in three files, the last one without disk
+    dm_split = [0, 300, 650, 1000]
+    disk_split = [0, 20, 50, 50]
+    with h5py.File(str(tmp_path / "snap_000.hdf5"), 'r') as single:
+        for i in range(3):
+            with h5py.File(str(tmp_path / "snap_001.{:d}.hdf5".format(i)), 'w') as f:
+                header = f.create_group('Header')
+                header.attrs['MassTable'] = single['Header'].attrs['MassTable']
+                header.attrs['NumFilesPerSnapshot'] = 3
+                header.attrs['NumPart_ThisFile'] = np.array(
+                    [0, dm_split[i+1]-dm_split[i], disk_split[i+1]-disk_split[i], 0, 0, 0])
+                for ptype, split in [('PartType1', dm_split), ('PartType2', disk_split)]:
+                    if split[i+1] > split[i]:
+                        for name, dset in single[ptype].items():
+                            f[ptype+'/'+name] = dset[split[i]:split[i+1]]
+
+    with Snapshot(str(tmp_path / "snap_001"), nreaders=2) as snap:
+        assert snap.npart == {'PartType1':1000, 'PartType2':50}, \
+                """bfe-py.ios.Snapshot multi-file headers are failing """
+        snap.load(['pos', 'pid', 'mass'])
+        assert np.array_equal(snap.get('pos'), data['pos']), \
+                """bfe-py.ios.Snapshot multi-file read is failing """
+        assert np.array_equal(snap.get('pid', index=slice(250, 700)), data['pid'][250:700])
+        assert snap.get('pid').dtype == data['pid'].dtype, \
+                """bfe-py.ios.Snapshot multi-file dtypes are failing """
+        assert np.array_equal(snap.get('mass'), np.full(1000, 2.5))
+        assert np.array_equal(snap.get('mass', 'disk'), data['disk_mass'])
+    assert np.array_equal(load_snapshot(str(tmp_path / "snap_001"), 3, 'pot', 'dm'), data['pot']), \
+            """bfe-py.ios.load_snapshot multi-file is failing """
+
+
+def write_gadget2(filename, snapformat=1, seed=0):
+    """
+    Gadget-2 binary snapshot with 30 gas, 100 dm and 20 disk particles,
+    the dm masses are only in the header.
+    """
+    from bfe.ios.gadget2_reader import HEADER
+    rng = np.random.default_rng(seed)
+    npart = np.array([30, 100, 20, 0, 0, 0])
+    header = np.zeros(1, dtype=HEADER)
+    header['npart'] = npart
+    header['npartTotal'] = npart
+    header['massarr'] = [0, 2.5, 0, 0, 0, 0]
+    header['num_files'] = 1
+    data = {'POS':rng.normal(size=(150, 3)).astype(np.float32),
+            'VEL':rng.normal(size=(150, 3)).astype(np.float32),
+            'ID':rng.permutation(150).astype(np.uint32),
+            'MASS':rng.uniform(size=50).astype(np.float32),
+            'U':rng.uniform(size=30).astype(np.float32),
+            'POT':rng.normal(size=150).astype(np.float32)}
+    with open(filename, 'wb') as f:
+        for name, block in [('HEAD', header)] + list(data.items()):
+            size = np.array([block.nbytes], dtype=np.int32)
+            if snapformat == 2:
+                np.array([8], dtype=np.int32).tofile(f)
+                f.write(name.ljust(4).encode('ascii'))
+                np.array([block.nbytes + 8], dtype=np.int32).tofile(f)
+                np.array([8], dtype=np.int32).tofile(f)
+            size.tofile(f)
+            block.tofile(f)
+            size.tofile(f)
+    return data
+
+
+def test_gadget2_reader(tmp_path):
+    from bfe.ios.read_snap import load_snapshot
+    for snapformat in [1, 2]:
+        filename = str(tmp_path / "snap_{:03d}".format(snapformat))
+        data = write_gadget2(filename, snapformat)
+        with Snapshot(filename, snapformat=1) as snap:
+            assert snap.npart == {'PartType0':30, 'PartType1':100, 'PartType2':20}
+            pos = snap.get('pos')
+            assert isinstance(pos.base, np.memmap) | isinstance(pos, np.memmap), \
+                    """bfe-py.ios.GadgetBinary memmap is failing """
+            assert np.array_equal(pos, data['POS'][30:130]), \
+                    """bfe-py.ios.GadgetBinary positions are failing """
+            assert np.array_equal(snap.get('pid', 'disk', index=[3, 1]), data['ID'][130:][[3, 1]])
+            assert np.array_equal(snap.get('mass'), np.full(100, 2.5))
+            assert np.array_equal(snap.get('mass', 'disk'), data['MASS'][30:]), \
+                    """bfe-py.ios.GadgetBinary masses are failing """
+            assert np.array_equal(snap.get('pot', 'disk'), data['POT'][130:]), \
+                    """bfe-py.ios.GadgetBinary optional blocks are failing """
+        assert np.array_equal(load_snapshot(filename, 1, 'vel', 'dm'), data['VEL'][30:130])
+
+
+def pipeline_config(path, **kwargs):
+    config = {'inpath':path, 'snapname':"snap", 'outpath':path, 'outname':"BFE",
+              'npartHalo':3000, 'samplePart':0, 'nmax':4, 'lmax':4, 'mmax':4,
+              'rs':10.0, 'ncores':1, 'mpi':0, 'rhaloCut':500, 'initSnap':0,
+              'finalSnap':1, 'SatBFE':1, 'Satrs':2.0, 'nmaxSat':2, 'lmaxSat':2,
+              'mmaxSat':2, 'HostBFE':1, 'SatBoundParticles':1, 'HostSatUnboundPart':1,
+              'WriteSnapsAscii':0, 'OutIdsBoundUnbound':1, 'PlotScatterSample':0,
+              'samplePartSat':0, 'snapformat':3, 'variance':True, 'coeffEngine':"fused",
+              'coeffMode':"particles"}
+    config.update(kwargs)
+    return config
+
+
+def run_pipeline(tmp_path, config):
+    """
+    Runs bfe/pipeline/pipeline.py with the parameters in config.
+    """
+    import os
+    import sys
+    import subprocess
+    import yaml
+    paramfile = str(tmp_path / "config_{}.yaml".format(config['outname']))
+    with open(paramfile, 'w') as f:
+        yaml.safe_dump(config, f)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, MPLBACKEND="Agg",
+               PYTHONPATH=os.pathsep.join([root] + sys.path))
+    run = subprocess.run([sys.executable, "pipeline.py", "--param", paramfile,
+                          "--ncores", "1"], cwd=os.path.join(root, "bfe/pipeline"),
+                         env=env, capture_output=True, text=True)
+    assert run.returncode == 0, run.stderr
+
+
+def write_host_satellite(filename, disk=False, masses=False):
+    """
+    Snapshot with 3000 host and 1000 satellite dm particles (IDs < 3000
+    are the host), and a disk in the host if disk is True.
+    """
+    import os
+    data = np.loadtxt(os.path.join(os.path.dirname(__file__), "data/plummer_sphere_10K.txt"))
+    host, sat = data[:3000], data[3000:4000]
+    with h5py.File(filename, 'w') as f:
+        f.create_group('Header').attrs['MassTable'] = np.array([0, 1e-4, 0, 0, 0, 0])
+        dm = f.create_group('PartType1')
+        dm['Coordinates'] = np.vstack([host[:,:3], 0.2*sat[:,:3] + [60, 0, 0]])
+        dm['Velocities'] = np.vstack([host[:,3:6], sat[:,3:6]])
+        dm['ParticleIDs'] = np.arange(4000, dtype=np.uint64)
+        dm['Potential'] = np.zeros(4000)
+        if masses == True:
+            dm['Masses'] = np.full(4000, 1e-4)
+        if disk == True:
+            # the minimum of the disk potential is off the dm center
+            pos_disk = 0.3*data[5000:5500,:3] + [1.5, -1.0, 0.5]
+            disk = f.create_group('PartType2')
+            disk['Coordinates'] = pos_disk
+            disk['Velocities'] = data[5000:5500,3:6]
+            disk['Potential'] = np.sum((pos_disk - [1.5, -1.0, 0.5])**2, axis=1)
+            disk['Masses'] = np.full(500, 1e-4)
+
+
+def test_pipeline(tmp_path):
+    # host and satellite expansions from one shared Snapshot per snapshot
+    import os
+    write_host_satellite(str(tmp_path / "snap_000.hdf5"))
+    path = str(tmp_path) + "/"
+    run_pipeline(tmp_path, pipeline_config(path))
+
+    for name in ["host", "host_sat_unbound", "sat_bound"]:
+        assert os.path.isfile(path + "BFE_{}_snap_000.hdf5".format(name)) | \
+               os.path.isfile(path + "BFE_{}_snap_000.txt.hdf5".format(name)), \
+                """bfe-py pipeline {} coefficients are missing """.format(name)
+    assert os.path.isfile(path + "snap_unbound_mw_lmc_frame_000.png_yz_density.png")
+
+    # the host+debris expansion is the host expansion plus the debris one
+    from bfe.coefficients import Coeff_parallel
+    from bfe.coefficients.coefficients_smoothing import reshape_matrix
+    import schwimmbad
+    pos = np.vstack([np.loadtxt(path + "snaphalo_particles_000.txt"),
+                     np.loadtxt(path + "snapdebris_particles_000.txt")])
+    results = Coeff_parallel(pos, np.full(len(pos), 1e-4), 10.0, True, 4, 4,
+                             engine='fused').main(schwimmbad.SerialPool())
+    with h5py.File(path + "BFE_host_sat_unbound_snap_000.hdf5", 'r') as f:
+        assert np.allclose(f['Snlm'][()], reshape_matrix(results[:,0], 4, 4, 4), rtol=1e-8, atol=1e-16)
+        assert np.allclose(f['var_Snlm'][()], reshape_matrix(results[:,2], 4, 4, 4), rtol=1e-8, atol=1e-20), \
+                """bfe-py pipeline host+debris coefficients are failing """
+
+
+def test_pipeline_stream_host(tmp_path):
+    # the streamed host expansion uses the same center (the minimum of the
+    # disk potential) as the expansion of the host read in memory
+    write_host_satellite(str(tmp_path / "snap_000.hdf5"), disk=True, masses=True)
+    path = str(tmp_path) + "/"
+    host_only = dict(SatBFE=0, SatBoundParticles=0, HostSatUnboundPart=0)
+    run_pipeline(tmp_path, pipeline_config(path, outname="memory", **host_only))
+    run_pipeline(tmp_path, pipeline_config(path, outname="stream", streamChunk=777, **host_only))
+    with h5py.File(path + "memory_host_snap_000.hdf5", 'r') as memory, \
+            h5py.File(path + "stream_host_snap_000.hdf5", 'r') as stream:
+        assert np.allclose(stream['rcom'][()], memory['rcom'][()], rtol=1e-12)
+        assert np.abs(memory['rcom'][()][0,0] - 1.5) < 0.5
+        for key in ['Snlm', 'Tnlm', 'var_Snlm']:
+            assert np.allclose(stream[key][()], memory[key][()], rtol=1e-8, atol=1e-20), \
+                    """bfe-py pipeline streamed host coefficients are failing """